@@ -0,0 +1,326 @@
+# Streaming zip writer for folder sends. Entries are produced piece by piece
+# so the archive can go on the wire while later files are still being
+# compressed: deflate work runs in a process pool a few chunks ahead of the
+# sender, each chunk is flushed on a byte boundary so the chunks of one file
+# concatenate into a single deflate stream, and sizes and CRCs follow each
+# entry in a data descriptor. Content that is already compressed (by
+# extension or by an entropy probe) is stored as-is.
+import collections
+import hashlib
+import math
+import os
+import struct
+import time
+import zlib
+
+# Uncompressed bytes per deflate job
+ARCHIVE_CHUNK = 1024 * 1024
+
+# Files below this size are deflated on the producer thread; a pool round
+# trip costs more than compressing them
+SMALL_FILE = 64 * 1024
+
+# Bytes sampled from the start of a file by the entropy probe, and the
+# bits-per-byte above which deflate is not worth running
+PROBE_SIZE = 64 * 1024
+STORE_ENTROPY = 7.5
+
+COMPRESSION_LEVEL = 6
+
+STORED_EXTENSIONS = {
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.heif', '.avif',
+    '.mp4', '.m4v', '.mkv', '.mov', '.avi', '.webm', '.3gp',
+    '.mp3', '.m4a', '.aac', '.ogg', '.opus', '.flac',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.7z', '.rar',
+    '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.epub', '.apk', '.jar', '.pdf'
+}
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_ENTRY_SIZE = 1 << 31  # entries this large get zip64 fields up front
+
+LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+CENTRAL_HEADER = struct.Struct('<4s6H3L5H2L')
+DATA_DESCRIPTOR = struct.Struct('<4s3L')
+DATA_DESCRIPTOR64 = struct.Struct('<4sL2Q')
+END_RECORD = struct.Struct('<4s4H2LH')
+END_RECORD64 = struct.Struct('<4sQ2H2L4Q')
+END_LOCATOR64 = struct.Struct('<4sLQL')
+
+
+def looks_compressed(path):
+    # Known compressed formats by extension, anything else by sampling the
+    # byte distribution of its first block
+    if os.path.splitext(path)[1].lower() in STORED_EXTENSIONS:
+        return True
+    try:
+        with open(path, 'rb') as f:
+            sample = f.read(PROBE_SIZE)
+    except OSError:
+        return False
+    return byte_entropy(sample) > STORE_ENTROPY
+
+
+def byte_entropy(data):
+    if not data:
+        return 0.0
+    total = len(data)
+    entropy = 0.0
+    for value in range(256):
+        count = data.count(value)
+        if count:
+            p = count / total
+            entropy -= p * math.log2(p)
+    return entropy
+
+
+def deflate_range(path, offset, length, last, level=COMPRESSION_LEVEL):
+    # Runs in a pool worker. Returns (compressed bytes, crc32, bytes read).
+    # Non-final chunks end with a sync flush so they can be concatenated.
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(length)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return compressed, zlib.crc32(data), len(data)
+
+
+def _gf2_times(matrix, vector):
+    result = 0
+    index = 0
+    while vector:
+        if vector & 1:
+            result ^= matrix[index]
+        vector >>= 1
+        index += 1
+    return result
+
+
+def _gf2_square(matrix):
+    return [_gf2_times(matrix, row) for row in matrix]
+
+
+def crc32_combine(crc1, crc2, length2):
+    # CRC of A+B from crc(A), crc(B) and len(B), as zlib's crc32_combine
+    if length2 <= 0:
+        return crc1
+    odd = [0xEDB88320] + [1 << n for n in range(31)]
+    even = _gf2_square(odd)
+    odd = _gf2_square(even)
+    while True:
+        even = _gf2_square(odd)
+        if length2 & 1:
+            crc1 = _gf2_times(even, crc1)
+        length2 >>= 1
+        if not length2:
+            break
+        odd = _gf2_square(even)
+        if length2 & 1:
+            crc1 = _gf2_times(odd, crc1)
+        length2 >>= 1
+        if not length2:
+            break
+    return crc1 ^ crc2
+
+
+def dos_time(timestamp):
+    t = time.localtime(timestamp)
+    year = max(t.tm_year, 1980)
+    return ((year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday,
+            t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2)
+
+
+class ArchiveEntry:
+    __slots__ = ('path', 'name', 'size', 'mtime', 'mode', 'method', 'zip64',
+                 'header_offset', 'crc', 'compress_size', 'file_size')
+
+    def __init__(self, path, name, stat):
+        self.path = path
+        self.name = name.encode('utf-8')
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.mode = stat.st_mode
+        self.method = ZIP_DEFLATED
+        self.zip64 = stat.st_size >= ZIP64_ENTRY_SIZE
+        self.header_offset = 0
+        self.crc = 0
+        self.compress_size = 0
+        self.file_size = 0
+
+
+class StreamingArchive:
+    # File-like producer of a zip archive of folder_path: read() returns the
+    # next piece of the archive and b'' at the end. Not thread-safe; one
+    # thread at a time may call read(). sha256 covers every byte returned.
+    # close() abandons it part way, cancelling deflate jobs not yet started.
+    def __init__(self, folder_path, pool=None, lookahead=None, level=COMPRESSION_LEVEL):
+        self.folder_path = folder_path
+        self.pool = pool
+        self.level = level
+        self.lookahead = lookahead or 2 * (os.cpu_count() or 1)
+        self.entries = list(self.scan())
+        self.total = sum(entry.size for entry in self.entries)
+        self.done = 0
+        self.offset = 0
+        self.sha256 = hashlib.sha256()
+        self.stored = 0
+        self.window = collections.deque()  # parts in flight, in archive order
+        self.pieces = self.generate()
+
+    def scan(self):
+        for root, dirs, files in os.walk(self.folder_path):
+            dirs.sort()
+            for file_name in sorted(files):
+                path = os.path.join(root, file_name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                rel_path = os.path.relpath(path, self.folder_path).replace(os.sep, '/')
+                yield ArchiveEntry(path, rel_path, stat)
+
+    def read(self):
+        piece = next(self.pieces, b'')
+        self.offset += len(piece)
+        self.sha256.update(piece)
+        return piece
+
+    def generate(self):
+        # Keeps up to lookahead deflate jobs in flight and yields results in
+        # archive order
+        window = self.window
+        for part in self.parts():
+            window.append(part)
+            while len(window) > self.lookahead:
+                yield from self.resolve(window.popleft())
+        while window:
+            yield from self.resolve(window.popleft())
+        yield self.central_directory()
+
+    def close(self):
+        self.pieces.close()
+        for part in self.window:
+            if part[0] == 'chunk' and not isinstance(part[2], tuple):
+                part[2].cancel()
+        self.window.clear()
+
+    def parts(self):
+        # ('header', entry), then ('chunk', entry, future or result) per
+        # deflate job or ('stored', entry), then ('end', entry)
+        for entry in self.entries:
+            if looks_compressed(entry.path):
+                entry.method = ZIP_STORED
+                self.stored += 1
+            yield ('header', entry)
+            if entry.method == ZIP_STORED:
+                yield ('stored', entry)
+            else:
+                inline = self.pool is None or entry.size < SMALL_FILE
+                offset = 0
+                while True:
+                    length = min(ARCHIVE_CHUNK, entry.size - offset)
+                    last = offset + length >= entry.size
+                    if inline:
+                        result = deflate_range(entry.path, offset, length, last, self.level)
+                    else:
+                        result = self.pool.submit(deflate_range, entry.path, offset, length, last, self.level)
+                    yield ('chunk', entry, result)
+                    offset += length
+                    if last:
+                        break
+            yield ('end', entry)
+
+    def resolve(self, part):
+        kind, entry = part[0], part[1]
+        if kind == 'header':
+            entry.header_offset = self.offset
+            yield self.local_header(entry)
+        elif kind == 'chunk':
+            result = part[2]
+            compressed, crc, length = result if isinstance(result, tuple) else result.result()
+            entry.crc = crc32_combine(entry.crc, crc, length)
+            entry.compress_size += len(compressed)
+            entry.file_size += length
+            self.done += length
+            yield compressed
+        elif kind == 'stored':
+            yield from self.read_stored(entry)
+        else:
+            yield self.data_descriptor(entry)
+
+    def read_stored(self, entry):
+        with open(entry.path, 'rb') as f:
+            while True:
+                data = f.read(ARCHIVE_CHUNK)
+                if not data:
+                    break
+                entry.crc = zlib.crc32(data, entry.crc)
+                entry.file_size += len(data)
+                entry.compress_size += len(data)
+                self.done += len(data)
+                yield data
+
+    def local_header(self, entry):
+        date, clock = dos_time(entry.mtime)
+        extra = struct.pack('<2H2Q', 1, 16, 0, 0) if entry.zip64 else b''
+        return LOCAL_HEADER.pack(
+            b'PK\x03\x04', 45 if entry.zip64 else 20, FLAG_DATA_DESCRIPTOR | FLAG_UTF8,
+            entry.method, clock, date, 0,
+            ZIP64_LIMIT if entry.zip64 else 0, ZIP64_LIMIT if entry.zip64 else 0,
+            len(entry.name), len(extra)) + entry.name + extra
+
+    def data_descriptor(self, entry):
+        if entry.zip64:
+            return DATA_DESCRIPTOR64.pack(b'PK\x07\x08', entry.crc, entry.compress_size, entry.file_size)
+        if entry.compress_size >= ZIP64_LIMIT or entry.file_size >= ZIP64_LIMIT:
+            raise ValueError(f"{entry.path} grew past 4 GB while archiving")
+        return DATA_DESCRIPTOR.pack(b'PK\x07\x08', entry.crc, entry.compress_size, entry.file_size)
+
+    def central_directory(self):
+        start = self.offset
+        records = []
+        for entry in self.entries:
+            date, clock = dos_time(entry.mtime)
+            zip64 = entry.zip64 or entry.header_offset >= ZIP64_LIMIT
+            if zip64:
+                extra = struct.pack('<2H3Q', 1, 24, entry.file_size, entry.compress_size, entry.header_offset)
+                sizes = (ZIP64_LIMIT, ZIP64_LIMIT, ZIP64_LIMIT)
+            else:
+                extra = b''
+                sizes = (entry.compress_size, entry.file_size, entry.header_offset)
+            version = 45 if zip64 else 20
+            records.append(CENTRAL_HEADER.pack(
+                b'PK\x01\x02', 3 << 8 | version, version, FLAG_DATA_DESCRIPTOR | FLAG_UTF8,
+                entry.method, clock, date, entry.crc, sizes[0], sizes[1],
+                len(entry.name), len(extra), 0, 0, 0, (entry.mode & 0xFFFF) << 16,
+                sizes[2]) + entry.name + extra)
+        directory = b''.join(records)
+        count = len(self.entries)
+        size = len(directory)
+
+        end = b''
+        if count >= 0xFFFF or start >= ZIP64_LIMIT or size >= ZIP64_LIMIT:
+            end = END_RECORD64.pack(b'PK\x06\x06', END_RECORD64.size - 12, 45, 45, 0, 0,
+                                    count, count, size, start) + \
+                  END_LOCATOR64.pack(b'PK\x06\x07', 0, start + size, 1)
+            count = min(count, 0xFFFF)
+            size = min(size, ZIP64_LIMIT)
+            start = min(start, ZIP64_LIMIT)
+        return directory + end + END_RECORD.pack(b'PK\x05\x06', 0, 0, count, count, size, start, 0)
+
+
+def write_archive(folder_path, file_path, pool=None):
+    # Whole archive into file_path, for peers that cannot receive a stream
+    archive = StreamingArchive(folder_path, pool)
+    with open(file_path, 'wb') as f:
+        while True:
+            piece = archive.read()
+            if not piece:
+                break
+            f.write(piece)
+    return archive
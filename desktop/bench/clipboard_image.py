@@ -0,0 +1,215 @@
+# Image clipboard latency over loopback, from the clipboard changing on one
+# side to the image being on the other: a stand-in device pushes PNG
+# screenshots to a SyncEngine with a MemoryClipboard, then (with PIL) the
+# engine picks up synthetic 1920x1080 screenshots from its clipboard,
+# encodes them and sends them to the device. Also checks that copying the
+# same screenshot again sends nothing, and that neither side echoes an
+# image back.
+#
+#   python desktop/bench/clipboard_image.py --rounds 10
+import argparse
+import asyncio
+import hashlib
+import importlib.util
+import itertools
+import os
+import queue
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clipimage
+import engine
+import protocol
+import qrimage
+from loopback_sessions import StandInClient
+
+WIDTH, HEIGHT = 1920, 1080
+
+
+class ImageListener(engine.Listener):
+    def __init__(self):
+        self.opened = threading.Semaphore(0)
+        self.images = queue.Queue()  # (perf_counter time, ClipboardImage)
+
+    def on_session_opened(self, session):
+        self.opened.release()
+
+    def on_clipboard_image_received(self, session, image):
+        self.images.put((time.perf_counter(), image))
+
+
+class ImageClient(StandInClient):
+    # Collects clipboard images from the engine and sends its own
+    def __init__(self):
+        super().__init__(0)
+        self.images = asyncio.Queue()  # (perf_counter time, format, data)
+        self.incoming = {}  # transfer id -> [format, size, data]
+        self.transfer_ids = itertools.count(1 << 30)
+
+    async def pump(self):
+        while True:
+            length_word, = protocol.LENGTH.unpack(await self.reader.readexactly(protocol.LENGTH.size))
+            is_binary, size = protocol.split_length(length_word)
+            data = await self.reader.readexactly(size)
+            if is_binary:
+                _, stream_id = protocol.BINARY_HEADER.unpack_from(data)
+                entry = self.incoming.get(stream_id)
+                if entry is None:
+                    continue
+                entry[2] += data[protocol.BINARY_HEADER.size:]
+                if len(entry[2]) >= entry[1]:
+                    del self.incoming[stream_id]
+                    self.images.put_nowait((time.perf_counter(), entry[0], bytes(entry[2])))
+                continue
+            message = protocol.decode_message(data)
+            if message.get('type') == 'clipboard_start' and message.get('format'):
+                self.incoming[message['transfer_id']] = [message['format'], message['size'], bytearray()]
+
+    async def send_image(self, data, mime=clipimage.PNG):
+        transfer_id = next(self.transfer_ids)
+        await self.send_message({
+            'type': 'clipboard_start',
+            'transfer_id': transfer_id,
+            'size': len(data),
+            'sha256': hashlib.sha256(data).hexdigest(),
+            'format': mime
+        })
+        for start in range(0, len(data), protocol.CHUNK_SIZE):
+            chunk = data[start:start + protocol.CHUNK_SIZE]
+            self.writer.write(protocol.encode_binary_header(transfer_id, len(chunk)) + chunk)
+        await self.writer.drain()
+
+
+def device_png(seed):
+    # A grayscale "screenshot" from the phone: flat background, lines of
+    # text-like marks; written without PIL
+    rng = random.Random(seed)
+    rows = []
+    for y in range(HEIGHT):
+        if y % 24 < 14 and 80 <= y < HEIGHT - 40:
+            row = bytearray(b'\xf2' * WIDTH)
+            x = 40
+            while x < WIDTH - 200:
+                word = rng.randint(12, 80)
+                row[x:x + word] = bytes(rng.choice((0x20, 0x30, 0x50)) for _ in range(word))
+                x += word + rng.randint(6, 14)
+            rows.append(bytes(row))
+        else:
+            rows.append(b'\x20' * WIDTH if y < 60 else b'\xf2' * WIDTH)
+    return qrimage.encode_png(rows, WIDTH)
+
+
+def desktop_screenshot(seed):
+    # An RGB desktop screenshot: title bar, sidebar, text and a photo
+    from PIL import Image, ImageDraw
+    rng = random.Random(seed)
+    image = Image.new('RGB', (WIDTH, HEIGHT), (246, 246, 248))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((0, 0, WIDTH, 40), fill=(36, 36, 40))
+    draw.rectangle((0, 40, 280, HEIGHT), fill=(228, 230, 236))
+    letters = 'abcdefghijklmnopqrstuvwxyz     '
+    for y in range(60, HEIGHT - 20, 22):
+        draw.text((20, y), ''.join(rng.choice(letters) for _ in range(30)), fill=(60, 60, 70))
+        draw.text((300, y), ''.join(rng.choice(letters) for _ in range(120)), fill=(20, 20, 20))
+    size = (480, 320)
+    gradient = Image.linear_gradient('L').resize(size)
+    grain = Image.frombytes('L', size, rng.randbytes(size[0] * size[1])).point(lambda v: 96 + v // 4)
+    image.paste(Image.merge('RGB', (gradient, gradient.transpose(Image.Transpose.FLIP_TOP_BOTTOM), grain)), (1380, 120))
+    return image
+
+
+async def device_to_desktop(client, listener, clipboard, rounds):
+    loop = asyncio.get_running_loop()
+    latencies = []
+    size = 0
+    lazy = True
+    for i in range(rounds):
+        data = device_png(i)
+        size = len(data)
+        start = time.perf_counter()
+        await client.send_image(data)
+        arrived, image = await loop.run_in_executor(None, listener.images.get, True, 10)
+        latencies.append(arrived - start)
+        lazy = lazy and image.decoded is None and clipboard.image is image
+    await asyncio.sleep(1)  # the watcher sees the new clipboard; nothing may go back
+    return latencies, size, lazy, client.images.qsize()
+
+
+async def desktop_to_device(client, listener, clipboard, rounds):
+    latencies = []
+    data = None
+    for i in range(rounds):
+        image = clipimage.ClipboardImage(image=desktop_screenshot(i))
+        start = time.perf_counter()
+        clipboard.copy_image(image)
+        arrived, _, data = await asyncio.wait_for(client.images.get(), 10)
+        latencies.append(arrived - start)
+
+    # The same screenshot captured again, then the device echoing it back
+    clipboard.copy_image(clipimage.ClipboardImage(image=desktop_screenshot(rounds - 1)))
+    await client.send_image(data)
+    await asyncio.sleep(1)
+    shot = desktop_screenshot(0)
+    encode = []
+    for _ in range(3):
+        start = time.perf_counter()
+        clipimage.encode_png(shot)
+        encode.append(time.perf_counter() - start)
+    return latencies, len(data), statistics.median(encode), client.images.qsize(), listener.images.qsize()
+
+
+async def run(listener, clipboard, address, rounds):
+    loop = asyncio.get_running_loop()
+    client = ImageClient()
+    await client.connect(*address)
+    await loop.run_in_executor(None, listener.opened.acquire)
+    pump = loop.create_task(client.pump())
+    try:
+        received = await device_to_desktop(client, listener, clipboard, rounds)
+        sent = None
+        if importlib.util.find_spec('PIL') is not None:
+            sent = await desktop_to_device(client, listener, clipboard, rounds)
+    finally:
+        pump.cancel()
+        client.close()
+    return received, sent
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Image clipboard sync latency")
+    parser.add_argument('--rounds', type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_folder:
+        config = dict(engine.default_config(), sync_folder=os.path.join(work_folder, 'sync'), discovery=False)
+        listener = ImageListener()
+        clipboard = engine.MemoryClipboard()
+        sync_engine = engine.SyncEngine(config, os.path.join(work_folder, 'config.json'), clipboard, listener,
+                                        ':memory:', ':memory:', os.path.join(work_folder, 'identity.pem'))
+        address = sync_engine.start('127.0.0.1', 0)
+        try:
+            received, sent = asyncio.run(run(listener, clipboard, address, args.rounds))
+        finally:
+            sync_engine.close()
+
+    latencies, size, lazy, echoes = received
+    print(f"device -> desktop: median {statistics.median(latencies) * 1000:.1f} ms, "
+          f"max {max(latencies) * 1000:.1f} ms ({size // 1024} KB PNG, {WIDTH}x{HEIGHT})")
+    print(f"  left encoded on arrival: {'yes' if lazy else 'NO'}; echoed back to the device: {echoes}")
+    if sent is None:
+        print("desktop -> device: n/a (needs PIL)")
+        return
+    latencies, size, encode, duplicates, echoes = sent
+    print(f"desktop -> device: median {statistics.median(latencies) * 1000:.1f} ms, "
+          f"max {max(latencies) * 1000:.1f} ms ({size // 1024} KB PNG, encode {encode * 1000:.0f} ms)")
+    print(f"  sent again after copying the same screenshot: {duplicates}; device echo applied: {echoes}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# Clipboard latency during a bulk transfer: one stand-in client receives a
+# large file from the server while it keeps asking for the clipboard, and the
+# round trips are compared with an idle connection. Also prints the server's
+# send queue figures for the session.
+#
+#   python desktop/bench/clipboard_under_load.py --size-mb 512
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import protocol
+from loopback_sessions import EchoHandler, StandInClient, percentile
+from server import ConnectionManager
+
+
+class BulkReceiver(StandInClient):
+    # Accepts and discards incoming files while answering clipboard nonces
+    def __init__(self, index):
+        super().__init__(index)
+        self.nonces = {}
+        self.file_done = None
+
+    async def pump(self):
+        while True:
+            length_word, = protocol.LENGTH.unpack(await self.reader.readexactly(protocol.LENGTH.size))
+            is_binary, size = protocol.split_length(length_word)
+            data = await self.reader.readexactly(size)
+            if is_binary:
+                continue
+            message = protocol.decode_message(data)
+            msg_type = message.get('type')
+            if msg_type == 'clipboard' and message.get('data') in self.nonces:
+                self.nonces.pop(message['data']).set_result(time.perf_counter())
+            elif msg_type == 'signature_request':
+                await self.send_message({'type': 'signatures', 'transfer_id': message['transfer_id'], 'blocks': []})
+            elif msg_type == 'file_start':
+                await self.send_message({'type': 'file_accept', 'transfer_id': message['transfer_id'], 'offset': 0})
+            elif msg_type == 'file_end':
+                await self.send_message({'type': 'file_done', 'transfer_id': message['transfer_id'], 'ok': True})
+                if self.file_done is not None and not self.file_done.done():
+                    self.file_done.set_result(None)
+
+    async def round_trip(self, nonce):
+        reply = asyncio.get_running_loop().create_future()
+        self.nonces[nonce] = reply
+        start = time.perf_counter()
+        await self.send_message({'type': 'clipboard_request', 'nonce': nonce})
+        return await reply - start
+
+
+async def measure(client, label, rounds, until=None):
+    latencies = []
+    for i in range(rounds):
+        if until is not None and until.done():
+            break
+        latencies.append(await client.round_trip(f"{label}:{i}"))
+        await asyncio.sleep(0.005)
+    return latencies
+
+
+async def run(manager, address, file_path, rounds):
+    client = BulkReceiver(0)
+    await client.connect(*address)
+    await asyncio.get_running_loop().run_in_executor(None, manager.handler.opened.acquire)
+    pump = asyncio.get_running_loop().create_task(client.pump())
+
+    idle = await measure(client, 'idle', rounds)
+
+    client.file_done = asyncio.get_running_loop().create_future()
+    start = time.perf_counter()
+    sending = asyncio.wrap_future(manager.send_file(file_path, 'bulk.bin'))
+    loaded = await measure(client, 'loaded', rounds * 10, client.file_done)
+    await sending
+    elapsed = time.perf_counter() - start
+
+    stats = manager.queue_stats()
+    pump.cancel()
+    client.close()
+    return idle, loaded, elapsed, next(iter(stats.values()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--rounds', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as sync_folder:
+        file_path = os.path.join(sync_folder, 'bulk.bin')
+        with open(file_path, 'wb') as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(1024 * 1024))
+
+        manager = ConnectionManager(EchoHandler(), lambda: sync_folder)
+        address = manager.start('127.0.0.1', 0)
+        try:
+            idle, loaded, elapsed, stats = asyncio.run(run(manager, address, file_path, args.rounds))
+        finally:
+            manager.stop()
+
+    print(f"bulk transfer: {args.size_mb} MB in {elapsed:.2f}s ({args.size_mb / elapsed:.0f} MB/s)")
+    for label, values in (('idle', idle), ('during transfer', loaded)):
+        if values:
+            print(f"clipboard rtt {label:>16}: p50 {statistics.median(values) * 1000:.2f}ms "
+                  f"p99 {percentile(values, 0.99) * 1000:.2f}ms ({len(values)} samples)")
+    print("send queue: " + ", ".join(f"{key} {value:.2f}" if isinstance(value, float) else f"{key} {value}"
+                                     for key, value in stats.items() if key != 'channels'))
+
+
+if __name__ == '__main__':
+    main()
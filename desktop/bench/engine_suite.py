@@ -0,0 +1,237 @@
+# Benchmark suite for the headless engine: a scripted stand-in mobile
+# client drives a SyncEngine over loopback. Reports file throughput per size
+# in both directions, the small-file rate, clipboard round-trip latency and
+# peak RSS (client and engine share the process). Results can be saved as a
+# JSON baseline; a later run compared against it exits non-zero when a
+# metric regressed by more than the tolerance.
+#
+#   python desktop/bench/engine_suite.py --save baseline.json
+#   python desktop/bench/engine_suite.py --compare baseline.json
+import argparse
+import asyncio
+import json
+import os
+import platform
+import queue
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import engine
+import protocol
+from loopback_sessions import StandInClient, percentile
+
+SMALL_FILE_SIZE = 4 * 1024
+
+
+class BenchListener(engine.Listener):
+    def __init__(self):
+        self.opened = threading.Semaphore(0)
+        self.received = queue.Queue()
+
+    def on_session_opened(self, session):
+        self.opened.release()
+
+    def on_file_received(self, session, file_path):
+        self.received.put(file_path)
+
+    def on_transfer_error(self, session, name, error):
+        print(f"Transfer error from {session.device_name}: {error}")
+
+
+class ScriptedClient(StandInClient):
+    # Accepts and discards files from the engine, answers its requests and
+    # uploads files the way the mobile app does
+    def __init__(self, index):
+        super().__init__(index)
+        self.waiting = {}  # message type -> future for the next one
+        self.transfer_ids = iter(range(1 << 30, 1 << 31))
+
+    def expect(self, msg_type):
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[msg_type] = future
+        return future
+
+    async def pump(self):
+        while True:
+            length_word, = protocol.LENGTH.unpack(await self.reader.readexactly(protocol.LENGTH.size))
+            is_binary, size = protocol.split_length(length_word)
+            data = await self.reader.readexactly(size)
+            if is_binary:
+                continue
+            message = protocol.decode_message(data)
+            msg_type = message.get('type')
+            if msg_type == 'signature_request':
+                await self.send_message({'type': 'signatures', 'transfer_id': message['transfer_id'], 'blocks': []})
+            elif msg_type == 'file_start' and message.get('resume_key'):
+                await self.send_message({'type': 'file_accept', 'transfer_id': message['transfer_id'], 'offset': 0})
+            elif msg_type == 'file_end':
+                await self.send_message({'type': 'file_done', 'transfer_id': message['transfer_id'], 'ok': True})
+            future = self.waiting.pop(msg_type, None)
+            if future is not None and not future.done():
+                future.set_result(message)
+
+    async def upload(self, file_path, name):
+        transfer_id = next(self.transfer_ids)
+        size = os.path.getsize(file_path)
+        await self.send_message({'type': 'file_start', 'transfer_id': transfer_id, 'name': name, 'size': size})
+        with open(file_path, 'rb') as f:
+            while True:
+                chunk = f.read(protocol.CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.writer.write(protocol.encode_binary_header(transfer_id, len(chunk)) + chunk)
+                await self.writer.drain()
+        await self.send_message({'type': 'file_end', 'transfer_id': transfer_id, 'size': size})
+
+
+def make_file(path, size):
+    with open(path, 'wb') as f:
+        while size:
+            count = min(size, 1024 * 1024)
+            f.write(os.urandom(count))
+            size -= count
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 ** 2) if sys.platform == 'darwin' else peak / 1024
+
+
+async def run(sync_engine, listener, address, work_folder, args):
+    loop = asyncio.get_running_loop()
+    client = ScriptedClient(0)
+    await client.connect(*address)
+    await loop.run_in_executor(None, listener.opened.acquire)
+    pump = loop.create_task(client.pump())
+    metrics = {}
+
+    for size_mb in args.sizes:
+        file_path = os.path.join(work_folder, f"bench-{size_mb}mb.bin")
+        await loop.run_in_executor(None, make_file, file_path, size_mb * 1024 * 1024)
+
+        start = time.perf_counter()
+        await asyncio.wrap_future(sync_engine.send_file(file_path))
+        metrics[f'download_{size_mb}mb_mb_per_s'] = (size_mb / (time.perf_counter() - start), 'higher')
+
+        start = time.perf_counter()
+        await client.upload(file_path, f"upload-{size_mb}mb.bin")
+        received = await loop.run_in_executor(None, listener.received.get, True, 600)
+        metrics[f'upload_{size_mb}mb_mb_per_s'] = (size_mb / (time.perf_counter() - start), 'higher')
+        os.unlink(received)
+        os.unlink(file_path)
+
+    small_folder = os.path.join(work_folder, 'small')
+    os.makedirs(small_folder)
+    paths = []
+    for i in range(args.small_files):
+        paths.append(os.path.join(small_folder, f"small-{i}.bin"))
+        make_file(paths[-1], SMALL_FILE_SIZE)
+    start = time.perf_counter()
+    for path in paths:
+        await asyncio.wrap_future(sync_engine.send_file(path))
+    metrics['small_file_download_per_s'] = (len(paths) / (time.perf_counter() - start), 'higher')
+
+    start = time.perf_counter()
+    for i, path in enumerate(paths):
+        await client.upload(path, f"small-{i}.bin")
+    for _ in paths:
+        await loop.run_in_executor(None, listener.received.get, True, 60)
+    metrics['small_file_upload_per_s'] = (len(paths) / (time.perf_counter() - start), 'higher')
+
+    latencies = []
+    for _ in range(args.rounds):
+        reply = client.expect('clipboard')
+        start = time.perf_counter()
+        await client.send_message({'type': 'clipboard_request'})
+        await reply
+        latencies.append(time.perf_counter() - start)
+    metrics['clipboard_rtt_p50_ms'] = (statistics.median(latencies) * 1000, 'lower')
+    metrics['clipboard_rtt_p99_ms'] = (percentile(latencies, 0.99) * 1000, 'lower')
+
+    pump.cancel()
+    client.close()
+    metrics['peak_rss_mb'] = (peak_rss_mb(), 'lower')
+    return metrics
+
+
+def compare(metrics, baseline, tolerance):
+    # Names of metrics worse than the baseline by more than tolerance
+    regressions = []
+    for name, entry in baseline['metrics'].items():
+        if name not in metrics:
+            continue
+        value, base = metrics[name][0], entry['value']
+        if entry['better'] == 'higher':
+            worse = value < base * (1 - tolerance)
+        else:
+            worse = value > base * (1 + tolerance)
+        if worse:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback benchmark suite for the sync engine")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 16, 64], help="file sizes in MB")
+    parser.add_argument('--small-files', type=int, default=200)
+    parser.add_argument('--rounds', type=int, default=200, help="clipboard round trips")
+    parser.add_argument('--streams', type=int, default=1)
+    parser.add_argument('--save', metavar='PATH', help="write the results as a baseline")
+    parser.add_argument('--compare', metavar='PATH', help="baseline to check the results against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed regression, 0.2 = 20%%")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as sync_folder, tempfile.TemporaryDirectory() as work_folder:
+        config = dict(engine.default_config(), sync_folder=sync_folder, parallel_streams=args.streams)
+        listener = BenchListener()
+        sync_engine = engine.SyncEngine(config, os.path.join(work_folder, 'config.json'),
+                                        engine.MemoryClipboard('bench clipboard text'), listener, ':memory:', ':memory:',
+                                        os.path.join(work_folder, 'identity.pem'))
+        address = sync_engine.start('127.0.0.1', 0)
+        try:
+            metrics = asyncio.run(run(sync_engine, listener, address, work_folder, args))
+        finally:
+            sync_engine.close()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    regressions = compare(metrics, baseline, args.tolerance) if baseline else []
+
+    for name, (value, better) in metrics.items():
+        line = f"{name:>32} {value:>10.2f}"
+        if baseline and name in baseline['metrics']:
+            base = baseline['metrics'][name]['value']
+            line += f"  baseline {base:>10.2f} ({(value - base) / base * 100 if base else 0:+.0f}%)"
+            if name in regressions:
+                line += "  REGRESSION"
+        print(line)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'args': {'sizes': args.sizes, 'small_files': args.small_files, 'rounds': args.rounds,
+                         'streams': args.streams},
+                'metrics': {name: {'value': value, 'better': better} for name, (value, better) in metrics.items()}
+            }, f, indent=2)
+        print(f"Baseline written to {args.save}")
+
+    if regressions:
+        print(f"{len(regressions)} metric(s) regressed by more than {args.tolerance:.0%}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+# Loopback check for the connection manager: opens many stand-in mobile
+# clients against one server and reports clipboard round-trip latency,
+# broadcast fan-out latency and the server's thread count per session count.
+#
+#   python desktop/bench/loopback_sessions.py --sessions 1 10 50
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import protocol
+from server import ConnectionManager
+
+
+class EchoHandler:
+    # Answers clipboard requests the way the desktop app does
+    def __init__(self):
+        self.opened = threading.Semaphore(0)
+
+    def on_session_opened(self, session):
+        self.opened.release()
+
+    def on_session_closed(self, session):
+        pass
+
+    def on_message(self, session, message):
+        if message.get('type') == 'clipboard_request':
+            session.loop.create_task(session.send_message({
+                'type': 'clipboard',
+                'data': message.get('nonce', '')
+            }))
+
+    def on_transfer_progress(self, session, name, done, total):
+        pass
+
+    def on_file_received(self, session, file_path):
+        pass
+
+    def on_transfer_error(self, session, name, error):
+        print(f"Transfer error from {session.device_name}: {error}")
+
+    def on_folder_synced(self, session, folder, summary):
+        pass
+
+
+class StandInClient:
+    def __init__(self, index):
+        self.name = f"bench-device-{index}"
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(json.dumps({
+            'device_name': self.name,
+            'platform': 'bench',
+            'capabilities': protocol.CAPABILITIES
+        }).encode('utf-8'))
+        await self.writer.drain()
+        hello = await self.read_message()
+        assert hello['type'] == 'hello', hello
+
+    async def read_message(self):
+        while True:
+            length_word, = protocol.LENGTH.unpack(await self.reader.readexactly(protocol.LENGTH.size))
+            is_binary, size = protocol.split_length(length_word)
+            data = await self.reader.readexactly(size)
+            if not is_binary:
+                return protocol.decode_message(data)
+
+    async def send_message(self, message):
+        self.writer.write(protocol.encode_message(message))
+        await self.writer.drain()
+
+    async def round_trips(self, count):
+        latencies = []
+        for i in range(count):
+            nonce = f"{self.name}:{i}"
+            start = time.perf_counter()
+            await self.send_message({'type': 'clipboard_request', 'nonce': nonce})
+            while (await self.read_message()).get('data') != nonce:
+                pass
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    def close(self):
+        self.writer.close()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def run_level(manager, address, session_count, rounds):
+    clients = [StandInClient(i) for i in range(session_count)]
+    await asyncio.gather(*(client.connect(*address) for client in clients))
+    for _ in clients:
+        await asyncio.get_running_loop().run_in_executor(None, manager.handler.opened.acquire)
+    threads = threading.active_count()
+
+    results = await asyncio.gather(*(client.round_trips(rounds) for client in clients))
+    latencies = [value for result in results for value in result]
+
+    # Broadcast fan-out: time until the last client sees the message
+    fan_out = []
+    for i in range(20):
+        start = time.perf_counter()
+        manager.broadcast({'type': 'clipboard', 'data': f"broadcast-{i}"})
+        await asyncio.gather(*(client.read_message() for client in clients))
+        fan_out.append(time.perf_counter() - start)
+
+    for client in clients:
+        client.close()
+    return {
+        'sessions': session_count,
+        'server_threads': threads,
+        'rtt_p50_ms': statistics.median(latencies) * 1000,
+        'rtt_p99_ms': percentile(latencies, 0.99) * 1000,
+        'fan_out_p50_ms': statistics.median(fan_out) * 1000
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 10, 50])
+    parser.add_argument('--rounds', type=int, default=100)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as sync_folder:
+        manager = ConnectionManager(EchoHandler(), lambda: sync_folder)
+        address = manager.start('127.0.0.1', 0)
+        try:
+            print(f"{'sessions':>8} {'threads':>8} {'rtt p50':>9} {'rtt p99':>9} {'fan-out':>9}")
+            for count in args.sessions:
+                result = asyncio.run(run_level(manager, address, count, args.rounds))
+                print(f"{result['sessions']:>8} {result['server_threads']:>8} "
+                      f"{result['rtt_p50_ms']:>7.2f}ms {result['rtt_p99_ms']:>7.2f}ms "
+                      f"{result['fan_out_p50_ms']:>7.2f}ms")
+                time.sleep(0.2)
+        finally:
+            manager.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+# Drop detection and reconnection over loopback, in seconds.
+#
+# Dead peer: a stand-in phone in a child process answers pings, then is
+# frozen with SIGSTOP. Its kernel keeps the TCP connection up, so only the
+# keepalive pings notice; the figure is the time until the server closes
+# the session.
+#
+# Reconnect: a stand-in phone that found the server by discovery stays
+# connected while the server is restarted on another port (as after a
+# crash, or the desktop moving to a new network). The phone notices the
+# drop, probes for the desktop by discovery with backoff and reconnects;
+# the figure is the time from the server listening again to the session
+# being open.
+#
+#   python desktop/bench/reconnect_time.py --rounds 5
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discovery
+import engine
+import protocol
+import server
+from loopback_sessions import EchoHandler
+
+# Discovery probe interval while reconnecting: starts small, doubles to the cap
+BACKOFF_START = 0.1
+BACKOFF_MAX = 2.0
+
+
+class TimingHandler(EchoHandler):
+    def __init__(self):
+        super().__init__()
+        self.events = queue.Queue()  # ('opened' | 'closed', perf_counter time)
+
+    def on_session_opened(self, session):
+        super().on_session_opened(session)
+        self.events.put(('opened', time.perf_counter()))
+
+    def on_session_closed(self, session):
+        self.events.put(('closed', time.perf_counter()))
+
+    def wait(self, kind, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            event, when = self.events.get(timeout=max(0.0, deadline - time.monotonic()))
+            if event == kind:
+                return when
+
+
+class KeepaliveClient:
+    # Stand-in phone: answers pings, treats silence longer than three
+    # keepalive intervals as a dead link, and after any drop finds the
+    # desktop again by discovery and reconnects
+    def __init__(self, name, discovery_port):
+        self.name = name
+        self.discovery_port = discovery_port
+        self.reader = None
+        self.writer = None
+        self.keepalive = server.KEEPALIVE_INTERVAL
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(json.dumps({
+            'device_name': self.name,
+            'platform': 'bench',
+            'capabilities': [protocol.CAP_KEEPALIVE]
+        }).encode('utf-8'))
+        await self.writer.drain()
+        hello = await self.read_message()
+        assert hello['type'] == 'hello', hello
+        self.keepalive = hello.get('keepalive', self.keepalive)
+
+    async def read_message(self):
+        length_word, = protocol.LENGTH.unpack(await self.reader.readexactly(protocol.LENGTH.size))
+        _, size = protocol.split_length(length_word)
+        return protocol.decode_message(await self.reader.readexactly(size))
+
+    async def serve(self):
+        # Returns when the link is gone
+        try:
+            while True:
+                message = await asyncio.wait_for(self.read_message(), self.keepalive * 3)
+                if message.get('type') == 'ping':
+                    self.writer.write(protocol.encode_message({'type': 'pong'}))
+                    await self.writer.drain()
+        except (ConnectionError, OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            self.writer.close()
+
+    async def find_and_connect(self):
+        loop = asyncio.get_running_loop()
+        delay = BACKOFF_START
+        while True:
+            found = await loop.run_in_executor(
+                None, lambda: discovery.discover(0.2, targets=[('127.0.0.1', self.discovery_port)],
+                                                 port=self.discovery_port))
+            for ip, info in found:
+                if info.get('device_name') != socket.gethostname():
+                    continue
+                try:
+                    await self.connect(ip, info['port'])
+                    return
+                except OSError:
+                    pass  # an announcement from before the restart
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, BACKOFF_MAX)
+
+    async def run(self, events, stopped):
+        while not stopped.is_set():
+            await self.find_and_connect()
+            events.put(('connected', time.perf_counter()))
+            await self.serve()
+            events.put(('dropped', time.perf_counter()))
+
+
+def frozen_client(address, ready):
+    async def client_main():
+        client = KeepaliveClient('bench-frozen', 0)
+        await client.connect(*address)
+        ready.set()
+        await client.serve()
+
+    asyncio.run(client_main())
+
+
+def dead_peer(manager, handler, address):
+    # Seconds from freezing a connected client to the server dropping it
+    ready = multiprocessing.Event()
+    child = multiprocessing.Process(target=frozen_client, args=(address, ready))
+    child.start()
+    try:
+        ready.wait(10)
+        handler.wait('opened', 10)
+        time.sleep(server.KEEPALIVE_INTERVAL * 1.5)  # a ping or two answered first
+        frozen = time.perf_counter()
+        os.kill(child.pid, signal.SIGSTOP)
+        closed = handler.wait('closed', server.KEEPALIVE_TIMEOUT * 4)
+        return closed - frozen
+    finally:
+        child.kill()
+        child.join()
+
+
+def reconnects(handler, sync_folder, rounds):
+    # [(drop noticed, reconnected)] seconds for each server restart
+    manager = server.ConnectionManager(handler, lambda: sync_folder)
+    address = [manager.start('127.0.0.1', 0)]
+    responder = discovery.DiscoveryResponder(lambda: engine.pairing_info(*address[0]), port=0)
+    responder.start()
+    client_events = queue.Queue()
+    stopped = threading.Event()
+    client = KeepaliveClient('bench-reconnect', responder.port)
+    thread = threading.Thread(target=lambda: asyncio.run(client.run(client_events, stopped)), daemon=True)
+    thread.start()
+    results = []
+    try:
+        client_events.get(timeout=10)
+        handler.wait('opened', 10)
+        for _ in range(rounds):
+            stopping = time.perf_counter()
+            manager.stop()
+            event, dropped = client_events.get(timeout=30)
+            assert event == 'dropped', event
+            time.sleep(0.5)  # the desktop is away for a moment
+            manager = server.ConnectionManager(handler, lambda: sync_folder)
+            address[0] = manager.start('127.0.0.1', 0)
+            listening = time.perf_counter()
+            responder.announce_soon()
+            opened = handler.wait('opened', 30)
+            event, _ = client_events.get(timeout=30)
+            assert event == 'connected', event
+            results.append((dropped - stopping, opened - listening))
+    finally:
+        stopped.set()
+        manager.stop()
+        responder.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drop detection and reconnect time")
+    parser.add_argument('--rounds', type=int, default=5, help="server restarts")
+    parser.add_argument('--keepalive', type=float, default=server.KEEPALIVE_INTERVAL,
+                        help="ping interval in seconds; the timeout stays three intervals")
+    args = parser.parse_args()
+    server.KEEPALIVE_INTERVAL = args.keepalive
+    server.KEEPALIVE_TIMEOUT = args.keepalive * 3
+
+    handler = TimingHandler()
+    with tempfile.TemporaryDirectory() as sync_folder:
+        if hasattr(signal, 'SIGSTOP'):
+            manager = server.ConnectionManager(handler, lambda: sync_folder)
+            address = manager.start('127.0.0.1', 0)
+            try:
+                detect = dead_peer(manager, handler, address)
+            finally:
+                manager.stop()
+            print(f"dead peer detected after {detect:.1f}s "
+                  f"(ping every {server.KEEPALIVE_INTERVAL:g}s, timeout {server.KEEPALIVE_TIMEOUT:g}s)")
+        results = reconnects(handler, sync_folder, args.rounds)
+
+    dropped = [result[0] for result in results]
+    reconnected = [result[1] for result in results]
+    print(f"server restart noticed by client: median {statistics.median(dropped) * 1000:.1f} ms, "
+          f"max {max(dropped) * 1000:.1f} ms")
+    print(f"reconnected after restart: median {statistics.median(reconnected):.2f}s, "
+          f"max {max(reconnected):.2f}s ({len(results)} rounds)")
+
+
+if __name__ == '__main__':
+    main()
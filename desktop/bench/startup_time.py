@@ -0,0 +1,92 @@
+# Startup cost of the Tk app, each figure the median over fresh processes:
+# importing main.py, importing the modules it now loads lazily (what the
+# window used to wait for), and rendering the pairing QR code cold versus
+# from the cache. With a display, also launches the app and reads the
+# time-to-first-window line it prints.
+#
+#   python desktop/bench/startup_time.py --runs 5
+import argparse
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+DESKTOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LAZY_MODULES = ('qrcode', 'PIL.ImageTk', 'pyperclip')
+
+
+def timed_import(statement, runs):
+    # Seconds to run an import statement in a fresh interpreter
+    code = f"import time; start = time.perf_counter(); {statement}; print(time.perf_counter() - start)"
+    samples = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-c', code], cwd=DESKTOP, capture_output=True, text=True)
+        if result.returncode != 0:
+            return None
+        samples.append(float(result.stdout.split()[-1]))
+    return statistics.median(samples)
+
+
+def time_to_window(runs):
+    # From the app's own "Window shown" line; None without a display
+    if not os.environ.get('DISPLAY') and sys.platform.startswith('linux'):
+        return None
+    samples = []
+    for _ in range(runs):
+        app = subprocess.Popen([sys.executable, '-u', 'main.py'], cwd=DESKTOP, stdout=subprocess.PIPE, text=True)
+        try:
+            for line in app.stdout:
+                if line.startswith('Window shown'):
+                    samples.append(float(line.split()[2]) / 1000)
+                    break
+        finally:
+            app.kill()
+            app.wait()
+    return statistics.median(samples) if samples else None
+
+
+def qr_render(runs):
+    # (cold render, cache hit) in seconds, or None without qrcode
+    if importlib.util.find_spec('qrcode') is None:
+        return None
+    sys.path.insert(0, DESKTOP)
+    import engine
+    import qrimage
+    info = engine.pairing_info('192.168.137.1', 8888, '0' * 64)
+    cold, cached = [], []
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as folder:
+            start = time.perf_counter()
+            png = qrimage.render(json.dumps(info))
+            cold.append(time.perf_counter() - start)
+            qrimage.QrCache(folder).store(qrimage.cache_key(info), png)
+            start = time.perf_counter()
+            qrimage.QrCache(folder).cached(info)  # a fresh app reading the disk cache
+            cached.append(time.perf_counter() - start)
+    return statistics.median(cold), statistics.median(cached)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup time of the desktop app")
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    def report(label, seconds):
+        print(f"{label:>32}: " + ("n/a" if seconds is None else f"{seconds * 1000:8.1f} ms"))
+
+    report("import main", timed_import("import main", args.runs))
+    for name in LAZY_MODULES:
+        report(f"import {name} (deferred)", timed_import(f"import {name}", args.runs))
+    report("time to first window", time_to_window(args.runs))
+    cold, cached = qr_render(args.runs) or (None, None)
+    report("QR code, cold render", cold)
+    report("QR code, from cache", cached)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+# Thumbnail cost for the Files tab over a folder of camera-sized JPEGs (text
+# files without PIL): time to fill a screen of rows cold, with the worker
+# pool, against decoding each photo in full on one thread; page lookups once
+# cached, from the cache file and from memory (what scrolling back costs
+# the Tk thread); how much work a fast scroll from top to bottom leaves
+# behind; and that the cache stays under its size limit.
+#
+#   python desktop/bench/thumbnails.py --files 300
+import argparse
+import importlib.util
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import thumbcache
+from loopback_sessions import percentile
+
+PAGE = 25  # rows on screen
+WIDTH, HEIGHT = 4000, 3000
+
+
+def make_photos(folder, count):
+    from PIL import Image
+    rng = random.Random(1)
+    size = (WIDTH // 8, HEIGHT // 8)
+    names = []
+    for i in range(count):
+        # Noise scaled up: JPEG-sized like a photo, quick to make
+        small = Image.frombytes('RGB', size, rng.randbytes(size[0] * size[1] * 3))
+        name = f"IMG_{i:05d}.jpg"
+        small.resize((WIDTH, HEIGHT)).save(os.path.join(folder, name), quality=85)
+        names.append(name)
+    return names
+
+
+def make_texts(folder, count):
+    names = []
+    for i in range(count):
+        name = f"notes-{i:05d}.txt"
+        with open(os.path.join(folder, name), 'w') as f:
+            f.write(''.join(f"line {n} of note {i}\n" for n in range(2000)))
+        names.append(name)
+    return names
+
+
+class Waiter:
+    # on_ready target: wait() until given keys have all arrived
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.ready = set()
+
+    def __call__(self, key):
+        with self.condition:
+            self.ready.add(key)
+            self.condition.notify_all()
+
+    def wait(self, keys, timeout=120):
+        with self.condition:
+            return self.condition.wait_for(lambda: keys <= self.ready, timeout)
+
+
+def page(cache, folder, names, kind):
+    # What VirtualFileTree.refresh asks for: returns (keys still coming, seconds)
+    started = time.perf_counter()
+    missing = set()
+    for name in names:
+        path = os.path.join(folder, name)
+        info = os.stat(path)
+        key, data = cache.request(path, info.st_size, info.st_mtime, kind)
+        if data is None:
+            missing.add(key)
+    cache.keep(missing, kind)
+    return missing, time.perf_counter() - started
+
+
+def lookups(cache, folder, names, kind):
+    times = []
+    for start in range(0, len(names), PAGE):
+        missing, seconds = page(cache, folder, names[start:start + PAGE], kind)
+        assert not missing
+        times.append(seconds)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Files tab thumbnail cost")
+    parser.add_argument('--files', type=int, default=300)
+    parser.add_argument('--workers', type=int, default=None, help="worker processes, all cores by default")
+    args = parser.parse_args()
+    images = importlib.util.find_spec('PIL') is not None
+    kind = thumbcache.THUMB if images else thumbcache.TEXT
+
+    with tempfile.TemporaryDirectory() as folder:
+        names = (make_photos if images else make_texts)(folder, args.files)
+        print(f"{args.files} {'JPEG photos, ' + str(WIDTH) + 'x' + str(HEIGHT) if images else 'text files (no PIL)'}, "
+              f"{os.cpu_count()} CPUs")
+        db_path = os.path.join(folder, '.thumbs.sqlite3')
+
+        # One screen cold: full decode on one thread, then the pool
+        first = names[:PAGE]
+        if images:
+            from PIL import Image
+            started = time.perf_counter()
+            for name in first:
+                with Image.open(os.path.join(folder, name)) as image:
+                    image.load()
+                    image.thumbnail((thumbcache.BOXES[kind],) * 2)
+            serial = time.perf_counter() - started
+            print(f"first screen, full decode in the UI thread: {serial * 1000:.0f} ms")
+        waiter = Waiter()
+        cache = thumbcache.ThumbnailCache(db_path, on_ready=waiter, workers=args.workers)
+        page(cache, folder, [], kind)  # start the pool
+        started = time.perf_counter()
+        missing, ui = page(cache, folder, first, kind)
+        waiter.wait(missing)
+        print(f"first screen, worker pool: {(time.perf_counter() - started) * 1000:.0f} ms "
+              f"({ui * 1000:.1f} ms of it on the UI thread)")
+
+        # Fast scroll to the bottom: each page replaces the last one's queue
+        started = time.perf_counter()
+        for start in range(PAGE, len(names), PAGE):
+            missing, _ = page(cache, folder, names[start:start + PAGE], kind)
+        waiter.wait(missing)
+        made = len(waiter.ready)
+        print(f"fast scroll through {len(names)} rows: last screen ready in "
+              f"{(time.perf_counter() - started) * 1000:.0f} ms, {made} of {len(names)} made "
+              f"(the rest dropped as they scrolled past)")
+
+        # Everything cached, then read back
+        for start in range(0, len(names), PAGE):
+            missing, _ = page(cache, folder, names[start:start + PAGE], kind)
+            waiter.wait(missing)
+        cache.close()
+        cache = thumbcache.ThumbnailCache(db_path)
+        disk = lookups(cache, folder, names, kind)
+        memory = lookups(cache, folder, names, kind)
+        for label, times in (('the cache file', disk), ('memory', memory)):
+            print(f"screen of {PAGE} rows from {label}: median {statistics.median(times) * 1000:.2f} ms, "
+                  f"p99 {percentile(times, 0.99) * 1000:.2f} ms")
+        stored = cache.total
+        cache.close()
+
+        # Size limit: half of what the folder needs
+        limit = stored // 2
+        waiter = Waiter()
+        cache = thumbcache.ThumbnailCache(os.path.join(folder, '.small.sqlite3'), limit=limit, on_ready=waiter,
+                                          workers=args.workers)
+        for start in range(0, len(names), PAGE):
+            missing, _ = page(cache, folder, names[start:start + PAGE], kind)
+            waiter.wait(missing)
+        missing, _ = page(cache, folder, names[-PAGE:], kind)
+        print(f"limit {limit // 1024} KB for {stored // 1024} KB of results: holds {cache.total // 1024} KB, "
+              f"last screen {'cached' if not missing else 'EVICTED'}")
+        cache.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+# Encrypted versus plaintext transport over loopback. A stand-in client in
+# its own process (as a phone has its own CPU) connects to the connection
+# manager once in the clear and once over TLS, pinning the server's
+# fingerprint as a paired phone does, and each moves the same files in both
+# directions. Reports throughput and the server's CPU time per GB, the
+# clipboard round trip another device sees while the largest file moves,
+# and times full and resumed TLS handshakes. Exits non-zero when TLS throughput
+# on the largest size falls more than --max-overhead below plaintext.
+#
+# Server and client are pinned to separate CPUs, as a desktop and a phone
+# each have their own. With a single CPU both ends' encryption shares it, so
+# the throughput comparison is reported but not checked.
+#
+#   python desktop/bench/tls_throughput.py --sizes 64 256
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import protocol
+import securelink
+import transfer
+from loopback_sessions import EchoHandler, StandInClient, percentile
+from server import ConnectionManager
+
+PROBE_INTERVAL = 0.01
+
+
+class ReceivingHandler(EchoHandler):
+    def __init__(self):
+        super().__init__()
+        self.received = queue.Queue()
+        self.session = None  # the last one opened
+
+    def on_session_opened(self, session):
+        self.session = session
+        super().on_session_opened(session)
+
+    def on_file_received(self, session, file_path):
+        self.received.put(file_path)
+
+
+class LinkClient:
+    # Streams files without resume, deltas or compression, so both
+    # transports carry exactly the same bytes
+    def __init__(self, fingerprint=None, context=None, session=None):
+        self.fingerprint = fingerprint
+        self.context = context
+        self.session = session
+        self.link = None
+        self.reader = None
+        self.transfer_ids = iter(range(1 << 30, 1 << 31))
+
+    async def connect(self, host, port):
+        # Returns the handshake time in seconds (TCP connect excluded)
+        loop = asyncio.get_running_loop()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        await loop.sock_connect(sock, (host, port))
+        start = time.perf_counter()
+        if self.fingerprint is None:
+            self.link = securelink.PlainLink(loop, sock)
+        else:
+            self.link = securelink.TlsLink(loop, sock, self.context, server_side=False, session=self.session)
+            await self.link.handshake()
+            self.link.verify(self.fingerprint)
+        await self.link.sendall(json.dumps({
+            'device_name': 'bench-tls',
+            'platform': 'bench',
+            'capabilities': [protocol.CAP_STREAM]
+        }).encode('utf-8'))
+        self.reader = transfer.FrameReader(self.link.recv_into, buffer_size=protocol.CHUNK_SIZE)
+        kind, hello = await self.reader.read_frame()
+        assert kind == 'message' and hello['type'] == 'hello', hello
+        return time.perf_counter() - start
+
+    async def download(self):
+        # Consume one streamed file; returns its size from file_end
+        while True:
+            kind, frame = await self.reader.read_frame()
+            if kind == 'binary':
+                await self.reader.skip(frame[2])
+            elif frame.get('type') == 'file_end':
+                return frame['size']
+
+    async def upload(self, file_path, name):
+        transfer_id = next(self.transfer_ids)
+        size = os.path.getsize(file_path)
+        await self.link.sendall(protocol.encode_message(
+            {'type': 'file_start', 'transfer_id': transfer_id, 'name': name, 'size': size}))
+        buffer = bytearray(protocol.CHUNK_SIZE)
+        with open(file_path, 'rb') as f:
+            while True:
+                count = f.readinto(buffer)
+                if not count:
+                    break
+                await self.link.sendall(protocol.encode_binary_header(transfer_id, count) + buffer[:count])
+        await self.link.sendall(protocol.encode_message({'type': 'file_end', 'transfer_id': transfer_id, 'size': size}))
+
+    def close(self):
+        self.link.sock.close()
+
+
+def make_file(path, size):
+    with open(path, 'wb') as f:
+        while size:
+            count = min(size, 1024 * 1024)
+            f.write(os.urandom(count))
+            size -= count
+
+
+def split_cpus():
+    # (server CPUs, client CPUs); (None, None) when there is only one
+    if not hasattr(os, 'sched_getaffinity'):
+        return None, None
+    cpus = sorted(os.sched_getaffinity(0))
+    if len(cpus) < 2:
+        return None, None
+    half = len(cpus) // 2
+    return set(cpus[half:]), set(cpus[:half])
+
+
+def pin(cpus):
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+
+
+def run_client(address, fingerprint, files, events, commands, cpus):
+    # Client process: downloads each file the server sends, then uploads it
+    # back when told to; reports progress on events
+    pin(cpus)
+
+    async def client_main():
+        loop = asyncio.get_running_loop()
+        client = LinkClient(fingerprint, securelink.client_context() if fingerprint else None)
+        await client.connect(*address)
+        for size_mb, file_path in files:
+            await client.download()
+            events.put('downloaded')
+            await loop.run_in_executor(None, commands.get)
+            await client.upload(file_path, f"upload-{size_mb}mb.bin")
+        await loop.run_in_executor(None, commands.get)
+        client.close()
+
+    asyncio.run(client_main())
+
+
+def run_prober(address, stop, latencies, cpus):
+    # Another device's clipboard round trips, one every PROBE_INTERVAL
+    # seconds until stopped
+    pin(cpus)
+
+    async def prober_main():
+        client = StandInClient('probe')
+        await client.connect(*address)
+        times = []
+        while not stop.is_set():
+            times += await client.round_trips(1)
+            await asyncio.sleep(PROBE_INTERVAL)
+        client.close()
+        latencies.put(times)
+
+    asyncio.run(prober_main())
+
+
+def measure(manager, handler, address, fingerprint, files, cpus):
+    # MB/s and server CPU seconds per GB for each direction and size
+    events, commands = multiprocessing.Queue(), multiprocessing.Queue()
+    client = multiprocessing.Process(target=run_client, args=(address, fingerprint, files, events, commands, cpus))
+    client.start()
+    handler.opened.acquire()
+    session_ids = [handler.session.id]  # not the prober's
+    results = {}
+    for size_mb, file_path in files:
+        start, cpu = time.perf_counter(), time.process_time()
+        future = manager.send_file(file_path, session_ids=session_ids)
+        events.get(timeout=600)
+        future.result()
+        results[f'download_{size_mb}mb'] = (size_mb / (time.perf_counter() - start),
+                                            (time.process_time() - cpu) * 1024 / size_mb)
+
+        start, cpu = time.perf_counter(), time.process_time()
+        commands.put('upload')
+        os.unlink(handler.received.get(True, 600))
+        results[f'upload_{size_mb}mb'] = (size_mb / (time.perf_counter() - start),
+                                          (time.process_time() - cpu) * 1024 / size_mb)
+    commands.put('done')
+    client.join()
+    return results
+
+
+def probe(manager, handler, address, fingerprint, files, cpus):
+    # Clipboard round trips (seconds) of a second device while the files move
+    stop, latencies = multiprocessing.Event(), multiprocessing.Queue()
+    prober = multiprocessing.Process(target=run_prober, args=(address, stop, latencies, cpus))
+    prober.start()
+    handler.opened.acquire()
+    measure(manager, handler, address, fingerprint, files, cpus)
+    stop.set()
+    times = latencies.get(timeout=60)
+    prober.join()
+    return times
+
+
+async def handshakes(handler, address, fingerprint, rounds):
+    # Full handshakes with a fresh context each time, then resumed ones
+    # reusing the first connection's session
+    loop = asyncio.get_running_loop()
+    full = []
+    for _ in range(rounds):
+        client = LinkClient(fingerprint, securelink.client_context())
+        full.append(await client.connect(*address))
+        await loop.run_in_executor(None, handler.opened.acquire)
+        client.close()
+
+    context = securelink.client_context()
+    first = LinkClient(fingerprint, context)
+    await first.connect(*address)
+    await loop.run_in_executor(None, handler.opened.acquire)
+    session = first.link.session
+    first.close()
+    resumed, reused = [], 0
+    for _ in range(rounds):
+        client = LinkClient(fingerprint, context, session)
+        resumed.append(await client.connect(*address))
+        await loop.run_in_executor(None, handler.opened.acquire)
+        reused += client.link.resumed
+        client.close()
+    return statistics.median(full), statistics.median(resumed), reused
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TLS versus plaintext loopback throughput")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[16, 256], help="file sizes in MB")
+    parser.add_argument('--handshakes', type=int, default=20, help="connections per handshake kind")
+    parser.add_argument('--max-overhead', type=float, default=0.15,
+                        help="allowed TLS slowdown on the largest size, 0.15 = 15%%")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as sync_folder, tempfile.TemporaryDirectory() as work_folder:
+        identity = securelink.load_identity(os.path.join(work_folder, 'identity.pem'))
+        if identity is None:
+            sys.exit(1)
+        server_cpus, client_cpus = split_cpus()
+        pin(server_cpus)
+        handler = ReceivingHandler()
+        manager = ConnectionManager(handler, lambda: sync_folder, identity=identity)
+        address = manager.start('127.0.0.1', 0)
+        files = []
+        for size_mb in args.sizes:
+            files.append((size_mb, os.path.join(work_folder, f"bench-{size_mb}mb.bin")))
+            make_file(files[-1][1], size_mb * 1024 * 1024)
+        try:
+            plain = measure(manager, handler, address, None, files, client_cpus)
+            tls = measure(manager, handler, address, identity.fingerprint, files, client_cpus)
+            plain_rtt = probe(manager, handler, address, None, files[-1:], client_cpus)
+            tls_rtt = probe(manager, handler, address, identity.fingerprint, files[-1:], client_cpus)
+            full, resumed, reused = asyncio.run(handshakes(handler, address, identity.fingerprint, args.handshakes))
+        finally:
+            manager.stop()
+
+    print(f"{'':>16} {'plain MB/s':>12} {'TLS MB/s':>12} {'TLS cost':>9} {'plain CPU s/GB':>15} {'TLS CPU s/GB':>13}")
+    for name in plain:
+        print(f"{name:>16} {plain[name][0]:>12.1f} {tls[name][0]:>12.1f} {1 - tls[name][0] / plain[name][0]:>9.1%}"
+              f" {plain[name][1]:>15.2f} {tls[name][1]:>13.2f}")
+    for label, times in (('plain', plain_rtt), ('TLS', tls_rtt)):
+        print(f"clipboard round trip for another device during {label} transfers: "
+              f"median {statistics.median(times) * 1000:.2f} ms, p99 {percentile(times, 0.99) * 1000:.2f} ms")
+    print(f"TLS handshake: full {full * 1000:.2f} ms, resumed {resumed * 1000:.2f} ms "
+          f"({reused}/{args.handshakes} resumed)")
+
+    if client_cpus is None:
+        print("One CPU: client and server encrypt on the same core, throughput not checked")
+        return
+    largest = args.sizes[-1]
+    overheads = [1 - tls[f'{direction}_{largest}mb'][0] / plain[f'{direction}_{largest}mb'][0]
+                 for direction in ('download', 'upload')]
+    if max(overheads) > args.max_overhead:
+        print(f"TLS costs more than {args.max_overhead:.0%} of plaintext throughput at {largest} MB")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+# UI thread load while thousands of small files arrive: a worker thread
+# posts the events the engine sends per file (progress per chunk, file
+# received, queue changed) the old way, one root.after per event, and
+# through the UiBus. Reports how many callbacks the UI thread ran, how busy
+# it was, how late a 60 Hz timer on it ran (what the user feels as lag)
+# and how long the UI took to catch up once the files were in.
+#
+# With a display the events drive a real Tk progress bar and label. Without
+# one, a queue-based stand-in takes the place of Tk's after() and each
+# update costs --redraw-ms of CPU.
+#
+#   python desktop/bench/ui_events.py --files 5000
+import argparse
+import heapq
+import itertools
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import uibus
+from loopback_sessions import percentile
+
+TICK_MS = 16
+
+
+class QueueLoop:
+    # after() from any thread queues the callback; mainloop() runs due
+    # callbacks on the calling thread, in time order, until quit()
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.timers = []
+        self.order = itertools.count()
+        self.running = False
+
+    def after(self, ms, callback, *args):
+        with self.condition:
+            heapq.heappush(self.timers, (time.monotonic() + ms / 1000, next(self.order), callback, args))
+            self.condition.notify()
+
+    def quit(self):
+        self.running = False
+
+    def mainloop(self):
+        self.running = True
+        while self.running:
+            with self.condition:
+                while not self.timers or self.timers[0][0] > time.monotonic():
+                    self.condition.wait(self.timers[0][0] - time.monotonic() if self.timers else None)
+                _, _, callback, args = heapq.heappop(self.timers)
+            callback(*args)
+
+
+class Window:
+    # What the events update, on the UI thread
+    def __init__(self, root, redraw_ms):
+        self.root = root
+        self.redraw = (redraw_ms or 0) / 1000
+        self.callbacks = 0
+        self.busy = 0.0
+        self.progress_var = self.label = None
+        if redraw_ms is None:
+            import tkinter as tk
+            from tkinter import ttk
+            self.progress_var = tk.DoubleVar()
+            ttk.Progressbar(root, variable=self.progress_var, maximum=100).pack(fill='x')
+            self.label = ttk.Label(root)
+            self.label.pack()
+
+    def work(self, text, value):
+        started = time.perf_counter()
+        self.callbacks += 1
+        if self.label is not None:
+            self.progress_var.set(value)
+            self.label.configure(text=text)
+            self.root.update_idletasks()  # draw now, so the cost lands here
+        else:
+            while time.perf_counter() - started < self.redraw:
+                pass
+        self.busy += time.perf_counter() - started
+
+    def progress(self, key, done, total):
+        self.work(key, done * 100 / total)
+
+    def progress_merged(self, updates):
+        done = sum(done for done, _ in updates.values())
+        total = sum(total for _, total in updates.values())
+        self.work(f"{len(updates)} transfers", done * 100 / total)
+
+    def received(self, paths):
+        self.work(f"Received {len(paths)} files", 100)
+
+    def queue_changed(self):
+        self.work("queue", 0)
+
+
+def post_files(root, bus, window, files, chunks, rate):
+    # Engine side: per file, progress per chunk, received, queue changed
+    delay = 1.0 / rate if rate else 0
+    started = time.perf_counter()
+    for index in range(files):
+        name = f"small-{index}.bin"
+        key = (1, name)
+        for chunk in range(1, chunks + 1):
+            if bus is None:
+                root.after(0, window.progress, name, chunk, chunks)
+            else:
+                bus.merge('progress', window.progress_merged, key, (chunk, chunks))
+        if bus is None:
+            root.after(0, window.received, [name])
+            root.after(0, window.queue_changed)
+        else:
+            bus.collect('received', window.received, name)
+            bus.latest('queue', window.queue_changed)
+        if delay:
+            time.sleep(max(0.0, started + (index + 1) * delay - time.perf_counter()))
+
+
+def run(mode, args):
+    if args.redraw_ms is None:
+        import tkinter as tk
+        root = tk.Tk()
+    else:
+        root = QueueLoop()
+    window = Window(root, args.redraw_ms)
+    bus = uibus.UiBus(root) if mode == 'bus' else None
+    lateness = []
+    finished = {}
+
+    def tick(expected):
+        now = time.monotonic()
+        lateness.append(now - expected)
+        if 'posted' in finished and 'drained' not in finished:
+            # The UI has caught up when a tick finds nothing queued ahead of it
+            if now - expected < TICK_MS / 1000:
+                finished['drained'] = time.perf_counter()
+                root.quit()
+                return
+        root.after(TICK_MS, tick, now + TICK_MS / 1000)
+
+    def worker():
+        post_files(root, bus, window, args.files, args.chunks, args.rate)
+        finished['posted'] = time.perf_counter()
+
+    def start():
+        finished['started'] = time.perf_counter()
+        threading.Thread(target=worker, daemon=True).start()
+        root.after(TICK_MS, tick, time.monotonic() + TICK_MS / 1000)
+
+    root.after(0, start)
+    root.mainloop()
+    if args.redraw_ms is None:
+        root.destroy()
+    return {
+        'callbacks': window.callbacks,
+        'busy': window.busy,
+        'catch_up': finished['drained'] - finished['posted'],
+        'lag_p50': statistics.median(lateness),
+        'lag_p99': percentile(lateness, 0.99),
+        'lag_max': max(lateness)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="UI thread load from per-file engine events")
+    parser.add_argument('--files', type=int, default=5000)
+    parser.add_argument('--chunks', type=int, default=2, help="progress events per file")
+    parser.add_argument('--rate', type=float, default=2000, help="files per second, 0 for as fast as possible")
+    parser.add_argument('--redraw-ms', type=float, default=0.2,
+                        help="CPU per update without a display; ignored with one")
+    args = parser.parse_args()
+    if os.environ.get('DISPLAY') or not sys.platform.startswith('linux'):
+        args.redraw_ms = None
+
+    print(f"{args.files} files, {args.chunks + 2} events each, {args.rate:g} files/s, "
+          + ("Tk" if args.redraw_ms is None else f"no display, {args.redraw_ms:g} ms per update"))
+    print(f"{'':>16} {'callbacks':>10} {'UI busy s':>10} {'catch-up s':>11} "
+          f"{'lag p50 ms':>11} {'lag p99 ms':>11} {'lag max ms':>11}")
+    for mode in ('root.after', 'bus'):
+        result = run(mode, args)
+        print(f"{mode:>16} {result['callbacks']:>10} {result['busy']:>10.2f} {result['catch_up']:>11.2f} "
+              f"{result['lag_p50'] * 1000:>11.1f} {result['lag_p99'] * 1000:>11.1f} {result['lag_max'] * 1000:>11.1f}")
+
+
+if __name__ == '__main__':
+    main()
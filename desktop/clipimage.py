@@ -0,0 +1,228 @@
+# Images on the clipboard. A ClipboardImage holds a captured PIL image or
+# the encoded bytes received from a device, and only produces the other when
+# something asks for it: a captured screenshot is encoded once, on the
+# clipboard watcher thread, before it is sent, and a received one stays as
+# encoded bytes until it is put on the system clipboard (X11, Wayland and
+# macOS take a PNG as-is, so it is never decoded there). Images are compared
+# by a digest of their pixels, so a screenshot copied again is recognised
+# without encoding it again.
+#
+# PIL is optional: without it images are not captured, and text sync works
+# as before.
+import hashlib
+import io
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+
+PNG = 'image/png'
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_HEADER = struct.Struct('>4sII')  # IHDR chunk type, width, height
+
+# zlib level for outgoing PNGs. Screenshots are mostly flat colour, so the
+# fastest level already gets most of the size; higher levels cost several
+# times the CPU for a few percent
+PNG_COMPRESS_LEVEL = 1
+
+# Images from devices with more pixels than this are not decoded
+MAX_PIXELS = 64 * 1024 * 1024
+
+# Seconds a clipboard tool may take to answer probe()
+PROBE_TIMEOUT = 2.0
+
+# Windows clipboard
+CF_DIB = 8
+GMEM_MOVEABLE = 0x0002
+
+
+def png_size(data):
+    # (width, height) from a PNG header, or None for anything else
+    if data[:8] != PNG_SIGNATURE or len(data) < 24:
+        return None
+    chunk, width, height = PNG_HEADER.unpack_from(data, 12)
+    return (width, height) if chunk == b'IHDR' else None
+
+
+def pixel_digest(image):
+    # The same picture hashes the same whether it came as RGB or RGBA
+    if image.mode != 'RGBA':
+        image = image.convert('RGBA')
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(struct.pack('>II', *image.size))
+    digest.update(image.tobytes())
+    return digest.digest()
+
+
+def encode_png(image):
+    if image.mode == 'RGBA' and image.getchannel('A').getextrema() == (255, 255):
+        image = image.convert('RGB')  # opaque; a quarter smaller
+    elif image.mode not in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA'):
+        image = image.convert('RGBA')
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG', compress_level=PNG_COMPRESS_LEVEL)
+    return buffer.getvalue()
+
+
+class ClipboardImage:
+    # image is a PIL image; data its encoded bytes, of type mime. Either may
+    # be given and the other is produced on first use.
+    def __init__(self, image=None, data=None, mime=PNG):
+        self.decoded = image
+        self.data = data
+        self.mime = mime if data is not None else PNG
+        self.pixels = None
+
+    @property
+    def size(self):
+        # (width, height); read from the PNG header without decoding
+        if self.decoded is None:
+            size = png_size(self.data)
+            if size is not None:
+                return size
+        return self.image.size
+
+    @property
+    def image(self):
+        if self.decoded is None:
+            from PIL import Image
+            image = Image.open(io.BytesIO(self.data))  # reads the header only
+            if image.size[0] * image.size[1] > MAX_PIXELS:
+                raise ValueError(f"Image too large: {image.size[0]}x{image.size[1]}")
+            image.load()
+            self.decoded = image
+        return self.decoded
+
+    @property
+    def digest(self):
+        if self.pixels is None:
+            self.pixels = pixel_digest(self.image)
+        return self.pixels
+
+    def encode(self):
+        # Encoded bytes, PNG unless they came from a device in another format
+        if self.data is None:
+            self.data = encode_png(self.decoded)
+            self.mime = PNG
+        return self.data
+
+    def png(self):
+        if self.mime == PNG:
+            return self.encode()
+        return encode_png(self.image)
+
+
+def grab():
+    # The image on the system clipboard, or None when it holds something
+    # else. Raises ImportError without PIL and NotImplementedError where
+    # PIL cannot read the clipboard (Linux without xclip or wl-paste).
+    from PIL import ImageGrab
+    image = ImageGrab.grabclipboard()
+    if image is None or isinstance(image, list):  # a list of copied file names
+        return None
+    return ClipboardImage(image=image)
+
+
+def probe():
+    # A cheap stand-in for grab() when the clipboard is polled on Linux:
+    # asks the clipboard tool for the offered types and, when one is an
+    # image, hashes its bytes as offered without decoding them. b'' means
+    # no image; None means there is no tool to ask, so callers must grab.
+    if sys.platform in ('win32', 'darwin'):
+        return None
+    if os.environ.get('WAYLAND_DISPLAY') and shutil.which('wl-paste'):
+        list_types = ['wl-paste', '--list-types']
+        read_type = ['wl-paste', '--no-newline', '--type']
+    elif shutil.which('xclip'):
+        list_types = ['xclip', '-selection', 'clipboard', '-t', 'TARGETS', '-o']
+        read_type = ['xclip', '-selection', 'clipboard', '-o', '-t']
+    else:
+        return None
+    images = [name for name in run_tool(list_types).decode('utf-8', 'replace').split() if name.startswith('image/')]
+    if not images:
+        return b''
+    data = run_tool(read_type + [PNG if PNG in images else images[0]])
+    return hashlib.blake2b(data, digest_size=16).digest() if data else b''
+
+
+def run_tool(command):
+    # stdout of a clipboard tool; empty when the clipboard is empty, which
+    # both tools report with a non-zero status
+    try:
+        return subprocess.run(command, stdin=subprocess.DEVNULL, capture_output=True,
+                              timeout=PROBE_TIMEOUT).stdout
+    except subprocess.TimeoutExpired as e:
+        raise OSError(f"{command[0]} did not answer") from e
+
+
+def copy(clip):
+    # Puts a ClipboardImage on the system clipboard
+    if sys.platform == 'win32':
+        copy_windows(clip)
+    elif sys.platform == 'darwin':
+        copy_macos(clip)
+    else:
+        copy_unix(clip)
+
+
+def copy_unix(clip):
+    if os.environ.get('WAYLAND_DISPLAY') and shutil.which('wl-copy'):
+        command = ['wl-copy', '--type', PNG]
+    elif shutil.which('xclip'):
+        command = ['xclip', '-selection', 'clipboard', '-t', PNG, '-i']
+    else:
+        raise OSError("Copying images needs xclip (X11) or wl-clipboard (Wayland)")
+    # Both fork to serve the selection, so this returns once the data is read
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL, close_fds=True)
+    process.communicate(clip.png())
+    if process.returncode:
+        raise OSError(f"{command[0]} exited with status {process.returncode}")
+
+
+def copy_macos(clip):
+    fd, path = tempfile.mkstemp(suffix='.png')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(clip.png())
+        script = f'set the clipboard to (read (POSIX file "{path}") as «class PNGf»)'
+        subprocess.run(['osascript', '-e', script], check=True, capture_output=True)
+    finally:
+        os.remove(path)
+
+
+def copy_windows(clip):
+    import ctypes
+    from ctypes import wintypes
+    buffer = io.BytesIO()
+    clip.image.convert('RGB').save(buffer, 'BMP')
+    dib = buffer.getvalue()[14:]  # CF_DIB is a bitmap without the file header
+
+    kernel32 = ctypes.windll.kernel32
+    user32 = ctypes.windll.user32
+    kernel32.GlobalAlloc.restype = wintypes.HGLOBAL
+    kernel32.GlobalAlloc.argtypes = [wintypes.UINT, ctypes.c_size_t]
+    kernel32.GlobalLock.restype = ctypes.c_void_p
+    kernel32.GlobalLock.argtypes = [wintypes.HGLOBAL]
+    kernel32.GlobalUnlock.argtypes = [wintypes.HGLOBAL]
+    kernel32.GlobalFree.argtypes = [wintypes.HGLOBAL]
+    user32.SetClipboardData.restype = wintypes.HANDLE
+    user32.SetClipboardData.argtypes = [wintypes.UINT, wintypes.HANDLE]
+
+    handle = kernel32.GlobalAlloc(GMEM_MOVEABLE, len(dib))
+    if not handle:
+        raise ctypes.WinError()
+    ctypes.memmove(kernel32.GlobalLock(handle), dib, len(dib))
+    kernel32.GlobalUnlock(handle)
+    if not user32.OpenClipboard(None):
+        kernel32.GlobalFree(handle)
+        raise ctypes.WinError()
+    try:
+        user32.EmptyClipboard()
+        if not user32.SetClipboardData(CF_DIB, handle):  # on success the clipboard owns handle
+            kernel32.GlobalFree(handle)
+            raise ctypes.WinError()
+    finally:
+        user32.CloseClipboard()
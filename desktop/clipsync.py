@@ -0,0 +1,249 @@
+# Clipboard change detection. Native change notifications are used where the
+# platform has them (XFIXES selection events on X11, the clipboard sequence
+# number on Windows, the pasteboard change count on macOS), so the clipboard
+# is only read after it actually changed. Elsewhere the clipboard is polled,
+# backing off while nothing changes; images are then only grabbed when a
+# cheap probe (engine.SystemClipboard.paste_image) sees new ones. Changes
+# are compared by hash and bursts are coalesced into the last value. The
+# clipboard holds text or an image (clipimage.ClipboardImage); images are
+# compared by a hash of their pixels.
+import ctypes
+import ctypes.util
+import hashlib
+import os
+import select
+import sys
+import threading
+import time
+
+# Quiet period that ends a burst of changes
+DEBOUNCE = 0.15
+
+# Polling fallback: interval after a change, doubling up to the maximum
+MIN_POLL = 0.25
+MAX_POLL = 2.0
+
+# Change counters are a cheap call, checked at this interval
+COUNTER_POLL = 0.1
+
+# How long a source blocks before the watcher rechecks whether it should stop
+SOURCE_TIMEOUT = 1.0
+
+
+def text_digest(text):
+    return hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+
+def clip_digest(value):
+    return text_digest(value) if isinstance(value, str) else value.digest
+
+
+class XFixesSource:
+    # Blocks on the X connection until the CLIPBOARD selection changes owner
+    SELECTION_NOTIFY = 0
+    SET_SELECTION_OWNER_MASK = 1
+
+    def __init__(self):
+        x11 = ctypes.CDLL(ctypes.util.find_library('X11') or 'libX11.so.6')
+        xfixes = ctypes.CDLL(ctypes.util.find_library('Xfixes') or 'libXfixes.so.3')
+        x11.XOpenDisplay.restype = ctypes.c_void_p
+        x11.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        x11.XDefaultRootWindow.restype = ctypes.c_ulong
+        x11.XDefaultRootWindow.argtypes = [ctypes.c_void_p]
+        x11.XInternAtom.restype = ctypes.c_ulong
+        x11.XInternAtom.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int]
+        x11.XConnectionNumber.argtypes = [ctypes.c_void_p]
+        x11.XPending.argtypes = [ctypes.c_void_p]
+        x11.XNextEvent.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+        x11.XFlush.argtypes = [ctypes.c_void_p]
+        xfixes.XFixesQueryExtension.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_int),
+                                                ctypes.POINTER(ctypes.c_int)]
+        xfixes.XFixesSelectSelectionInput.argtypes = [ctypes.c_void_p, ctypes.c_ulong,
+                                                      ctypes.c_ulong, ctypes.c_ulong]
+
+        display = x11.XOpenDisplay(None)
+        if not display:
+            raise OSError("Cannot open X display")
+        event_base = ctypes.c_int()
+        error_base = ctypes.c_int()
+        if not xfixes.XFixesQueryExtension(display, ctypes.byref(event_base), ctypes.byref(error_base)):
+            raise OSError("XFIXES extension not available")
+
+        clipboard = x11.XInternAtom(display, b'CLIPBOARD', 0)
+        xfixes.XFixesSelectSelectionInput(display, x11.XDefaultRootWindow(display), clipboard,
+                                          self.SET_SELECTION_OWNER_MASK)
+        x11.XFlush(display)
+
+        self.x11 = x11
+        self.display = display
+        self.fd = x11.XConnectionNumber(display)
+        self.notify_type = event_base.value + self.SELECTION_NOTIFY
+        self.event = (ctypes.c_long * 24)()  # sizeof(XEvent)
+
+    def wait(self, timeout):
+        # True once a selection change arrived within timeout
+        changed = False
+        if not self.x11.XPending(self.display):
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+            if not readable:
+                return False
+        while self.x11.XPending(self.display):
+            self.x11.XNextEvent(self.display, self.event)
+            if ctypes.cast(self.event, ctypes.POINTER(ctypes.c_int))[0] == self.notify_type:
+                changed = True
+        return changed
+
+
+class CounterSource:
+    # A clipboard change counter, checked without reading the clipboard
+    def __init__(self, counter):
+        self.counter = counter
+        self.last = counter()
+
+    def wait(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            value = self.counter()
+            if value != self.last:
+                self.last = value
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(COUNTER_POLL, remaining))
+
+
+def native_source():
+    # Best change notification this platform offers, or None to poll
+    try:
+        if sys.platform == 'win32':
+            return CounterSource(ctypes.windll.user32.GetClipboardSequenceNumber)
+        if sys.platform == 'darwin':
+            from AppKit import NSPasteboard
+            return CounterSource(NSPasteboard.generalPasteboard().changeCount)
+        if os.environ.get('DISPLAY') and not os.environ.get('WAYLAND_DISPLAY'):
+            return XFixesSource()
+    except Exception as e:
+        print(f"Clipboard change notifications unavailable, polling instead: {e}")
+    return None
+
+
+class ClipboardWatcher:
+    # Calls on_change(value) from its own thread for every settled clipboard
+    # change while active. read returns the current clipboard text or image.
+    def __init__(self, read, on_change, source=None):
+        self.read = read
+        self.on_change = on_change
+        self.source = source
+        self.last = None
+        self.last_digest = None
+        self.active = threading.Event()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        self.active.set()
+        self.wakeup.set()
+
+    def set_active(self, active):
+        # Nothing is read while inactive (sync disabled or no device connected)
+        if active:
+            self.active.set()
+        else:
+            self.active.clear()
+        self.wakeup.set()
+
+    def remember(self, value):
+        # Text or an image put on the clipboard from a device, so it is not
+        # sent back. A received image is hashed (decoded) only if the
+        # clipboard later holds an image of the same size.
+        self.last = value
+        self.last_digest = None
+
+    def is_last(self, value, digest):
+        last = self.last
+        if last is None or isinstance(last, str) != isinstance(value, str):
+            return False
+        if not isinstance(value, str) and last.size != value.size:
+            return False
+        if self.last_digest is None:
+            try:
+                self.last_digest = clip_digest(last)
+            except Exception as e:
+                print(f"Failed to read received clipboard image: {e}")
+                self.last = None
+                return False
+        return digest == self.last_digest
+
+    def run(self):
+        if self.source is None:
+            self.source = native_source()  # opens the display connection, off the caller's thread
+        interval = MIN_POLL
+        changed = True  # check once on activation
+        while not self.stopped:
+            if not self.active.is_set():
+                self.active.wait()
+                changed = True
+                continue
+
+            if not changed:
+                if self.source is not None:
+                    changed = self.source.wait(SOURCE_TIMEOUT)
+                else:
+                    self.wakeup.clear()
+                    self.wakeup.wait(interval)
+                    changed = True
+                if not changed or not self.active.is_set():
+                    continue
+
+            changed = False
+            value = self.settle()
+            if value is None:
+                interval = min(interval * 2, MAX_POLL)
+                continue
+            interval = MIN_POLL
+            try:
+                self.on_change(value)
+            except Exception as e:
+                print(f"Clipboard sync error: {e}")
+
+    def settle(self):
+        # Wait out a burst of changes and return the final value, or None
+        # when it matches what was last seen
+        if self.source is not None:
+            while self.source.wait(DEBOUNCE):
+                pass
+        value = self.read_value()
+        if value is None or value is self.last:
+            return None  # unread, or the very object put there from a device
+        digest = clip_digest(value)
+        if self.is_last(value, digest):
+            return None
+        if self.source is None:
+            # Polling: re-read until two reads DEBOUNCE apart agree
+            while True:
+                time.sleep(DEBOUNCE)
+                again = self.read_value()
+                if again is None:
+                    break
+                again_digest = clip_digest(again)
+                if again_digest == digest:
+                    break
+                value, digest = again, again_digest
+        self.last, self.last_digest = value, digest
+        if isinstance(value, str) and not value.strip():
+            return None
+        return value
+
+    def read_value(self):
+        try:
+            return self.read()
+        except Exception as e:
+            print(f"Failed to read clipboard: {e}")
+            return None
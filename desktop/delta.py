@@ -0,0 +1,147 @@
+# rsync-style delta encoding. The receiver describes its existing copy of a
+# file as per-block signatures (rolling weak checksum plus strong hash); the
+# sender slides a window over the new version and emits copy instructions
+# for blocks the receiver already has and literal ranges for everything else.
+import hashlib
+import math
+import mmap
+import os
+import zlib
+
+MOD_ADLER = 65521
+
+MIN_BLOCK_SIZE = 2 * 1024
+MAX_BLOCK_SIZE = 128 * 1024
+
+# Files smaller than this are cheaper to send whole
+MIN_DELTA_SIZE = 1024 * 1024
+
+# Give up on the delta when it would carry more than this share of the file
+MAX_LITERAL_RATIO = 0.8
+
+# After a mismatch the window slides byte by byte for this many blocks, which
+# resynchronises after insertions and deletions of up to that length. Longer
+# literal runs advance a block at a time with a one-block rolling burst every
+# BURST_EVERY blocks, so pure Python never walks a large literal run byte by
+# byte.
+ROLL_WINDOW_BLOCKS = 4
+BURST_EVERY = 16
+
+
+def block_size_for(file_size):
+    # Roughly sqrt(size), as rsync does, rounded to whole KB
+    size = int(math.sqrt(max(file_size, 1)))
+    size = (size + 1023) // 1024 * 1024
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, size))
+
+
+def strong_hash(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def signatures(file_path, block_size):
+    # [weak, strong] per block of the receiver's copy; weak is zlib's Adler-32
+    blocks = []
+    with open(file_path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            blocks.append([zlib.adler32(block), strong_hash(block)])
+    return blocks
+
+
+def _weak_parts(data, offset, length):
+    value = zlib.adler32(data[offset:offset + length])
+    return value & 0xffff, value >> 16
+
+
+def _append_copy(ops, index):
+    # Coalesce runs of consecutive blocks into one copy instruction
+    if ops and ops[-1][0] == 'copy' and ops[-1][1] + ops[-1][2] == index:
+        ops[-1] = ('copy', ops[-1][1], ops[-1][2] + 1)
+    else:
+        ops.append(('copy', index, 1))
+
+
+def compute_delta(file_path, block_size, blocks):
+    # Returns a list of ('copy', block_index, block_count) and
+    # ('literal', offset, length) instructions that rebuild file_path from
+    # the receiver's copy, or None when a delta is not worth sending.
+    size = os.path.getsize(file_path)
+    n = block_size
+    if size < n or not blocks:
+        return None
+
+    table = {}
+    for index, (weak, strong) in enumerate(blocks):
+        table.setdefault(weak, {}).setdefault(strong, index)
+
+    ops = []
+    literal_bytes = 0
+    literal_limit = size * MAX_LITERAL_RATIO
+
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        p = 0
+        literal_start = 0
+        budget = ROLL_WINDOW_BLOCKS * n
+        skipped = 0
+        a, b = _weak_parts(data, p, n)
+
+        while p + n <= size:
+            candidates = table.get((b << 16) | a)
+            if candidates is not None:
+                index = candidates.get(strong_hash(data[p:p + n]))
+                if index is not None:
+                    if p > literal_start:
+                        ops.append(('literal', literal_start, p - literal_start))
+                        literal_bytes += p - literal_start
+                    _append_copy(ops, index)
+                    p += n
+                    literal_start = p
+                    budget = ROLL_WINDOW_BLOCKS * n
+                    skipped = 0
+                    if p + n <= size:
+                        a, b = _weak_parts(data, p, n)
+                    continue
+
+            if literal_bytes + p - literal_start > literal_limit:
+                return None
+
+            if budget > 0:
+                # Slide the window one byte
+                budget -= 1
+                if p + n < size:
+                    old = data[p]
+                    a = (a - old + data[p + n]) % MOD_ADLER
+                    b = (b - n * old + a - 1) % MOD_ADLER
+                p += 1
+            else:
+                p += n
+                skipped += 1
+                if skipped % BURST_EVERY == 0:
+                    budget = n
+                if p + n <= size:
+                    a, b = _weak_parts(data, p, n)
+
+        if literal_start < size:
+            ops.append(('literal', literal_start, size - literal_start))
+            literal_bytes += size - literal_start
+
+    if literal_bytes > literal_limit:
+        return None
+    return ops
+
+
+def literal_size(ops):
+    return sum(op[2] for op in ops if op[0] == 'literal')
+
+
+def copy_ranges(blocks, block_size, basis_size):
+    # (offset, length) in the receiver's copy for each [index, count] of a
+    # copy instruction; the last block of the copy may be short
+    for index, count in blocks:
+        offset = index * block_size
+        length = min(count * block_size, basis_size - offset)
+        if length > 0:
+            yield offset, length
@@ -0,0 +1,333 @@
+# Finding each other on the local network without internet access.
+#
+# Interface enumeration lists every address a phone could reach the desktop
+# on; "connecting" a UDP socket to a public address only finds the interface
+# with the default route, which a hotspot without an uplink does not have.
+#
+# DiscoveryResponder answers probes on DISCOVERY_PORT and announces the
+# desktop by broadcast and multicast: a burst when it starts or its
+# addresses change, then a slow beat. A phone that paired before can find
+# the desktop again after an address change or restart without rescanning
+# the QR code. Datagrams are single JSON objects:
+#
+#   {"type": "discover"}                    probe, to the group, a broadcast
+#                                           address or a known address
+#   {"type": "announce", <pairing info>}    reply or announcement
+#
+# Clients connect to the address an announcement came from. They should
+# only trust a desktop whose certificate fingerprint matches the one they
+# paired with, since anyone on the network can send announcements.
+import ipaddress
+import json
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+
+DISCOVERY_PORT = 8889
+MULTICAST_GROUP = '239.255.77.88'
+
+# Seconds after start (or an address change) at which announcements go out,
+# then one every ANNOUNCE_INTERVAL
+ANNOUNCE_BURST = (0, 0.5, 1.5, 3.5)
+ANNOUNCE_INTERVAL = 15.0
+
+# Interfaces are re-read this often, to notice a hotspot starting or moving
+ADDRESS_CHECK_INTERVAL = 5.0
+
+# Larger datagrams are not probes
+MAX_DATAGRAM = 2048
+
+# Container and VM bridges a phone cannot reach
+VIRTUAL_PREFIXES = ('docker', 'veth', 'br-', 'virbr', 'vboxnet', 'vmnet', 'cni', 'flannel', 'podman', 'lxc')
+
+# Subnets that desktop hotspots hand out (Windows Mobile Hotspot, Linux
+# NetworkManager shared connections, macOS Internet Sharing); listed first
+HOTSPOT_NETWORKS = [ipaddress.ip_network(network) for network in
+                    ('192.168.137.0/24', '10.42.0.0/24', '192.168.2.0/24')]
+
+SIOCGIFFLAGS = 0x8913
+SIOCGIFADDR = 0x8915
+SIOCGIFNETMASK = 0x891b
+IFF_UP = 0x1
+IFF_LOOPBACK = 0x8
+
+
+class Interface:
+    __slots__ = ('name', 'ip', 'broadcast')
+
+    def __init__(self, name, ip, netmask=None, broadcast=None):
+        self.name = name
+        self.ip = ip
+        if broadcast is None and netmask:
+            broadcast = str(ipaddress.ip_network(f"{ip}/{netmask}", strict=False).broadcast_address)
+        self.broadcast = broadcast or '255.255.255.255'
+
+    def __eq__(self, other):
+        return (self.name, self.ip, self.broadcast) == (other.name, other.ip, other.broadcast)
+
+    def __repr__(self):
+        return f"Interface({self.name!r}, {self.ip!r}, broadcast={self.broadcast!r})"
+
+
+def psutil_interfaces():
+    import psutil
+    stats = psutil.net_if_stats()
+    for name, addresses in psutil.net_if_addrs().items():
+        if name in stats and not stats[name].isup:
+            continue
+        for address in addresses:
+            if address.family == socket.AF_INET:
+                yield Interface(name, address.address, address.netmask, address.broadcast)
+
+
+def ioctl_interfaces():
+    # Linux without psutil: the primary IPv4 address of each interface
+    import fcntl
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for _, name in socket.if_nameindex():
+            request = struct.pack('256s', name.encode('utf-8')[:15])
+            try:
+                flags, = struct.unpack_from('H', fcntl.ioctl(sock, SIOCGIFFLAGS, request), 16)
+                if not flags & IFF_UP or flags & IFF_LOOPBACK:
+                    continue
+                ip = socket.inet_ntoa(fcntl.ioctl(sock, SIOCGIFADDR, request)[20:24])
+                netmask = socket.inet_ntoa(fcntl.ioctl(sock, SIOCGIFNETMASK, request)[20:24])
+            except OSError:
+                continue  # down, or no IPv4 address
+            yield Interface(name, ip, netmask)
+    finally:
+        sock.close()
+
+
+def probe_interfaces():
+    # Last resort: the host name's addresses, plus the source address the
+    # routing table picks for a few destinations (nothing is sent)
+    addresses = []
+    try:
+        addresses.extend(info[4][0] for info in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET))
+    except OSError:
+        pass
+    for target in ('8.8.8.8', '10.255.255.255', '172.31.255.255', '192.168.255.255'):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.connect((target, 9))
+            addresses.append(sock.getsockname()[0])
+        except OSError:
+            pass
+        finally:
+            sock.close()
+    return [Interface('', ip) for ip in dict.fromkeys(addresses)]
+
+
+def list_interfaces():
+    # IPv4 interfaces a phone might reach us on, best first
+    try:
+        interfaces = list(psutil_interfaces())
+    except ImportError:
+        interfaces = None
+    if interfaces is None and sys.platform.startswith('linux'):
+        try:
+            interfaces = list(ioctl_interfaces())
+        except (OSError, ImportError, AttributeError):
+            interfaces = None
+    if interfaces is None:
+        interfaces = probe_interfaces()
+
+    usable = []
+    for interface in interfaces:
+        ip = ipaddress.ip_address(interface.ip)
+        if ip.is_loopback or ip.is_unspecified or interface.name.startswith(VIRTUAL_PREFIXES):
+            continue
+        usable.append(interface)
+
+    def rank(interface):
+        ip = ipaddress.ip_address(interface.ip)
+        if any(ip in network for network in HOTSPOT_NETWORKS):
+            return 0
+        if ip.is_link_local:
+            return 3
+        return 1 if ip.is_private else 2
+
+    return sorted(usable, key=rank)  # stable: same-rank interfaces keep the OS order
+
+
+def lan_addresses():
+    # Addresses for the pairing info, best first; loopback when offline
+    return [interface.ip for interface in list_interfaces()] or ['127.0.0.1']
+
+
+def probe_message():
+    return json.dumps({'type': 'discover'}).encode('utf-8')
+
+
+def parse_datagram(data):
+    if len(data) > MAX_DATAGRAM:
+        return None
+    try:
+        message = json.loads(data.decode('utf-8'))
+    except (UnicodeDecodeError, ValueError):
+        return None
+    return message if isinstance(message, dict) else None
+
+
+class DiscoveryResponder:
+    # info() returns the pairing info to announce. on_addresses_changed
+    # (interfaces) is called from the responder thread when the set of
+    # usable interfaces changes. port 0 binds any free port (for tests).
+    def __init__(self, info, on_addresses_changed=None, port=DISCOVERY_PORT):
+        self.info = info
+        self.on_addresses_changed = on_addresses_changed or (lambda interfaces: None)
+        self.port = port
+        self.interfaces = []
+        self.sock = None
+        self.stopped = threading.Event()
+        self.thread = None
+        self.burst_started = 0.0
+        self.next_announce = 0.0
+
+    def start(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            except OSError:
+                pass
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)  # never leaves the local network
+        try:
+            sock.bind(('', self.port))
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+        self.port = sock.getsockname()[1]
+        self.thread = threading.Thread(target=self.run, name='discovery', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout=2)
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def announce_soon(self):
+        # Starts a new burst, e.g. after the server moved to another port
+        self.burst_started = time.monotonic()
+        self.next_announce = self.burst_started
+
+    def join_groups(self, interfaces):
+        for interface in interfaces:
+            try:
+                self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                                     socket.inet_aton(MULTICAST_GROUP) + socket.inet_aton(interface.ip))
+            except OSError:
+                pass  # already a member, or the interface has no multicast
+
+    def run(self):
+        self.update_interfaces(report=False)
+        self.announce_soon()
+        next_check = time.monotonic() + ADDRESS_CHECK_INTERVAL
+        while not self.stopped.is_set():
+            now = time.monotonic()
+            if now >= next_check:
+                self.update_interfaces(report=True)
+                next_check = now + ADDRESS_CHECK_INTERVAL
+            if now >= self.next_announce:
+                self.announce()
+                self.schedule_announce(now)
+            timeout = max(0.0, min(next_check, self.next_announce) - time.monotonic())
+            try:
+                readable, _, _ = select.select([self.sock], [], [], min(timeout, 0.5))
+                if readable:
+                    data, sender = self.sock.recvfrom(MAX_DATAGRAM + 1)
+                    message = parse_datagram(data)
+                    if message is not None and message.get('type') == 'discover':
+                        self.send(self.announcement(), sender)
+            except OSError as e:
+                if self.stopped.is_set():
+                    break
+                print(f"Discovery error: {e}")
+                self.stopped.wait(1)
+
+    def schedule_announce(self, now):
+        elapsed = now - self.burst_started
+        for offset in ANNOUNCE_BURST:
+            if offset > elapsed:
+                self.next_announce = self.burst_started + offset
+                return
+        self.next_announce = now + ANNOUNCE_INTERVAL
+
+    def update_interfaces(self, report):
+        interfaces = list_interfaces()
+        if interfaces == self.interfaces:
+            return
+        self.interfaces = interfaces
+        self.join_groups(interfaces)
+        if report:
+            self.on_addresses_changed(interfaces)
+            self.announce_soon()
+
+    def announcement(self):
+        return json.dumps(dict(self.info(), type='announce')).encode('utf-8')
+
+    def send(self, data, address):
+        try:
+            self.sock.sendto(data, address)
+        except OSError:
+            pass  # no route on this interface right now
+
+    def announce(self):
+        data = self.announcement()
+        for interface in self.interfaces:
+            try:
+                self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface.ip))
+            except OSError:
+                continue
+            self.send(data, (MULTICAST_GROUP, self.port))
+            self.send(data, (interface.broadcast, self.port))
+
+
+def discover(timeout=1.0, fingerprint=None, targets=(), port=DISCOVERY_PORT):
+    # Client side: probes the group, every broadcast address and any known
+    # targets, and returns [(source ip, pairing info)] of the desktops that
+    # answered within timeout, filtered by certificate fingerprint if given
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        sock.bind(('', 0))
+        probe = probe_message()
+        destinations = [(MULTICAST_GROUP, port)] + [(interface.broadcast, port) for interface in list_interfaces()]
+        for destination in list(dict.fromkeys(destinations)) + list(targets):
+            try:
+                sock.sendto(probe, destination)
+            except OSError:
+                pass
+        found = {}
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            readable, _, _ = select.select([sock], [], [], remaining)
+            if not readable:
+                break
+            data, (ip, _) = sock.recvfrom(MAX_DATAGRAM + 1)
+            message = parse_datagram(data)
+            if message is None or message.get('type') != 'announce':
+                continue
+            if fingerprint is not None and message.get('fingerprint') != fingerprint:
+                continue
+            found.setdefault((ip, message.get('port')), message)
+            if fingerprint is not None:
+                break  # the one paired desktop
+        return [(ip, message) for (ip, _), message in found.items()]
+    finally:
+        sock.close()
@@ -0,0 +1,591 @@
+# Headless core of the desktop app: configuration, the connection manager
+# and clipboard sync, with no UI toolkit imported. The Tk app (main.py) and
+# the command line daemon (syncd.py) each drive one SyncEngine and receive
+# its events through a Listener.
+import collections
+import concurrent.futures
+import json
+import os
+import socket
+import threading
+import time
+
+import clipimage
+import clipsync
+import discovery
+import metrics
+import securelink
+import transferqueue
+from server import ConnectionManager, MAX_STREAMS
+
+CONFIG_FILE = "sync_config.json"
+INDEX_FILE = "sync_index.sqlite3"
+QUEUE_FILE = "sync_queue.sqlite3"
+IDENTITY_FILE = "sync_identity.pem"
+DEFAULT_FOLDER = os.path.join(os.path.expanduser("~"), "Downloads", "sync-files")
+
+# Encoded clipboard images kept by pixel digest, so copying one again does
+# not encode it again
+IMAGE_CACHE_SIZE = 4
+
+
+def default_config():
+    return {
+        'sync_folder': DEFAULT_FOLDER,
+        'port': 8888,
+        'auto_accept_files': False,
+        'parallel_streams': 4,
+        'concurrent_transfers': 2,
+        'bandwidth_limit': 0,  # KB/s for outgoing data, 0 for none
+        'require_encryption': False,  # refuse devices that connect without TLS
+        'discovery': True  # answer and announce on the local network (discovery.py)
+    }
+
+
+def load_config(config_file=CONFIG_FILE):
+    # Saved settings on top of the defaults, so new keys always exist
+    config = default_config()
+    try:
+        if os.path.exists(config_file):
+            with open(config_file, 'r') as f:
+                config.update(json.load(f))
+    except Exception as e:
+        print(f"Failed to load configuration: {e}")
+    return config
+
+
+def local_ip():
+    # The best LAN address; works on a hotspot without internet access
+    return discovery.lan_addresses()[0]
+
+
+def pairing_info(ip, port, fingerprint=None, addresses=None):
+    # What the mobile app needs to connect; shown as a QR code by the Tk app.
+    # With a fingerprint the app connects over TLS and pins that certificate.
+    # addresses lists every interface, best first, for the app to try in turn.
+    info = {
+        "ip": ip,
+        "port": port,
+        "device_name": socket.gethostname(),
+        "timestamp": int(time.time())
+    }
+    if addresses and len(addresses) > 1:
+        info["addresses"] = list(addresses)
+    if fingerprint:
+        info["fingerprint"] = fingerprint
+    return info
+
+
+class MemoryClipboard:
+    # Process-local clipboard for machines without one (servers, kiosks,
+    # benchmarks). serial counts changes, for clipsync.CounterSource. Holds
+    # text or a clipimage.ClipboardImage.
+    def __init__(self, text=''):
+        self.text = text
+        self.image = None
+        self.serial = 0
+
+    def paste(self):
+        return self.text
+
+    def copy(self, text):
+        self.text = text
+        self.image = None
+        self.serial += 1
+
+    def paste_image(self):
+        return self.image
+
+    def copy_image(self, image):
+        self.text = ''
+        self.image = image
+        self.serial += 1
+
+
+class SystemClipboard:
+    # pyperclip, imported on first use rather than at startup; the clipboard
+    # is only read once a device connects
+    def __init__(self):
+        self.module = None
+        self.images = True  # until PIL turns out to be missing or unable to read the clipboard
+        self.probed = (None, None)  # (clipimage.probe() result, image grabbed for it)
+
+    def load(self):
+        if self.module is None:
+            import pyperclip
+            self.module = pyperclip
+        return self.module
+
+    def paste(self):
+        return self.load().paste()
+
+    def copy(self, text):
+        self.load().copy(text)
+
+    def paste_image(self):
+        # Where the clipboard is polled, an unchanged image comes back as the
+        # same object without grabbing and hashing its pixels again
+        if not self.images:
+            return None
+        try:
+            probe = clipimage.probe()
+        except OSError as e:
+            print(f"Clipboard probe failed: {e}")
+            probe = None
+        if probe is not None and probe == self.probed[0]:
+            return self.probed[1]
+        image = None
+        if probe != b'':
+            try:
+                image = clipimage.grab()
+            except (ImportError, NotImplementedError) as e:
+                print(f"Image clipboard sync unavailable: {e}")
+                self.images = False
+                return None
+        self.probed = (probe, image)
+        return image
+
+    def copy_image(self, image):
+        clipimage.copy(image)
+
+
+class Listener:
+    # Engine events; override the ones you need. They run on the network
+    # loop thread (or the clipboard or identity thread), never on a UI thread.
+    def on_session_opened(self, session):
+        pass
+
+    def on_session_closed(self, session):
+        pass
+
+    def on_clipboard_received(self, session, text):
+        pass
+
+    def on_clipboard_image_received(self, session, image):
+        # image is a clipimage.ClipboardImage, still encoded
+        pass
+
+    def on_message(self, session, message):
+        pass
+
+    def on_transfer_progress(self, session, name, done, total):
+        pass
+
+    def on_file_received(self, session, file_path):
+        pass
+
+    def on_transfer_error(self, session, name, error):
+        pass
+
+    def on_folder_synced(self, session, folder, summary):
+        pass
+
+    def on_queue_changed(self, job):
+        pass
+
+    def on_job_finished(self, job):
+        # job.state is 'done' (job.reports holds one report per device),
+        # 'failed' (job.error says why) or 'cancelled'
+        pass
+
+    def on_addresses_changed(self, addresses):
+        # The LAN addresses changed while running (a hotspot started or
+        # moved); pairing_info() now reports the new ones
+        pass
+
+    def on_identity_ready(self, fingerprint):
+        # The TLS certificate is loaded; fingerprint is None when encryption
+        # is unavailable. pairing_info() includes it from now on.
+        pass
+
+
+class SyncEngine:
+    # clipboard is any object with paste() and copy(text) (pyperclip, a
+    # MemoryClipboard), or None to leave clipboard sync off; images are
+    # synced too when it also has paste_image() and copy_image(image). Methods that
+    # start transfers return concurrent futures, as the manager does; the
+    # queue_* methods add persistent jobs to the transfer queue instead.
+    def __init__(self, config=None, config_file=CONFIG_FILE, clipboard=None, listener=None,
+                 index_file=INDEX_FILE, queue_file=QUEUE_FILE, identity_file=IDENTITY_FILE):
+        self.config_file = config_file
+        self.config = config if config is not None else load_config(config_file)
+        self.listener = listener or Listener()
+        self.clipboard = clipboard
+        self.clipboard_enabled = clipboard is not None
+        # TLS certificate whose fingerprint goes into the pairing info. The
+        # first run generates it, which can take seconds, so it is loaded on
+        # its own thread; until identity_ready is set only plaintext is offered.
+        self.identity = None
+        self.fingerprint = None
+        self.identity_ready = threading.Event()
+        self.server = ConnectionManager(self, lambda: self.config['sync_folder'], index_file,
+                                        self.config['parallel_streams'], self.config['bandwidth_limit'] * 1024)
+        self.set_require_encryption(self.config['require_encryption'])
+        threading.Thread(target=self.load_identity, args=(identity_file,), name='identity', daemon=True).start()
+        self.address = None
+        self.addresses = []
+        self.fixed_host = False
+        self.responder = None
+        self.profiler = None
+
+        # Ensure sync folder exists
+        os.makedirs(self.config['sync_folder'], exist_ok=True)
+
+        self.encoded_images = collections.OrderedDict()  # pixel digest -> (data, mime)
+        self.encoded_images_lock = threading.Lock()
+        self.clipboard_watcher = None
+        if clipboard is not None:
+            source = None
+            if isinstance(clipboard, MemoryClipboard):
+                source = clipsync.CounterSource(lambda: clipboard.serial)
+            self.clipboard_watcher = clipsync.ClipboardWatcher(self.read_clipboard, self.on_clipboard_changed, source)
+            self.clipboard_watcher.start()
+
+        # Jobs left over from the last run start again once their device connects
+        self.queue = transferqueue.TransferQueue(
+            queue_file, self.run_job, self.job_ready, self.config['concurrent_transfers'],
+            lambda job: self.listener.on_queue_changed(job), lambda job: self.listener.on_job_finished(job))
+        self.queue.start()
+
+    def load_identity(self, identity_file):
+        identity = securelink.load_identity(identity_file)
+        if identity is not None:
+            self.identity = identity
+            self.fingerprint = identity.fingerprint
+            self.server.identity = identity
+            self.set_require_encryption(self.config['require_encryption'])
+        self.identity_ready.set()
+        self.listener.on_identity_ready(self.fingerprint)
+
+    def save_config(self):
+        with open(self.config_file, 'w') as f:
+            json.dump(self.config, f, indent=2)
+
+    def set_streams(self, streams):
+        # Applies to devices that connect from now on
+        self.config['parallel_streams'] = max(1, min(int(streams), MAX_STREAMS))
+        self.server.streams = self.config['parallel_streams']
+
+    def set_concurrent_transfers(self, count):
+        self.config['concurrent_transfers'] = max(1, int(count))
+        self.queue.set_limit(self.config['concurrent_transfers'])
+
+    def set_require_encryption(self, required):
+        # Applies to devices that connect from now on; needs an identity
+        self.config['require_encryption'] = bool(required)
+        self.server.require_tls = self.config['require_encryption'] and self.identity is not None
+
+    def set_bandwidth_limit(self, kb_per_second):
+        # Outgoing file data across all devices; 0 removes the cap
+        self.config['bandwidth_limit'] = max(0, int(kb_per_second))
+        self.server.bandwidth.set_rate(self.config['bandwidth_limit'] * 1024)
+
+    def start(self, host=None, port=None):
+        # Listens on every interface unless host is given. Returns the
+        # (ip, port) to pair with: the best LAN address and the bound port.
+        port = self.config['port'] if port is None else port
+        self.fixed_host = bool(host)
+        self.addresses = [host] if host else discovery.lan_addresses()
+        _, port = self.server.start(host or '0.0.0.0', port)
+        self.address = (self.addresses[0], port)
+        if self.config['discovery']:
+            self.start_discovery()
+        self.update_clipboard_watcher()
+        return self.address
+
+    def stop(self):
+        if self.responder is not None:
+            self.responder.stop()
+            self.responder = None
+        self.server.stop()
+        self.address = None
+        self.update_clipboard_watcher()
+
+    def start_discovery(self):
+        self.responder = discovery.DiscoveryResponder(self.pairing_info, self.on_interfaces_changed)
+        try:
+            self.responder.start()
+        except OSError as e:
+            print(f"LAN discovery unavailable: {e}")
+            self.responder = None
+
+    def set_discovery(self, enabled):
+        self.config['discovery'] = bool(enabled)
+        if self.address is None:
+            return
+        if enabled and self.responder is None:
+            self.start_discovery()
+        elif not enabled and self.responder is not None:
+            self.responder.stop()
+            self.responder = None
+
+    def on_interfaces_changed(self, interfaces):
+        # Runs on the discovery thread
+        if self.fixed_host or self.address is None:
+            return
+        self.addresses = [interface.ip for interface in interfaces] or ['127.0.0.1']
+        self.address = (self.addresses[0], self.address[1])
+        self.listener.on_addresses_changed(list(self.addresses))
+
+    def close(self):
+        self.stop_profiler()
+        self.queue.close()
+        if self.clipboard_watcher is not None:
+            self.clipboard_watcher.stop()
+        self.stop()
+
+    def pairing_info(self):
+        ip, port = self.address
+        return pairing_info(ip, port, self.fingerprint, self.addresses)
+
+    @property
+    def is_running(self):
+        return self.server.is_running
+
+    def sessions(self, session_ids=None):
+        return self.server.target_sessions(session_ids) if self.server.is_running else []
+
+    # Diagnostics
+
+    def metrics_snapshot(self):
+        # Process metrics plus the live send queues and codec figures
+        snapshot = metrics.REGISTRY.snapshot()
+        sessions = self.sessions()
+        names = {session.id: session.device_name for session in sessions}
+        queues = self.server.queue_stats() if self.is_running else {}
+        gauges = [{'name': 'sessions_connected', 'labels': {}, 'value': len(sessions)}]
+        for session_id, stats in queues.items():
+            stats['device'] = names.get(session_id, str(session_id))
+            for priority in ('control', 'bulk'):
+                gauges.append({'name': 'send_queue_depth',
+                               'labels': {'device': stats['device'], 'priority': priority},
+                               'value': stats[f'{priority}_queued']})
+        jobs = self.queue.snapshot()
+        for state in (transferqueue.QUEUED, transferqueue.RUNNING):
+            gauges.append({'name': 'transfer_queue_jobs', 'labels': {'state': state},
+                           'value': sum(1 for job in jobs if job.state == state)})
+        compression = self.server.compression_stats()
+        for codec, stats in compression.items():
+            gauges.append({'name': 'compression_ratio', 'labels': {'codec': codec}, 'value': stats['ratio']})
+        snapshot['gauges'] = gauges
+        snapshot['queues'] = queues
+        snapshot['compression'] = compression
+        if self.profiler is not None:
+            snapshot['profile'] = [{'function': function, 'self': own, 'total': inclusive}
+                                   for function, own, inclusive in self.profiler.top()]
+        return snapshot
+
+    def start_profiler(self, interval=0.005):
+        # Opt-in: samples every thread's stack until stop_profiler
+        if self.profiler is None or not self.profiler.running:
+            self.profiler = metrics.SamplingProfiler(interval)
+            self.profiler.start()
+        return self.profiler
+
+    def stop_profiler(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+        return self.profiler
+
+    # Clipboard
+
+    def set_clipboard_enabled(self, enabled):
+        self.clipboard_enabled = enabled and self.clipboard is not None
+        self.update_clipboard_watcher()
+
+    def update_clipboard_watcher(self):
+        # Watches for local clipboard changes only while sync is enabled and
+        # a device is connected
+        if self.clipboard_watcher is not None:
+            self.clipboard_watcher.set_active(self.clipboard_enabled and bool(self.sessions()))
+
+    def read_clipboard(self):
+        # Text when there is some, otherwise an image if the clipboard holds one
+        text = self.clipboard.paste()
+        if text or not hasattr(self.clipboard, 'paste_image'):
+            return text
+        return self.clipboard.paste_image() or text
+
+    def on_clipboard_changed(self, value):
+        # Runs on the watcher thread once a burst of changes has settled
+        if isinstance(value, str):
+            self.server.send_clipboard(value)
+        else:
+            self.send_clipboard_image(value)
+
+    def send_clipboard(self, text=None, session_ids=None):
+        # The local clipboard (text or image) unless text is given; False
+        # when there is nothing to send or nobody to send it to
+        if text is None:
+            if self.clipboard is None:
+                return False
+            text = self.read_clipboard()
+            if isinstance(text, clipimage.ClipboardImage):
+                return self.send_clipboard_image(text, session_ids)
+        if not text:
+            return False
+        return self.server.send_clipboard(text, session_ids)
+
+    def send_clipboard_image(self, image, session_ids=None):
+        # Encodes on the calling thread (never the network loop), once per
+        # distinct picture; devices that already have it are skipped
+        try:
+            data, mime = self.encode_image(image)
+        except Exception as e:
+            print(f"Failed to encode clipboard image: {e}")
+            return False
+        return self.server.send_clipboard_image(data, mime, session_ids)
+
+    def encode_image(self, image):
+        digest = image.digest
+        with self.encoded_images_lock:
+            cached = self.encoded_images.get(digest)
+            if cached is not None:
+                self.encoded_images.move_to_end(digest)
+                return cached
+        started = time.perf_counter()
+        encoded = image.encode(), image.mime
+        metrics.observe('clipboard_image_encode_seconds', time.perf_counter() - started)
+        with self.encoded_images_lock:
+            self.encoded_images[digest] = encoded
+            while len(self.encoded_images) > IMAGE_CACHE_SIZE:
+                self.encoded_images.popitem(last=False)
+        return encoded
+
+    def request_clipboard(self, session_ids=None):
+        return self.server.broadcast({'type': 'clipboard_request'}, session_ids)
+
+    def apply_remote_clipboard(self, session, text):
+        # Runs in an executor; clipboard access can block
+        if not self.clipboard_enabled:
+            return
+        try:
+            self.clipboard_watcher.remember(text)
+            self.clipboard.copy(text)
+        except Exception as e:
+            print(f"Failed to update clipboard: {e}")
+            return
+        print(f"Clipboard updated from {session.device_name}")
+        self.listener.on_clipboard_received(session, text)
+
+        # Pass it on to the other devices instead of echoing it back
+        others = {s.id for s in self.sessions() if s.id != session.id}
+        if others:
+            self.server.send_clipboard(text, others)
+
+    def apply_remote_image(self, session, image):
+        # Runs in an executor. The image stays encoded unless the platform
+        # clipboard needs pixels (Windows) or a local image is compared with it
+        if not self.clipboard_enabled or not hasattr(self.clipboard, 'copy_image'):
+            return
+        try:
+            self.clipboard_watcher.remember(image)
+            self.clipboard.copy_image(image)
+        except Exception as e:
+            print(f"Failed to put image on clipboard: {e}")
+            return
+        print(f"Clipboard image updated from {session.device_name}")
+        self.listener.on_clipboard_image_received(session, image)
+
+        others = {s.id for s in self.sessions() if s.id != session.id}
+        if others:
+            self.server.send_clipboard_image(image.data, image.mime, others)
+
+    # Transfers
+
+    def send_file(self, file_path, file_name=None, session_ids=None, on_progress=None):
+        return self.server.send_file(file_path, file_name, session_ids, on_progress)
+
+    def send_folder(self, folder_path, session_ids=None, on_progress=None):
+        # Sent as <folder name>.zip
+        archive_name = f"{os.path.basename(os.path.normpath(folder_path))}.zip"
+        return self.server.send_folder(folder_path, archive_name, session_ids, on_progress)
+
+    def sync_directory(self, folder_path, session_ids=None):
+        return self.server.sync_directory(folder_path, session_ids)
+
+    # Transfer queue
+
+    def device_keys(self, session_ids):
+        # Jobs remember devices by key, which survives reconnects and restarts
+        if session_ids is None:
+            return None
+        return [session.device_key for session in self.sessions(session_ids)]
+
+    def queue_file(self, file_path, file_name=None, session_ids=None):
+        return self.queue.add('file', os.path.abspath(file_path), file_name or os.path.basename(file_path),
+                              self.device_keys(session_ids), os.path.getsize(file_path))
+
+    def queue_folder(self, folder_path, session_ids=None):
+        archive_name = f"{os.path.basename(os.path.normpath(folder_path))}.zip"
+        return self.queue.add('folder', os.path.abspath(folder_path), archive_name, self.device_keys(session_ids))
+
+    def queue_sync(self, folder_path, session_ids=None):
+        return self.queue.add('sync', os.path.abspath(folder_path), os.path.basename(os.path.normpath(folder_path)),
+                              self.device_keys(session_ids))
+
+    def job_sessions(self, job):
+        return [session for session in self.sessions()
+                if job.targets is None or session.device_key in job.targets]
+
+    def job_ready(self, job):
+        return bool(self.job_sessions(job))
+
+    def run_job(self, job):
+        # Runs on a queue worker thread. ConnectionError sends the job back
+        # to the queue until one of its devices is connected again.
+        session_ids = {session.id for session in self.job_sessions(job)}
+        if not session_ids:
+            raise ConnectionError("No device connected")
+
+        def progress(session, done, total):
+            self.queue.progress(job, session.id, done, total)
+
+        try:
+            if job.kind == 'file':
+                future = self.send_file(job.path, job.name, session_ids, progress)
+            elif job.kind == 'folder':
+                future = self.send_folder(job.path, session_ids, progress)
+            else:
+                future = self.sync_directory(job.path, session_ids)
+            return future.result()
+        except (ConnectionError, concurrent.futures.CancelledError) as e:
+            # The queue sends it again; stop the manager re-sending it on its
+            # own when the device asks to resume
+            self.server.forget_interrupted(job.path)
+            raise ConnectionError(str(e) or "Server stopped") from e
+
+    # Connection manager callbacks; these run on the network loop thread
+
+    def on_session_opened(self, session):
+        self.update_clipboard_watcher()
+        self.queue.wake()
+        self.listener.on_session_opened(session)
+
+    def on_session_closed(self, session):
+        self.update_clipboard_watcher()
+        self.listener.on_session_closed(session)
+
+    def on_message(self, session, message):
+        msg_type = message.get('type')
+        if msg_type == 'clipboard':
+            session.loop.run_in_executor(None, self.apply_remote_clipboard, session, message['data'])
+        elif msg_type == 'clipboard_image':
+            image = clipimage.ClipboardImage(data=message['data'], mime=message['format'])
+            session.loop.run_in_executor(None, self.apply_remote_image, session, image)
+        elif msg_type == 'clipboard_request':
+            session.loop.run_in_executor(None, self.send_clipboard, None, {session.id})
+        else:
+            self.listener.on_message(session, message)
+
+    def on_transfer_progress(self, session, name, done, total):
+        self.listener.on_transfer_progress(session, name, done, total)
+
+    def on_file_received(self, session, file_path):
+        self.listener.on_file_received(session, file_path)
+
+    def on_transfer_error(self, session, name, error):
+        self.listener.on_transfer_error(session, name, error)
+
+    def on_folder_synced(self, session, folder, summary):
+        self.listener.on_folder_synced(session, folder, summary)
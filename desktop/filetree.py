@@ -0,0 +1,244 @@
+# Virtualized file list for the Files tab: a ttk.Treeview holding only the
+# rows that fit on screen. Scrolling rewrites those rows from a
+# folderview.FolderView instead of moving through real items, so the
+# widget costs the same with a hundred files or a hundred thousand. With a
+# thumbcache.ThumbnailCache, image rows get a thumbnail; only the rows on
+# screen ask for one, and work queued for rows scrolled past is dropped.
+import base64
+import collections
+import os
+import tkinter as tk
+from tkinter import ttk
+from datetime import datetime
+
+import folderview
+import thumbcache
+
+HEADINGS = (('#0', 'name', 'Name'), ('size', 'size', 'Size'), ('modified', 'modified', 'Modified'))
+
+# Wait this long after the last keystroke before filtering
+FILTER_DELAY_MS = 150
+
+# Thumbnail images kept for rows, so scrolling back does not decode them again
+PHOTO_CACHE_SIZE = 512
+THUMBNAIL_STYLE = 'Thumbnails.Treeview'
+
+
+def format_size(size):
+    return f"{size / 1024:.1f} KB"
+
+
+def format_time(mtime):
+    return datetime.fromtimestamp(mtime).strftime("%Y-%m-%d %H:%M")
+
+
+class VirtualFileTree(ttk.Frame):
+    # Generates <<ListChanged>> when the number of rows may have changed.
+    # thumbnails is a ThumbnailCache for the files in folder; call
+    # thumbnails_ready() on the Tk thread when it has new results.
+    def __init__(self, parent, folder=None, thumbnails=None):
+        super().__init__(parent)
+        self.view = folderview.FolderView()
+        self.folder = folder
+        self.thumbnails = thumbnails
+        self.photos = collections.OrderedDict()  # cache key -> PhotoImage
+        self.waiting = set()  # cache keys of thumbnails on screen still being made
+        self.top = 0  # view index of the first row shown
+        self.items = []  # Treeview item ids, top to bottom
+        self.shown = {}  # item id -> (name, size, mtime, photo) currently written to it
+        self.selected = set()  # names, so selection survives scrolling
+        self.rendering = False
+        self.filter_job = None
+
+        style = 'Treeview'
+        if thumbnails is not None:
+            style = THUMBNAIL_STYLE
+            ttk.Style().configure(style, rowheight=thumbcache.BOXES[thumbcache.THUMB] + 4)
+        self.tree = ttk.Treeview(self, columns=('size', 'modified'), show='tree headings', selectmode='extended',
+                                 style=style)
+        for column, sort_column, text in HEADINGS:
+            self.tree.heading(column, text=text, command=lambda c=sort_column: self.sort_by(c))
+        self.scrollbar = ttk.Scrollbar(self, orient='vertical', command=self.yview)
+        self.tree.pack(side='left', fill='both', expand=True)
+        self.scrollbar.pack(side='right', fill='y')
+
+        self.tree.bind('<Configure>', lambda event: self.refresh())
+        self.tree.bind('<<TreeviewSelect>>', self.on_select)
+        self.tree.bind('<MouseWheel>', lambda event: self.scroll_units(-1 if event.delta > 0 else 1, 3))
+        self.tree.bind('<Button-4>', lambda event: self.scroll_units(-1, 3))
+        self.tree.bind('<Button-5>', lambda event: self.scroll_units(1, 3))
+        self.tree.bind('<Prior>', lambda event: self.yview('scroll', -1, 'pages') or 'break')
+        self.tree.bind('<Next>', lambda event: self.yview('scroll', 1, 'pages') or 'break')
+        self.tree.bind('<Home>', lambda event: self.yview('moveto', 0) or 'break')
+        self.tree.bind('<End>', lambda event: self.yview('moveto', 1) or 'break')
+        self.tree.bind('<Up>', lambda event: self.step_focus(-1))
+        self.tree.bind('<Down>', lambda event: self.step_focus(1))
+        self.update_headings()
+
+    def __len__(self):
+        return len(self.view)
+
+    def visible_rows(self):
+        # Rows that fit below the heading; rowheight is a style option
+        height = self.tree.winfo_height()
+        try:
+            row_height = int(ttk.Style().lookup(self.tree.cget('style') or 'Treeview', 'rowheight') or 20)
+        except (tk.TclError, ValueError):
+            row_height = 20
+        return max(1, height // row_height - 1)
+
+    def apply(self, changed, removed, reset):
+        # Changes from folderview.FolderWatcher; only rows on screen whose
+        # file changed are rewritten
+        self.view.apply(changed, removed, reset)
+        if reset:
+            self.top = 0
+        self.refresh()
+        self.event_generate('<<ListChanged>>')
+
+    def set_filter(self, text):
+        if self.filter_job is not None:
+            self.after_cancel(self.filter_job)
+        self.filter_job = self.after(FILTER_DELAY_MS, self.apply_filter, text)
+
+    def apply_filter(self, text):
+        self.filter_job = None
+        self.view.set_filter(text)
+        self.top = 0
+        self.refresh()
+        self.event_generate('<<ListChanged>>')
+
+    def sort_by(self, column):
+        reverse = not self.view.reverse if column == self.view.sort_column else False
+        self.view.set_sort(column, reverse)
+        self.update_headings()
+        self.refresh()
+
+    def update_headings(self):
+        for column, sort_column, text in HEADINGS:
+            if sort_column == self.view.sort_column:
+                text += " ▼" if self.view.reverse else " ▲"
+            self.tree.heading(column, text=text)
+
+    def refresh(self):
+        total = len(self.view)
+        rows = self.visible_rows()
+        self.top = max(0, min(self.top, total - rows))
+        count = min(rows, total - self.top)
+
+        self.rendering = True
+        try:
+            while len(self.items) > count:
+                item = self.items.pop()
+                self.shown.pop(item, None)
+                self.tree.delete(item)
+            while len(self.items) < count:
+                self.items.append(self.tree.insert('', 'end'))
+
+            selection = []
+            self.waiting = set()
+            for offset, item in enumerate(self.items):
+                entry = self.view.row(self.top + offset)
+                state = (entry.name, entry.size, entry.mtime, self.thumbnail(entry))
+                if self.shown.get(item) != state:
+                    self.shown[item] = state
+                    self.tree.item(item, text=entry.name, image=state[3] or '',
+                                   values=(format_size(entry.size), format_time(entry.mtime)))
+                if entry.name in self.selected:
+                    selection.append(item)
+            if tuple(selection) != self.tree.selection():
+                self.tree.selection_set(selection)
+        finally:
+            self.rendering = False
+        if self.thumbnails is not None:
+            self.thumbnails.keep(self.waiting)
+
+        if total:
+            self.scrollbar.set(self.top / total, (self.top + count) / total)
+        else:
+            self.scrollbar.set(0, 1)
+
+    def thumbnail(self, entry):
+        # PhotoImage for an image row, or None while it is being made or for
+        # other files. Cache hits, in memory or on disk, come back at once.
+        if self.thumbnails is None or self.folder is None or thumbcache.preview_kind(entry.name) != 'image':
+            return None
+        path = os.path.join(self.folder, entry.name)
+        key = thumbcache.cache_key(path, entry.size, entry.mtime, thumbcache.THUMB)
+        photo = self.photos.get(key)
+        if photo is not None:
+            self.photos.move_to_end(key)
+            return photo
+        key, data = self.thumbnails.request(path, entry.size, entry.mtime, thumbcache.THUMB)
+        if data is None:
+            self.waiting.add(key)
+            return None
+        if not data:
+            return None
+        try:
+            photo = tk.PhotoImage(master=self, data=base64.b64encode(data), format='png')
+        except tk.TclError:
+            return None
+        self.photos[key] = photo
+        while len(self.photos) > PHOTO_CACHE_SIZE:
+            self.photos.popitem(last=False)
+        return photo
+
+    def thumbnails_ready(self, keys):
+        # Redraw once a thumbnail for a row still on screen is ready
+        if self.waiting.intersection(keys):
+            self.refresh()
+
+    def set_folder(self, folder):
+        self.folder = folder
+        self.photos.clear()
+
+    def focused_entry(self):
+        # FileEntry of the row with the keyboard focus, or None
+        focus = self.tree.focus()
+        if focus not in self.items:
+            return None
+        return self.view.row(self.top + self.items.index(focus))
+
+    def on_select(self, event):
+        if self.rendering:
+            return
+        # Names selected on screen replace the on-screen part of the set
+        on_screen = {self.shown[item][0] for item in self.items if item in self.shown}
+        self.selected -= on_screen
+        self.selected.update(self.shown[item][0] for item in self.tree.selection() if item in self.shown)
+
+    def selected_names(self):
+        return sorted(self.selected)
+
+    def yview(self, *args):
+        # Scrollbar protocol: moveto <fraction> or scroll <n> units|pages
+        if args[0] == 'moveto':
+            self.top = int(float(args[1]) * len(self.view))
+        elif args[0] == 'scroll':
+            step = int(args[1])
+            if args[2] == 'pages':
+                step *= max(1, len(self.items) - 1)
+            self.top += step
+        self.refresh()
+
+    def scroll_units(self, direction, count):
+        self.yview('scroll', direction * count, 'units')
+        return 'break'
+
+    def step_focus(self, step):
+        # Arrow keys past the first or last row on screen scroll the window
+        focus = self.tree.focus()
+        if focus not in self.items:
+            return None
+        position = self.items.index(focus) + step
+        if 0 <= position < len(self.items):
+            return None  # Treeview moves within the window itself
+        top = self.top
+        self.yview('scroll', step, 'units')
+        if self.top != top and self.items:
+            item = self.items[0] if step < 0 else self.items[-1]
+            self.tree.focus(item)
+            self.selected = {self.shown[item][0]}
+            self.refresh()
+        return 'break'
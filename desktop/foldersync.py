@@ -0,0 +1,129 @@
+# Incremental folder sync. A persistent SQLite index maps every file under a
+# synced root to its size, mtime and content hash so unchanged files are
+# never re-hashed. Each side turns its index into a manifest; the sender
+# transfers only new or changed files and tells the receiver what to delete.
+import hashlib
+import os
+import sqlite3
+import threading
+
+import transfer
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    root TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    PRIMARY KEY (root, path)
+)
+"""
+
+
+def is_internal(name):
+    # Transfer bookkeeping that must never be synced
+    return name == transfer.JOURNAL_DIR or (name.startswith('.') and name.endswith('.part'))
+
+
+def walk_files(root):
+    # Yields (relative path with '/' separators, DirEntry) for regular files
+    stack = ['']
+    while stack:
+        prefix = stack.pop()
+        try:
+            entries = os.scandir(os.path.join(root, prefix) if prefix else root)
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if is_internal(entry.name):
+                    continue
+                rel_path = f"{prefix}/{entry.name}" if prefix else entry.name
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(rel_path)
+                    elif entry.is_file(follow_symlinks=False):
+                        yield rel_path, entry
+                except OSError:
+                    continue
+
+
+class ContentIndex:
+    # Shared by every session; scans run on executor threads
+    def __init__(self, db_path):
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute(SCHEMA)
+
+    def scan(self, root):
+        # Returns {relative path: (size, sha256)} for everything under root,
+        # hashing only files whose size or mtime changed since the last scan
+        root = os.path.abspath(root)
+        with self.lock:
+            known = {path: (size, mtime_ns, sha256) for path, size, mtime_ns, sha256 in self.db.execute(
+                'SELECT path, size, mtime_ns, sha256 FROM files WHERE root = ?', (root,))}
+
+        manifest = {}
+        updates = []
+        for rel_path, entry in walk_files(root):
+            try:
+                stat = entry.stat(follow_symlinks=False)
+                row = known.get(rel_path)
+                if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+                    sha256 = row[2]
+                else:
+                    sha256 = transfer.hash_file(entry.path)
+                    updates.append((root, rel_path, stat.st_size, stat.st_mtime_ns, sha256))
+            except OSError:
+                continue
+            manifest[rel_path] = (stat.st_size, sha256)
+
+        removed = [(root, path) for path in known.keys() - manifest.keys()]
+        if updates or removed:
+            with self.lock, self.db:
+                self.db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)', updates)
+                self.db.executemany('DELETE FROM files WHERE root = ? AND path = ?', removed)
+        return manifest
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def manifest_digest(manifest):
+    # One hash over the whole manifest; equal digests mean nothing to do
+    digest = hashlib.sha256()
+    for path in sorted(manifest):
+        size, sha256 = manifest[path]
+        digest.update(f"{path}\0{size}\0{sha256}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def diff_manifests(local, remote):
+    # Returns (paths to send, paths to delete on the remote side)
+    changed = sorted(path for path, entry in local.items()
+                     if tuple(remote.get(path) or ()) != tuple(entry))
+    deleted = sorted(remote.keys() - local.keys())
+    return changed, deleted
+
+
+def remove_files(root, rel_paths):
+    # Apply deletions carried over from the sender, pruning emptied folders
+    removed = 0
+    for rel_path in rel_paths:
+        try:
+            path = transfer.safe_join(root, rel_path)
+            if os.path.isfile(path):
+                os.unlink(path)
+                removed += 1
+            parent = os.path.dirname(path)
+            while os.path.normcase(parent) != os.path.normcase(root) and not os.listdir(parent):
+                os.rmdir(parent)
+                parent = os.path.dirname(parent)
+        except (OSError, ValueError) as e:
+            print(f"Failed to delete {rel_path}: {e}")
+    return removed
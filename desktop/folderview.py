@@ -0,0 +1,382 @@
+# Listing of the sync folder for the Files tab, kept off the Tk thread. A
+# watcher thread scans the folder once with os.scandir and then follows
+# changes: inotify on Linux, elsewhere a cheap poll of the folder's mtime
+# plus a periodic rescan. Only changed names are re-stat'ed and reported.
+# FolderView holds the sorted, filtered rows the tree displays.
+import bisect
+import ctypes
+import ctypes.util
+import os
+import select
+import stat
+import struct
+import sys
+import threading
+import time
+
+# Changes arriving within this window are reported as one batch
+BATCH_DELAY = 0.2
+
+# Polling fallback: folder mtime check interval, and full rescan interval
+# for in-place modifications the folder mtime does not reflect
+POLL_INTERVAL = 2.0
+RESCAN_INTERVAL = 30.0
+
+
+class FileEntry:
+    __slots__ = ('name', 'size', 'mtime', 'folded')
+
+    def __init__(self, name, size, mtime):
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+        self.folded = name.casefold()
+
+    def same(self, other):
+        return other is not None and self.size == other.size and self.mtime == other.mtime
+
+
+def visible(name):
+    # Part files of transfers in progress and other dotfiles stay hidden
+    return not name.startswith('.')
+
+
+def stat_entry(folder, name):
+    # FileEntry for one name, or None if it is gone or not a regular file
+    try:
+        info = os.stat(os.path.join(folder, name))
+    except OSError:
+        return None
+    if not stat.S_ISREG(info.st_mode):
+        return None
+    return FileEntry(name, info.st_size, info.st_mtime)
+
+
+def scan(folder):
+    entries = {}
+    try:
+        with os.scandir(folder) as iterator:
+            for entry in iterator:
+                if not visible(entry.name):
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    info = entry.stat()  # cached by scandir on Windows
+                except OSError:
+                    continue
+                entries[entry.name] = FileEntry(entry.name, info.st_size, info.st_mtime)
+    except OSError as e:
+        print(f"Error listing {folder}: {e}")
+    return entries
+
+
+class InotifySource:
+    # Names changed in one directory, from the Linux inotify API
+    IN_MODIFY = 0x002
+    IN_ATTRIB = 0x004
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, folder):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = (self.IN_MODIFY | self.IN_ATTRIB | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO |
+                self.IN_CREATE | self.IN_DELETE | self.IN_DELETE_SELF | self.IN_MOVE_SELF)
+        if libc.inotify_add_watch(self.fd, os.fsencode(folder), mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, f"Cannot watch {folder}")
+
+    def wait(self, timeout):
+        # Set of changed names, None when everything must be rescanned, or
+        # an empty set after timeout
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+        names = set()
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            if mask & (self.IN_Q_OVERFLOW | self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                return None
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if name:
+                names.add(os.fsdecode(name))
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollSource:
+    # Fallback: reports a rescan when the folder's mtime moves (files added,
+    # removed or renamed) and every RESCAN_INTERVAL regardless
+    def __init__(self, folder):
+        self.folder = folder
+        self.mtime = self.folder_mtime()
+        self.last_scan = time.monotonic()
+
+    def folder_mtime(self):
+        try:
+            return os.stat(self.folder).st_mtime_ns
+        except OSError:
+            return None
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, POLL_INTERVAL))
+        mtime = self.folder_mtime()
+        if mtime != self.mtime or time.monotonic() - self.last_scan >= RESCAN_INTERVAL:
+            self.mtime = mtime
+            self.last_scan = time.monotonic()
+            return None
+        return set()
+
+    def close(self):
+        pass
+
+
+def change_source(folder):
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifySource(folder)
+        except (OSError, AttributeError) as e:
+            print(f"Folder notifications unavailable, polling instead: {e}")
+    return PollSource(folder)
+
+
+class FolderWatcher:
+    # Calls on_change(folder, changed, removed, reset) from its own thread.
+    # changed maps names to FileEntry; reset means the entries replace
+    # everything reported before (first scan, folder switch, overflow).
+    def __init__(self, folder, on_change):
+        self.folder = folder
+        self.on_change = on_change
+        self.entries = {}
+        self.pending = set()  # names to re-stat, from notify()
+        self.rescan_requested = True
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='folder-watcher', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+
+    def set_folder(self, folder):
+        with self.lock:
+            if folder == self.folder:
+                return
+            self.folder = folder
+            self.rescan_requested = True
+        self.wakeup.set()
+
+    def rescan(self):
+        with self.lock:
+            self.rescan_requested = True
+        self.wakeup.set()
+
+    def notify(self, path):
+        # A file the app itself wrote; picked up without waiting for the
+        # next poll. Safe to call from any thread.
+        folder, name = os.path.split(path)
+        with self.lock:
+            if os.path.normpath(folder) != os.path.normpath(self.folder):
+                return
+            self.pending.add(name)
+        self.wakeup.set()
+
+    def run(self):
+        source = None
+        folder = None
+        while not self.stopped:
+            with self.lock:
+                reset = self.rescan_requested or self.folder != folder
+                self.rescan_requested = False
+                names, self.pending = self.pending, set()
+                if self.folder != folder:
+                    folder = self.folder
+                    if source is not None:
+                        source.close()
+                    source = None
+
+            if source is None and os.path.isdir(folder):
+                source = change_source(folder)
+            if reset:
+                self.full_scan(folder, report_reset=True)
+            elif names:
+                self.restat(folder, names)
+
+            if source is None:
+                self.wakeup.wait(POLL_INTERVAL)
+                self.wakeup.clear()
+                continue
+            changed = self.wait_for_changes(source)
+            if changed is None:
+                self.full_scan(folder, report_reset=False)
+            elif changed:
+                self.restat(folder, changed)
+        if source is not None:
+            source.close()
+
+    def wait_for_changes(self, source):
+        # Blocks until something changed, then collects the rest of the
+        # burst for BATCH_DELAY. Returns names, or None for a rescan.
+        while not self.stopped and not self.wakeup.is_set():
+            changed = source.wait(0.5)
+            if changed is None or changed:
+                break
+        else:
+            self.wakeup.clear()
+            return set()
+        deadline = time.monotonic() + BATCH_DELAY
+        while changed is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            more = source.wait(remaining)
+            if more is None:
+                changed = None
+            else:
+                changed |= more
+        return changed
+
+    def full_scan(self, folder, report_reset):
+        entries = scan(folder)
+        if report_reset:
+            self.entries = entries
+            self.on_change(folder, dict(entries), [], True)
+            return
+        # Report only the difference to what was listed before
+        changed = {name: entry for name, entry in entries.items() if not entry.same(self.entries.get(name))}
+        removed = [name for name in self.entries if name not in entries]
+        self.entries = entries
+        if changed or removed:
+            self.on_change(folder, changed, removed, False)
+
+    def restat(self, folder, names):
+        changed = {}
+        removed = []
+        for name in names:
+            if not visible(name):
+                continue
+            entry = stat_entry(folder, name)
+            if entry is None:
+                if self.entries.pop(name, None) is not None:
+                    removed.append(name)
+            elif not entry.same(self.entries.get(name)):
+                self.entries[name] = entry
+                changed[name] = entry
+        if changed or removed:
+            self.on_change(folder, changed, removed, False)
+
+
+# Every key ends in the exact name, so keys are unique: rows never fall
+# back to comparing entries, and bisect finds the one row for a name
+SORT_KEYS = {
+    'name': lambda entry: (entry.folded, entry.name),
+    'size': lambda entry: (entry.size, entry.folded, entry.name),
+    'modified': lambda entry: (entry.mtime, entry.folded, entry.name),
+}
+
+
+class FolderView:
+    # The rows the tree shows: entries sorted by one column and filtered by
+    # a case-insensitive substring. Small batches of changes are applied
+    # with bisect, so a received file does not re-sort 100k rows.
+    REBUILD_THRESHOLD = 256
+
+    def __init__(self):
+        self.entries = {}
+        self.sort_column = 'name'
+        self.reverse = False
+        self.filter_text = ''
+        self.keys = {}  # name -> sort key currently in rows
+        self.rows = []  # sorted [(key, entry)] passing the filter
+
+    def __len__(self):
+        return len(self.rows)
+
+    def row(self, index):
+        if self.reverse:
+            index = len(self.rows) - 1 - index
+        return self.rows[index][1]
+
+    def index_of(self, name):
+        key = self.keys.get(name)
+        if key is None:
+            return None
+        index = bisect.bisect_left(self.rows, (key,))
+        return len(self.rows) - 1 - index if self.reverse else index
+
+    def matches(self, entry):
+        return not self.filter_text or self.filter_text in entry.folded
+
+    def rebuild(self):
+        sort_key = SORT_KEYS[self.sort_column]
+        self.keys = {}
+        rows = []
+        for entry in self.entries.values():
+            if self.matches(entry):
+                key = sort_key(entry)
+                self.keys[entry.name] = key
+                rows.append((key, entry))
+        rows.sort()
+        self.rows = rows
+
+    def set_sort(self, column, reverse):
+        if column != self.sort_column:
+            self.sort_column = column
+            self.reverse = reverse
+            self.rebuild()
+        else:
+            self.reverse = reverse  # same order, read backwards
+
+    def set_filter(self, text):
+        self.filter_text = text.casefold()
+        self.rebuild()
+
+    def apply(self, changed, removed, reset):
+        if reset:
+            self.entries = dict(changed)
+            self.rebuild()
+            return
+        for name in removed:
+            self.entries.pop(name, None)
+        self.entries.update(changed)
+        if len(changed) + len(removed) > self.REBUILD_THRESHOLD:
+            self.rebuild()
+            return
+        sort_key = SORT_KEYS[self.sort_column]
+        for name in list(removed) + list(changed):
+            key = self.keys.pop(name, None)
+            if key is not None:
+                index = bisect.bisect_left(self.rows, (key,))
+                del self.rows[index]
+        for entry in changed.values():
+            if self.matches(entry):
+                key = sort_key(entry)
+                self.keys[entry.name] = key
+                self.rows.insert(bisect.bisect_left(self.rows, (key,)), (key, entry))
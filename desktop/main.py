@@ -1,71 +1,91 @@
+import time
+STARTED = time.perf_counter()  # launch time, for the startup figures
+
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, scrolledtext
-import socket
-import threading
-import json
-import qrcode
-from PIL import Image, ImageTk
-import pyperclip
-import os
-import time
 import base64
-from datetime import datetime
-import hashlib
+import importlib.util
+import os
+import threading
+
+import discovery
+import engine
+import filetree
+import folderview
+import metrics
+import qrimage
+import thumbcache
+import transfer
+import transferqueue
+import uibus
+from server import MAX_STREAMS
 
-class SyncDesktopApp:
+# Diagnostics tab refresh interval while it is showing
+DIAGNOSTICS_REFRESH_MS = 1000
+
+# Transfer queue refresh interval while a job is running, for speed and ETA
+QUEUE_REFRESH_MS = 500
+
+# After the window is shown, the QR code for the default address is rendered
+# in the background so the first server start does not wait for it
+QR_PREPARE_DELAY_MS = 500
+
+class SyncDesktopApp(engine.Listener):
+    # Tk front end of a SyncEngine; engine events arrive on the network
+    # thread and are handed to the Tk thread, coalesced, through a UiBus
     def __init__(self):
         self.root = tk.Tk()
         self.root.title("Desktop Sync App")
         self.root.geometry("800x600")
         self.root.configure(bg='#f0f0f0')
-        
-        # Configuration
-        self.config_file = "sync_config.json"
-        self.default_folder = os.path.join(os.path.expanduser("~"), "Downloads", "sync-files")
-        self.config = self.load_config()
-        
-        # Network variables
-        self.server_socket = None
-        self.client_socket = None
-        self.is_server_running = False
-        self.connected_device = None
-        self.server_thread = None
-        
-        # Ensure sync folder exists
-        os.makedirs(self.config['sync_folder'], exist_ok=True)
+        self.bus = uibus.UiBus(self.root)
+        
+        # Configuration, networking and clipboard sync
+        self.engine = engine.SyncEngine(clipboard=engine.SystemClipboard(), listener=self)
+        self.config = self.engine.config
+        self.server_address = None
+        self.target_session_ids = []
+        self.queue_refresh_job = None
+        self.qr_cache = qrimage.QrCache()
+        self.qr_requested = None
+        self.transfers = {}  # (session id, name) -> (done, total) of transfers in flight
+        self.error_backlog = []
+        self.showing_errors = False
+        self.thumbnails = thumbcache.ThumbnailCache(
+            on_ready=lambda key: self.bus.collect('thumbnails', self.thumbnails_ready, key))
+        self.preview_key = None
+        self.preview_photo = None
         
         # Clipboard monitoring
-        self.last_clipboard = ""
         self.clipboard_enabled = tk.BooleanVar(value=True)
+        self.clipboard_enabled.trace_add(
+            'write', lambda *args: self.engine.set_clipboard_enabled(self.clipboard_enabled.get()))
         
         self.setup_ui()
-        self.start_clipboard_monitor()
-        
-    def load_config(self):
-        default_config = {
-            'sync_folder': self.default_folder,
-            'port': 8888,
-            'auto_accept_files': False
-        }
-        
-        try:
-            if os.path.exists(self.config_file):
-                with open(self.config_file, 'r') as f:
-                    config = json.load(f)
-                    # Ensure all default keys exist
-                    for key, value in default_config.items():
-                        if key not in config:
-                            config[key] = value
-                    return config
-        except:
-            pass
-        
-        return default_config
+        self.root.bind('<Map>', self.on_first_map)
+    
+    def on_first_map(self, event):
+        # Children's <Map> events reach this binding too
+        if event.widget is not self.root:
+            return
+        self.root.unbind('<Map>')
+        elapsed = time.perf_counter() - STARTED
+        metrics.observe('startup_seconds', elapsed, phase='window')
+        print(f"Window shown {elapsed * 1000:.0f} ms after launch")
+        if self.engine.identity_ready.is_set():
+            # Loaded before the main loop ran, when its event could not be posted
+            self.show_identity(self.engine.fingerprint)
+        self.root.after(QR_PREPARE_DELAY_MS, self.prepare_qr_code)
+    
+    def prepare_qr_code(self):
+        if self.server_address is None:
+            addresses = discovery.lan_addresses()
+            self.qr_cache.request(engine.pairing_info(addresses[0], self.config['port'], self.engine.fingerprint,
+                                                      addresses))
     
     def save_config(self):
         try:
-            with open(self.config_file, 'w') as f:
-                json.dump(self.config, f, indent=2)
+            self.engine.save_config()
         except Exception as e:
             messagebox.showerror("Error", f"Failed to save configuration: {e}")
     
@@ -82,6 +102,9 @@ class SyncDesktopApp:
         
         # Settings Tab
         self.setup_settings_tab(notebook)
+        
+        # Diagnostics Tab
+        self.setup_diagnostics_tab(notebook)
     
     def setup_connection_tab(self, notebook):
         conn_frame = ttk.Frame(notebook)
@@ -117,6 +140,10 @@ class SyncDesktopApp:
         self.qr_label = ttk.Label(qr_frame, text="Start server to generate QR code")
         self.qr_label.pack(expand=True)
         
+        # Lets the user check the pairing on the phone; the app pins this certificate
+        self.fingerprint_label = ttk.Label(qr_frame, text="Preparing encryption...")
+        self.fingerprint_label.pack()
+        
         # Clipboard section
         clip_frame = ttk.LabelFrame(conn_frame, text="Clipboard Sync", padding=10)
         clip_frame.pack(fill='x', padx=10, pady=5)
@@ -147,6 +174,16 @@ class SyncDesktopApp:
         ttk.Button(transfer_frame, text="Send Folder", 
                   command=self.send_folder).pack(side='left', padx=5)
         
+        ttk.Button(transfer_frame, text="Sync Folder", 
+                  command=self.sync_folder).pack(side='left', padx=5)
+        
+        # Target device when several are connected
+        ttk.Label(transfer_frame, text="Send to:").pack(side='left', padx=5)
+        self.target_var = tk.StringVar(value="All devices")
+        self.target_combo = ttk.Combobox(transfer_frame, textvariable=self.target_var,
+                                         values=["All devices"], state='readonly', width=30)
+        self.target_combo.pack(side='left', padx=5)
+        
         # Progress bar
         self.progress_var = tk.DoubleVar()
         self.progress_bar = ttk.Progressbar(transfer_frame, variable=self.progress_var, 
@@ -156,26 +193,65 @@ class SyncDesktopApp:
         self.progress_label = ttk.Label(transfer_frame, text="")
         self.progress_label.pack()
         
+        # Transfer queue; persists across restarts
+        queue_frame = ttk.LabelFrame(files_frame, text="Transfer Queue", padding=10)
+        queue_frame.pack(fill='x', padx=10, pady=5)
+        
+        self.queue_tree = ttk.Treeview(queue_frame, columns=('state', 'progress', 'speed', 'eta'),
+                                       show='tree headings', height=5)
+        self.queue_tree.heading('#0', text='Name')
+        self.queue_tree.heading('state', text='State')
+        self.queue_tree.heading('progress', text='Progress')
+        self.queue_tree.heading('speed', text='Speed')
+        self.queue_tree.heading('eta', text='ETA')
+        for column in ('state', 'progress', 'speed', 'eta'):
+            self.queue_tree.column(column, width=90, stretch=False)
+        self.queue_tree.pack(side='left', fill='x', expand=True)
+        
+        queue_buttons = ttk.Frame(queue_frame)
+        queue_buttons.pack(side='right', fill='y', padx=5)
+        ttk.Button(queue_buttons, text="Cancel", command=self.cancel_jobs).pack(fill='x', pady=2)
+        ttk.Button(queue_buttons, text="Retry", command=self.retry_jobs).pack(fill='x', pady=2)
+        ttk.Button(queue_buttons, text="Clear Finished", command=self.clear_finished_jobs).pack(fill='x', pady=2)
+        
         # File list section
         list_frame = ttk.LabelFrame(files_frame, text="Sync Folder Contents", padding=10)
         list_frame.pack(fill='both', expand=True, padx=10, pady=5)
         
-        # Treeview for file list
-        self.file_tree = ttk.Treeview(list_frame, columns=('size', 'modified'), show='tree headings')
-        self.file_tree.heading('#0', text='Name')
-        self.file_tree.heading('size', text='Size')
-        self.file_tree.heading('modified', text='Modified')
-        
-        scrollbar = ttk.Scrollbar(list_frame, orient='vertical', command=self.file_tree.yview)
-        self.file_tree.configure(yscrollcommand=scrollbar.set)
-        
-        self.file_tree.pack(side='left', fill='both', expand=True)
-        scrollbar.pack(side='right', fill='y')
+        # Filter and file count; the list itself fills in from a background scan
+        filter_frame = ttk.Frame(list_frame)
+        filter_frame.pack(fill='x', pady=(0, 5))
+        ttk.Label(filter_frame, text="Filter:").pack(side='left', padx=5)
+        self.filter_var = tk.StringVar()
+        self.filter_var.trace_add('write', lambda *args: self.file_tree.set_filter(self.filter_var.get()))
+        ttk.Entry(filter_frame, textvariable=self.filter_var, width=30).pack(side='left', padx=5)
+        self.file_count_label = ttk.Label(filter_frame, text="Scanning...")
+        self.file_count_label.pack(side='left', padx=5)
         
         # Refresh button
-        ttk.Button(list_frame, text="Refresh", command=self.refresh_file_list).pack(pady=5)
-        
-        self.refresh_file_list()
+        ttk.Button(filter_frame, text="Refresh", command=self.refresh_file_list).pack(side='right', padx=5)
+        
+        # Preview of the focused file: a larger image, or the head of a text file
+        preview_frame = ttk.Frame(list_frame, width=thumbcache.BOXES[thumbcache.PREVIEW] + 20)
+        preview_frame.pack(side='right', fill='y', padx=(5, 0))
+        preview_frame.pack_propagate(False)
+        self.preview_label = ttk.Label(preview_frame, text="Select a file to preview", anchor='center',
+                                       compound='top', wraplength=thumbcache.BOXES[thumbcache.PREVIEW])
+        self.preview_label.pack(fill='x')
+        self.preview_text = scrolledtext.ScrolledText(preview_frame, wrap='none', font=('Courier', 9))
+        
+        # Only the rows on screen exist in the Treeview; click a heading to sort
+        self.file_tree = filetree.VirtualFileTree(list_frame, self.config['sync_folder'], self.thumbnails)
+        self.file_tree.pack(fill='both', expand=True)
+        self.file_tree.bind('<<ListChanged>>', lambda event: self.update_file_count())
+        self.file_tree.tree.bind('<<TreeviewSelect>>', self.show_preview, add='+')
+        
+        self.folder_watcher = folderview.FolderWatcher(
+            self.config['sync_folder'],
+            lambda *change: self.bus.collect('folder', self.apply_folder_batches, change))
+        self.folder_watcher.start()
+        
+        self.refresh_queue()
     
     def setup_settings_tab(self, notebook):
         settings_frame = ttk.Frame(notebook)
@@ -204,6 +280,37 @@ class SyncDesktopApp:
         port_entry = ttk.Entry(port_frame, textvariable=self.port_var, width=10)
         port_entry.pack(side='left', padx=5)
         
+        # Connections per device for large transfers; 1 disables striping
+        ttk.Label(port_frame, text="Parallel streams:").pack(side='left', padx=5)
+        self.streams_var = tk.StringVar(value=str(self.config['parallel_streams']))
+        ttk.Spinbox(port_frame, from_=1, to=MAX_STREAMS, textvariable=self.streams_var,
+                    width=5).pack(side='left', padx=5)
+        
+        # Transfer queue limits
+        queue_frame = ttk.LabelFrame(settings_frame, text="Transfer Queue", padding=10)
+        queue_frame.pack(fill='x', padx=10, pady=5)
+        
+        ttk.Label(queue_frame, text="Concurrent transfers:").pack(side='left', padx=5)
+        self.concurrent_var = tk.StringVar(value=str(self.config['concurrent_transfers']))
+        ttk.Spinbox(queue_frame, from_=1, to=8, textvariable=self.concurrent_var,
+                    width=5).pack(side='left', padx=5)
+        
+        # Keeps syncing from saturating the hotspot
+        ttk.Label(queue_frame, text="Upload limit (KB/s, 0 = none):").pack(side='left', padx=5)
+        self.bandwidth_var = tk.StringVar(value=str(self.config['bandwidth_limit']))
+        ttk.Entry(queue_frame, textvariable=self.bandwidth_var, width=8).pack(side='left', padx=5)
+        
+        # Plaintext is still accepted by default for apps that predate TLS
+        self.require_encryption_var = tk.BooleanVar(value=self.config['require_encryption'])
+        self.require_encryption_check = ttk.Checkbutton(port_frame, text="Require encrypted connections",
+                                                        variable=self.require_encryption_var, state='disabled')
+        self.require_encryption_check.pack(anchor='w', pady=5)
+        
+        # Lets paired phones find this computer again after its address changes
+        self.discovery_var = tk.BooleanVar(value=self.config['discovery'])
+        ttk.Checkbutton(port_frame, text="Announce this computer on the local network",
+                        variable=self.discovery_var).pack(anchor='w', pady=5)
+        
         # Auto-accept files
         ttk.Checkbutton(port_frame, text="Auto-accept incoming files", 
                        variable=tk.BooleanVar(value=self.config['auto_accept_files'])).pack(anchor='w', pady=5)
@@ -212,298 +319,431 @@ class SyncDesktopApp:
         ttk.Button(settings_frame, text="Save Settings", 
                   command=self.save_settings).pack(pady=10)
     
-    def get_local_ip(self):
-        try:
-            # Connect to a remote address to determine local IP
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.connect(("8.8.8.8", 80))
-            ip = s.getsockname()[0]
-            s.close()
-            return ip
-        except:
-            return "127.0.0.1"
-    
-    def generate_qr_code(self, ip, port):
-        connection_info = {
-            "ip": ip,
-            "port": port,
-            "device_name": socket.gethostname(),
-            "timestamp": int(time.time())
-        }
-        
-        qr_data = json.dumps(connection_info)
-        
-        qr = qrcode.QRCode(version=1, box_size=10, border=5)
-        qr.add_data(qr_data)
-        qr.make(fit=True)
-        
-        qr_image = qr.make_image(fill_color="black", back_color="white")
-        qr_image = qr_image.resize((300, 300), Image.Resampling.LANCZOS)
-        
-        # Convert to PhotoImage for tkinter
-        photo = ImageTk.PhotoImage(qr_image)
-        self.qr_label.configure(image=photo)
+    def setup_diagnostics_tab(self, notebook):
+        self.notebook = notebook
+        self.diagnostics_frame = ttk.Frame(notebook)
+        notebook.add(self.diagnostics_frame, text="Diagnostics")
+        
+        control_frame = ttk.Frame(self.diagnostics_frame)
+        control_frame.pack(fill='x', padx=10, pady=5)
+        
+        ttk.Button(control_frame, text="Export JSON", 
+                  command=lambda: self.export_metrics('.json')).pack(side='left', padx=5)
+        
+        ttk.Button(control_frame, text="Export Prometheus", 
+                  command=lambda: self.export_metrics('.prom')).pack(side='left', padx=5)
+        
+        # Sampling profiler for finding where CPU goes under load; off by default
+        self.profiler_btn = ttk.Button(control_frame, text="Start Profiler", 
+                                      command=self.toggle_profiler)
+        self.profiler_btn.pack(side='left', padx=5)
+        
+        ttk.Button(control_frame, text="Save Profile", 
+                  command=self.save_profile).pack(side='left', padx=5)
+        
+        self.diagnostics_text = scrolledtext.ScrolledText(self.diagnostics_frame, font=('Courier', 9),
+                                                          state='disabled')
+        self.diagnostics_text.pack(fill='both', expand=True, padx=10, pady=5)
+        
+        self.refresh_diagnostics()
+    
+    def refresh_diagnostics(self):
+        # Only redrawn while the tab is showing
+        if self.notebook.select() == str(self.diagnostics_frame):
+            text = metrics.format_snapshot(self.engine.metrics_snapshot())
+            if self.engine.profiler is not None:
+                text += "\n\nProfile\n" + self.engine.profiler.format_top()
+            position = self.diagnostics_text.yview()[0]
+            self.diagnostics_text.configure(state='normal')
+            self.diagnostics_text.delete('1.0', 'end')
+            self.diagnostics_text.insert('1.0', text)
+            self.diagnostics_text.configure(state='disabled')
+            self.diagnostics_text.yview_moveto(position)
+        self.root.after(DIAGNOSTICS_REFRESH_MS, self.refresh_diagnostics)
+    
+    def export_metrics(self, extension):
+        file_path = filedialog.asksaveasfilename(defaultextension=extension,
+                                                 initialfile=f"syncapp-metrics{extension}")
+        if file_path:
+            try:
+                metrics.write_snapshot(self.engine.metrics_snapshot(), file_path)
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to export metrics: {e}")
+    
+    def toggle_profiler(self):
+        if self.engine.profiler is not None and self.engine.profiler.running:
+            self.engine.stop_profiler()
+            self.profiler_btn.configure(text="Start Profiler")
+        else:
+            self.engine.start_profiler()
+            self.profiler_btn.configure(text="Stop Profiler")
+    
+    def save_profile(self):
+        profiler = self.engine.profiler
+        if profiler is None or not profiler.samples:
+            messagebox.showinfo("Profiler", "Start the profiler and run a transfer first")
+            return
+        # Collapsed stacks, readable by flamegraph.pl and speedscope
+        file_path = filedialog.asksaveasfilename(defaultextension='.txt', initialfile="syncapp-profile.txt")
+        if file_path:
+            try:
+                profiler.write_collapsed(file_path)
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to save profile: {e}")
+    
+    def generate_qr_code(self):
+        # Shown at once when cached, otherwise rendered on a worker thread
+        self.qr_requested = time.perf_counter()
+        info = self.engine.pairing_info()
+        png = self.qr_cache.request(
+            info, lambda info, png, error: self.bus.call(self.show_qr_code, info, png, error))
+        if png is not None:
+            self.show_qr_code(info, png, None)
+        else:
+            self.qr_label.configure(image='', text="Generating QR code...")
+    
+    def show_qr_code(self, info, png, error):
+        if self.server_address is None or qrimage.cache_key(info) != qrimage.cache_key(self.engine.pairing_info()):
+            return  # the server stopped or moved meanwhile
+        if png is None:
+            self.qr_label.configure(image='', text=f"QR code unavailable: {error}")
+            return
+        photo = tk.PhotoImage(data=base64.b64encode(png), format='png')
+        self.qr_label.configure(image=photo, text='')
         self.qr_label.image = photo  # Keep a reference
+        elapsed = time.perf_counter() - self.qr_requested
+        metrics.observe('startup_seconds', elapsed, phase='qr')
+        print(f"QR code shown {elapsed * 1000:.0f} ms after server start")
     
     def start_server(self):
         try:
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            
-            ip = self.get_local_ip()
-            port = int(self.port_var.get())
-            
-            self.server_socket.bind((ip, port))
-            self.server_socket.listen(1)
-            
-            self.is_server_running = True
-            self.server_thread = threading.Thread(target=self.accept_connections)
-            self.server_thread.daemon = True
-            self.server_thread.start()
+            self.server_address = self.engine.start(port=int(self.port_var.get()))
             
             self.status_label.configure(text="Server Running", foreground="green")
-            self.device_label.configure(text=f"Listening on {ip}:{port}")
+            self.device_label.configure(text=self.listening_text())
             
             self.start_btn.configure(state='disabled')
             self.stop_btn.configure(state='normal')
             
             # Generate QR code
-            self.generate_qr_code(ip, port)
+            self.generate_qr_code()
             
         except Exception as e:
             messagebox.showerror("Error", f"Failed to start server: {e}")
     
     def stop_server(self):
-        self.is_server_running = False
-        
-        if self.server_socket:
-            self.server_socket.close()
-            self.server_socket = None
-        
-        if self.client_socket:
-            self.client_socket.close()
-            self.client_socket = None
+        self.engine.stop()
+        self.server_address = None
         
         self.status_label.configure(text="Not Connected", foreground="red")
         self.device_label.configure(text="")
-        self.connected_device = None
+        self.update_target_devices()
         
         self.start_btn.configure(state='normal')
         self.stop_btn.configure(state='disabled')
         
         self.qr_label.configure(image='', text="Start server to generate QR code")
     
-    def accept_connections(self):
-        while self.is_server_running:
-            try:
-                client_socket, address = self.server_socket.accept()
-                self.client_socket = client_socket
-                
-                # Receive device info
-                data = client_socket.recv(1024).decode('utf-8')
-                device_info = json.loads(data)
-                self.connected_device = device_info.get('device_name', 'Unknown Device')
-                
-                self.root.after(0, self.update_connection_status)
-                
-                # Start message handler
-                threading.Thread(target=self.handle_messages, daemon=True).start()
-                break
-                
-            except Exception as e:
-                if self.is_server_running:
-                    print(f"Connection error: {e}")
-                break
+    # Engine events; these run on the network loop thread. Anything that
+    # can arrive per chunk or per file is coalesced by the bus.
+    
+    def on_session_opened(self, session):
+        self.bus.latest('connection', self.update_connection_status)
+    
+    def on_session_closed(self, session):
+        self.bus.latest('connection', self.update_connection_status)
+    
+    def on_transfer_progress(self, session, name, done, total):
+        # total is 0 while receiving a folder archive whose size is not known yet
+        if total:
+            self.bus.merge('progress', self.show_progress, (session.id, name), (done, total))
+    
+    def on_file_received(self, session, file_path):
+        self.bus.collect('received', self.show_received, file_path)
+        self.folder_watcher.notify(file_path)
+    
+    def on_transfer_error(self, session, name, error):
+        self.bus.merge('progress', self.show_progress, (session.id, name), (0, 0))
+        self.bus.collect('errors', self.show_errors, f"Transfer of {name} failed: {error}")
+    
+    def on_queue_changed(self, job):
+        self.bus.latest('queue', self.restart_queue_refresh)
+    
+    def on_addresses_changed(self, addresses):
+        self.bus.latest('addresses', self.refresh_addresses)
+    
+    def on_identity_ready(self, fingerprint):
+        self.bus.latest('identity', self.show_identity, fingerprint)
+    
+    def on_job_finished(self, job):
+        if job.state == transferqueue.FAILED:
+            self.bus.collect('errors', self.show_errors, f"Failed to send {job.name}: {job.error}")
+            return
+        if job.state != transferqueue.DONE:
+            return
+        if job.kind == 'sync':
+            for summary in job.reports:
+                print(f"Synced {job.name}: {summary['sent']}/{summary['files']} files sent, "
+                      f"{summary['deleted']} deleted, {transfer.format_report(summary)}")
+            summary = job.reports[0]
+            text = (f"Synced {job.name}: {summary['sent']} of {summary['files']} files sent, "
+                    f"{summary['deleted']} deleted")
+        else:
+            for report in job.reports:
+                print(f"Sent {job.name}: {transfer.format_report(report)}")
+            text = f"Sent {job.name} to {len(job.reports)} device(s) ({transfer.format_report(job.reports[0])})"
+        self.bus.latest('status', self.set_status, text)
+    
+    def on_folder_synced(self, session, folder, summary):
+        self.bus.latest('status', self.set_status,
+                        f"{folder} synced from {session.device_name}: "
+                        f"{summary['received']} updated, {summary['deleted']} deleted")
+        self.folder_watcher.rescan()
+    
+    # Bus callbacks; these run on the Tk thread
+    
+    def set_status(self, text):
+        self.progress_label.configure(text=text)
+    
+    def show_progress(self, updates):
+        # One bar for all transfers in flight; finished and failed ones drop out
+        for key, (done, total) in updates.items():
+            if done < total:
+                self.transfers[key] = (done, total)
+            else:
+                self.transfers.pop(key, None)
+        if self.transfers:
+            self.progress_var.set(sum(done for done, _ in self.transfers.values()) * 100 /
+                                  sum(total for _, total in self.transfers.values()))
+        elif any(total for _, total in updates.values()):
+            self.progress_var.set(100)
+    
+    def show_received(self, paths):
+        # A notice per frame rather than a dialog per file
+        name = os.path.basename(paths[-1])
+        self.set_status(f"Received {name}" if len(paths) == 1 else f"Received {len(paths)} files, last {name}")
+    
+    def show_errors(self, errors):
+        # Errors that arrive while the dialog is open are shown after it
+        self.error_backlog.extend(errors)
+        if self.showing_errors:
+            return
+        self.showing_errors = True
+        try:
+            while self.error_backlog:
+                errors, self.error_backlog = self.error_backlog, []
+                text = "\n".join(errors[:10])
+                if len(errors) > 10:
+                    text += f"\n...and {len(errors) - 10} more"
+                messagebox.showerror("Error", text)
+        finally:
+            self.showing_errors = False
     
     def update_connection_status(self):
-        self.status_label.configure(text="Connected", foreground="blue")
-        self.device_label.configure(text=f"Connected to: {self.connected_device}")
+        if not self.engine.is_running:
+            return
+        
+        sessions = self.engine.sessions()
+        connected = {session.id for session in sessions}
+        gone = [key for key in self.transfers if key[0] not in connected]
+        if gone:
+            self.show_progress({key: (0, 0) for key in gone})
+        if sessions:
+            names = ", ".join(session.device_name + (" (encrypted)" if session.link.encrypted else "")
+                              for session in sessions)
+            self.status_label.configure(text=f"Connected ({len(sessions)})", foreground="blue")
+            self.device_label.configure(text=f"Connected to: {names}")
+        else:
+            self.status_label.configure(text="Server Running", foreground="green")
+            self.device_label.configure(text=self.listening_text())
+        self.update_target_devices()
     
-    def handle_messages(self):
-        while self.is_server_running and self.client_socket:
-            try:
-                # Receive message length first
-                length_data = self.client_socket.recv(4)
-                if not length_data:
-                    break
-                
-                message_length = int.from_bytes(length_data, byteorder='big')
-                
-                # Receive the actual message
-                message_data = b''
-                while len(message_data) < message_length:
-                    chunk = self.client_socket.recv(min(4096, message_length - len(message_data)))
-                    if not chunk:
-                        break
-                    message_data += chunk
-                
-                if len(message_data) == message_length:
-                    message = json.loads(message_data.decode('utf-8'))
-                    self.process_message(message)
-                
-            except Exception as e:
-                print(f"Message handling error: {e}")
-                break
+    def listening_text(self):
+        ip, port = self.server_address
+        others = self.engine.addresses[1:]
+        return f"Listening on {ip}:{port}" + (f" (also {', '.join(others)})" if others else "")
     
-    def process_message(self, message):
-        msg_type = message.get('type')
-        
-        if msg_type == 'clipboard':
-            if self.clipboard_enabled.get():
-                pyperclip.copy(message['data'])
-                print("Clipboard updated from mobile device")
-        
-        elif msg_type == 'file':
-            self.receive_file(message)
-        
-        elif msg_type == 'clipboard_request':
-            self.send_clipboard()
+    def show_identity(self, fingerprint):
+        # The certificate is loaded: show it, allow requiring encryption and
+        # put its fingerprint into the QR code
+        self.fingerprint_label.configure(text=f"Certificate SHA-256: {fingerprint[:32]}..." if fingerprint
+                                         else "Encryption unavailable: connections are not encrypted")
+        self.require_encryption_check.configure(state='normal' if fingerprint else 'disabled')
+        if self.server_address is not None:
+            self.generate_qr_code()
+        else:
+            self.prepare_qr_code()
     
-    def send_message(self, message):
-        if self.client_socket:
-            try:
-                message_data = json.dumps(message).encode('utf-8')
-                length_data = len(message_data).to_bytes(4, byteorder='big')
-                self.client_socket.send(length_data + message_data)
-                return True
-            except Exception as e:
-                print(f"Failed to send message: {e}")
-                return False
-        return False
-    
-    def start_clipboard_monitor(self):
-        def monitor():
-            while True:
-                try:
-                    if self.clipboard_enabled.get() and self.client_socket:
-                        current_clipboard = pyperclip.paste()
-                        if current_clipboard != self.last_clipboard and current_clipboard.strip():
-                            self.last_clipboard = current_clipboard
-                            self.send_message({
-                                'type': 'clipboard',
-                                'data': current_clipboard
-                            })
-                except:
-                    pass
-                time.sleep(1)
-        
-        threading.Thread(target=monitor, daemon=True).start()
+    def refresh_addresses(self):
+        # The hotspot came up or moved: new address in the status and QR code
+        if not self.engine.is_running:
+            return
+        self.server_address = self.engine.address
+        self.update_connection_status()
+        self.generate_qr_code()
+    
+    def update_target_devices(self):
+        sessions = self.engine.sessions()
+        self.target_session_ids = [session.id for session in sessions]
+        labels = [f"{session.device_name} ({session.address[0]})" for session in sessions]
+        self.target_combo.configure(values=["All devices"] + labels)
+        if self.target_var.get() not in labels:
+            self.target_var.set("All devices")
+    
+    def selected_session_ids(self):
+        # None means every connected device
+        index = self.target_combo.current()
+        if index <= 0 or index > len(self.target_session_ids):
+            return None
+        return {self.target_session_ids[index - 1]}
     
     def send_clipboard(self):
+        # Reading the clipboard, and encoding an image on it, can take a
+        # moment; the result comes back through the bus
+        threading.Thread(target=self.send_clipboard_in_background, daemon=True).start()
+    
+    def send_clipboard_in_background(self):
         try:
-            clipboard_data = pyperclip.paste()
-            if clipboard_data:
-                self.send_message({
-                    'type': 'clipboard',
-                    'data': clipboard_data
-                })
-                messagebox.showinfo("Success", "Clipboard sent to mobile device")
+            if self.engine.send_clipboard():
+                self.bus.call(messagebox.showinfo, "Success", "Clipboard sent to mobile device")
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to send clipboard: {e}")
+            self.bus.collect('errors', self.show_errors, f"Failed to send clipboard: {e}")
     
     def request_clipboard(self):
-        self.send_message({'type': 'clipboard_request'})
+        self.engine.request_clipboard()
     
     def send_file(self):
         file_path = filedialog.askopenfilename()
         if file_path:
-            threading.Thread(target=self._send_file, args=(file_path,), daemon=True).start()
+            self.queue_transfer(self.engine.queue_file, file_path, None, self.selected_session_ids())
     
     def send_folder(self):
+        # The folder is zipped on the fly; compression runs in worker
+        # processes while earlier parts of the archive are already on the wire
         folder_path = filedialog.askdirectory()
         if folder_path:
-            threading.Thread(target=self._send_folder, args=(folder_path,), daemon=True).start()
+            self.queue_transfer(self.engine.queue_folder, folder_path, self.selected_session_ids())
     
-    def _send_file(self, file_path):
-        try:
-            file_size = os.path.getsize(file_path)
-            file_name = os.path.basename(file_path)
-            
-            self.root.after(0, lambda: self.progress_label.configure(text=f"Sending {file_name}..."))
-            
-            with open(file_path, 'rb') as f:
-                file_data = base64.b64encode(f.read()).decode('utf-8')
-            
-            message = {
-                'type': 'file',
-                'name': file_name,
-                'size': file_size,
-                'data': file_data
-            }
-            
-            if self.send_message(message):
-                self.root.after(0, lambda: self.progress_label.configure(text=f"Sent {file_name}"))
-            else:
-                self.root.after(0, lambda: self.progress_label.configure(text="Failed to send file"))
-                
-        except Exception as e:
-            self.root.after(0, lambda: messagebox.showerror("Error", f"Failed to send file: {e}"))
+    def sync_folder(self):
+        # Only new and changed files go over the wire; unchanged files are
+        # recognised from the content index without re-hashing
+        folder_path = filedialog.askdirectory()
+        if folder_path:
+            self.queue_transfer(self.engine.queue_sync, folder_path, self.selected_session_ids())
     
-    def _send_folder(self, folder_path):
-        # Implementation for sending entire folder (zip it first)
-        import zipfile
-        import tempfile
-        
+    def queue_transfer(self, queue_method, *args):
         try:
-            folder_name = os.path.basename(folder_path)
-            
-            with tempfile.NamedTemporaryFile(suffix='.zip', delete=False) as tmp_file:
-                with zipfile.ZipFile(tmp_file.name, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                    for root, dirs, files in os.walk(folder_path):
-                        for file in files:
-                            file_path = os.path.join(root, file)
-                            arcname = os.path.relpath(file_path, folder_path)
-                            zipf.write(file_path, arcname)
-                
-                self._send_file(tmp_file.name)
-                os.unlink(tmp_file.name)
-                
+            job = queue_method(*args)
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to send folder: {e}")
+            messagebox.showerror("Error", f"Failed to queue transfer: {e}")
+            return
+        waiting = "" if self.engine.job_ready(job) else ", waiting for a device"
+        self.progress_label.configure(text=f"Queued {job.name}{waiting}")
     
-    def receive_file(self, message):
-        try:
-            file_name = message['name']
-            file_data = base64.b64decode(message['data'])
-            
-            # Save to sync folder
-            file_path = os.path.join(self.config['sync_folder'], file_name)
-            
-            # Handle duplicate names
-            counter = 1
-            original_path = file_path
-            while os.path.exists(file_path):
-                name, ext = os.path.splitext(original_path)
-                file_path = f"{name}_{counter}{ext}"
-                counter += 1
-            
-            with open(file_path, 'wb') as f:
-                f.write(file_data)
-            
-            self.root.after(0, lambda: messagebox.showinfo("File Received", 
-                                                          f"Received: {os.path.basename(file_path)}"))
-            self.root.after(0, self.refresh_file_list)
-            
-        except Exception as e:
-            self.root.after(0, lambda: messagebox.showerror("Error", f"Failed to receive file: {e}"))
+    def refresh_queue(self):
+        # Rows are updated in place; the queue holds at most a few dozen jobs
+        self.queue_refresh_job = None
+        jobs = self.engine.queue.snapshot()
+        rows = set(self.queue_tree.get_children())
+        running = False
+        for job in jobs:
+            iid = str(job.id)
+            progress = ""
+            if job.size and job.state == transferqueue.RUNNING:
+                progress = f"{min(job.done, job.size) * 100 / job.size:.0f}%"
+            elif job.state == transferqueue.DONE:
+                progress = "100%"
+            speed = transferqueue.format_rate(job.rate()) if job.state == transferqueue.RUNNING else ""
+            values = (job.state, progress, speed, transferqueue.format_eta(job.eta()))
+            if iid in rows:
+                rows.discard(iid)
+                self.queue_tree.item(iid, values=values)
+            else:
+                self.queue_tree.insert('', 'end', iid=iid, text=job.name, values=values)
+            running = running or job.state == transferqueue.RUNNING
+        for iid in rows:
+            self.queue_tree.delete(iid)
+        if running:
+            self.queue_refresh_job = self.root.after(QUEUE_REFRESH_MS, self.refresh_queue)
+    
+    def restart_queue_refresh(self):
+        if self.queue_refresh_job is not None:
+            self.root.after_cancel(self.queue_refresh_job)
+        self.refresh_queue()
+    
+    def cancel_jobs(self):
+        for iid in self.queue_tree.selection():
+            self.engine.queue.cancel(int(iid))
+    
+    def retry_jobs(self):
+        for iid in self.queue_tree.selection():
+            self.engine.queue.retry(int(iid))
+    
+    def clear_finished_jobs(self):
+        self.engine.queue.clear_finished()
+        self.restart_queue_refresh()
     
     def refresh_file_list(self):
-        # Clear existing items
-        for item in self.file_tree.get_children():
-            self.file_tree.delete(item)
-        
-        try:
-            sync_folder = self.config['sync_folder']
-            if os.path.exists(sync_folder):
-                for item in os.listdir(sync_folder):
-                    item_path = os.path.join(sync_folder, item)
-                    if os.path.isfile(item_path):
-                        stat = os.stat(item_path)
-                        size = f"{stat.st_size / 1024:.1f} KB"
-                        modified = datetime.fromtimestamp(stat.st_mtime).strftime("%Y-%m-%d %H:%M")
-                        self.file_tree.insert('', 'end', text=item, values=(size, modified))
-        except Exception as e:
-            print(f"Error refreshing file list: {e}")
+        # The watcher keeps the list current; this forces a full rescan
+        self.folder_watcher.rescan()
+    
+    def apply_folder_batches(self, batches):
+        for change in batches:
+            self.apply_folder_changes(*change)
+    
+    def apply_folder_changes(self, folder, changed, removed, reset):
+        # A late batch from a folder we have since switched away from
+        if os.path.normpath(folder) != os.path.normpath(self.config['sync_folder']):
+            return
+        self.file_tree.apply(changed, removed, reset)
+    
+    def thumbnails_ready(self, keys):
+        self.file_tree.thumbnails_ready(keys)
+        if self.preview_key in keys:
+            self.show_preview()
+    
+    def show_preview(self, event=None):
+        entry = self.file_tree.focused_entry()
+        kind = thumbcache.preview_kind(entry.name) if entry is not None else None
+        if kind is None:
+            self.preview_key = None
+            self.set_preview(entry.name if entry is not None else "Select a file to preview")
+            return
+        path = os.path.join(self.config['sync_folder'], entry.name)
+        result = thumbcache.PREVIEW if kind == 'image' else thumbcache.TEXT
+        key, data = self.thumbnails.request(path, entry.size, entry.mtime, result)
+        if key == self.preview_key and data is None:
+            return  # still on its way
+        self.preview_key = key
+        if data is None:
+            self.set_preview(f"{entry.name}\n\n" + ("Loading preview..." if self.thumbnails.available(result)
+                                                      else "Install Pillow for image previews"))
+        elif not data:
+            self.set_preview(f"{entry.name}\n\nNo preview")
+        elif kind == 'image':
+            try:
+                photo = tk.PhotoImage(data=base64.b64encode(data), format='png')
+            except tk.TclError:
+                photo = None
+            self.set_preview(entry.name, photo=photo)
+        else:
+            self.set_preview(entry.name, text=data.decode('utf-8', 'replace'))
+    
+    def set_preview(self, caption, photo=None, text=None):
+        self.preview_photo = photo  # Tk drops images nothing in Python refers to
+        self.preview_label.configure(text=caption, image=photo or '')
+        if text is None:
+            self.preview_text.pack_forget()
+            return
+        self.preview_text.configure(state='normal')
+        self.preview_text.delete('1.0', tk.END)
+        self.preview_text.insert('1.0', text)
+        self.preview_text.configure(state='disabled')
+        self.preview_text.pack(fill='both', expand=True, pady=(5, 0))
+    
+    def update_file_count(self):
+        shown, total = len(self.file_tree), len(self.file_tree.view.entries)
+        self.file_count_label.configure(text=f"{shown} of {total} files" if shown != total else f"{total} files")
     
     def browse_folder(self):
         folder = filedialog.askdirectory(initialdir=self.folder_var.get())
@@ -522,15 +762,26 @@ class SyncDesktopApp:
         try:
             self.config['sync_folder'] = self.folder_var.get()
             self.config['port'] = int(self.port_var.get())
+            # Applies to devices that connect from now on
+            self.engine.set_streams(self.streams_var.get())
+            self.streams_var.set(str(self.config['parallel_streams']))
+            self.engine.set_concurrent_transfers(self.concurrent_var.get())
+            self.concurrent_var.set(str(self.config['concurrent_transfers']))
+            self.engine.set_bandwidth_limit(self.bandwidth_var.get())
+            self.bandwidth_var.set(str(self.config['bandwidth_limit']))
+            self.engine.set_require_encryption(self.require_encryption_var.get())
+            self.engine.set_discovery(self.discovery_var.get())
             
             # Create new sync folder if it doesn't exist
             os.makedirs(self.config['sync_folder'], exist_ok=True)
+            self.folder_watcher.set_folder(self.config['sync_folder'])
+            self.file_tree.set_folder(self.config['sync_folder'])
             
             self.save_config()
             messagebox.showinfo("Success", "Settings saved successfully!")
             
         except ValueError:
-            messagebox.showerror("Error", "Port must be a valid number")
+            messagebox.showerror("Error", "Port, parallel streams and transfer limits must be valid numbers")
         except Exception as e:
             messagebox.showerror("Error", f"Failed to save settings: {e}")
     
@@ -538,19 +789,21 @@ class SyncDesktopApp:
         try:
             self.root.mainloop()
         finally:
-            self.stop_server()
+            self.bus.close()
+            self.thumbnails.close()
+            self.folder_watcher.stop()
+            self.engine.close()
 
 if __name__ == "__main__":
-    # Install required packages if not present
-    try:
-        import qrcode
-        from PIL import Image, ImageTk
-        import pyperclip
-    except ImportError as e:
-        print(f"Missing required package: {e}")
+    # Check required packages without importing them; they load when first used
+    missing = [name for name in ('qrcode', 'pyperclip') if importlib.util.find_spec(name) is None]
+    if missing:
+        print(f"Missing required package: {', '.join(missing)}")
         print("Please install required packages:")
-        print("pip install qrcode[pil] pillow pyperclip")
+        print("pip install qrcode pyperclip")
         exit(1)
-    
+    if importlib.util.find_spec('PIL') is None:
+        print("Pillow not installed; images on the clipboard are not synced (pip install pillow)")
+
     app = SyncDesktopApp()
     app.run()
\ No newline at end of file
@@ -0,0 +1,370 @@
+# Process-wide transfer metrics and an opt-in sampling profiler. Recording
+# is a lock plus a dict update, cheap enough to call per chunk. Snapshots
+# are plain dicts that the Diagnostics tab formats, and that can be written
+# out as JSON or in the Prometheus text exposition format.
+import bisect
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
+# Histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Finished transfers kept for the Diagnostics tab
+RECENT_TRANSFERS = 50
+
+PROMETHEUS_PREFIX = 'syncapp_'
+
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class StageTimer:
+    # with REGISTRY.stage('hash'): ... adds the elapsed time to stage_seconds
+    __slots__ = ('registry', 'labels', 'start')
+
+    def __init__(self, registry, labels):
+        self.registry = registry
+        self.labels = labels
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.registry.observe_labels('stage_seconds', self.labels, time.perf_counter() - self.start)
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.transfers = collections.deque(maxlen=RECENT_TRANSFERS)
+        self.started = time.time()
+
+    def add(self, name, value=1, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        self.observe_labels(name, label_key(labels), value)
+
+    def observe_labels(self, name, labels, value):
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def stage(self, name):
+        return StageTimer(self, (('stage', name),))
+
+    def record_transfer(self, direction, device, name, size, seconds, wire_bytes=None, ok=True):
+        self.add('transfers_total', direction=direction, result='ok' if ok else 'error')
+        if not ok:
+            return
+        self.observe('transfer_seconds', seconds, direction=direction)
+        with self.lock:
+            self.transfers.append({
+                'direction': direction,
+                'device': device,
+                'name': name,
+                'bytes': size,
+                'wire_bytes': size if wire_bytes is None else wire_bytes,
+                'seconds': seconds,
+                'mb_per_s': size / max(seconds, 1e-9) / (1024 ** 2),
+                'finished': time.time()
+            })
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.transfers.clear()
+            self.started = time.time()
+
+    def snapshot(self):
+        with self.lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            histograms = []
+            for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                cumulative = 0
+                buckets = []
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    buckets.append([bound, cumulative])
+                histograms.append({'name': name, 'labels': dict(labels), 'buckets': buckets,
+                                   'sum': histogram.sum, 'count': histogram.count})
+            return {
+                'time': time.time(),
+                'uptime_seconds': time.time() - self.started,
+                'counters': counters,
+                'histograms': histograms,
+                'gauges': [],
+                'transfers': list(self.transfers)
+            }
+
+
+REGISTRY = Registry()
+add = REGISTRY.add
+observe = REGISTRY.observe
+stage = REGISTRY.stage
+record_transfer = REGISTRY.record_transfer
+
+
+def counter_value(snapshot, name, **labels):
+    # Sum of a counter over every label set that includes labels
+    total = 0
+    for entry in snapshot['counters']:
+        if entry['name'] == name and all(entry['labels'].get(k) == v for k, v in labels.items()):
+            total += entry['value']
+    return total
+
+
+def quantile(histogram, fraction):
+    # Upper bound of the bucket holding the given fraction of observations
+    if not histogram['count']:
+        return 0.0
+    target = histogram['count'] * fraction
+    for bound, cumulative in histogram['buckets']:
+        if cumulative >= target:
+            return float('inf') if bound == '+Inf' else bound
+    return float('inf')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, extra=None):
+    items = list(labels.items()) + (extra or [])
+    if not items:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in items) + '}'
+
+
+def prometheus_text(snapshot):
+    lines = []
+    typed = set()
+
+    def declare(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} {kind}")
+
+    for entry in snapshot['counters']:
+        name = PROMETHEUS_PREFIX + entry['name']
+        declare(name, 'counter')
+        lines.append(f"{name}{_labels(entry['labels'])} {entry['value']}")
+    for entry in snapshot['gauges']:
+        name = PROMETHEUS_PREFIX + entry['name']
+        declare(name, 'gauge')
+        lines.append(f"{name}{_labels(entry['labels'])} {entry['value']}")
+    for entry in snapshot['histograms']:
+        name = PROMETHEUS_PREFIX + entry['name']
+        declare(name, 'histogram')
+        for bound, cumulative in entry['buckets']:
+            lines.append(f"{name}_bucket{_labels(entry['labels'], [('le', bound)])} {cumulative}")
+        lines.append(f"{name}_sum{_labels(entry['labels'])} {entry['sum']}")
+        lines.append(f"{name}_count{_labels(entry['labels'])} {entry['count']}")
+    return '\n'.join(lines) + '\n'
+
+
+def write_snapshot(snapshot, path):
+    # Prometheus text for *.prom (node exporter textfile collector), JSON
+    # otherwise. Written to a temporary file and renamed, so readers never
+    # see half a file.
+    if path.endswith('.prom'):
+        data = prometheus_text(snapshot)
+    else:
+        data = json.dumps(snapshot, indent=2, default=str)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+def format_snapshot(snapshot):
+    # Text for the Diagnostics tab and the daemon's console
+    megabyte = 1024 ** 2
+    lines = [
+        f"Uptime {snapshot['uptime_seconds']:.0f}s",
+        f"Sent {counter_value(snapshot, 'bytes_sent_total') / megabyte:.1f} MB in "
+        f"{counter_value(snapshot, 'frames_sent_total')} frames, received "
+        f"{counter_value(snapshot, 'bytes_received_total') / megabyte:.1f} MB in "
+        f"{counter_value(snapshot, 'frames_received_total')} frames",
+        f"Sessions opened {counter_value(snapshot, 'sessions_opened_total')}, "
+        f"reconnects {counter_value(snapshot, 'reconnects_total')}, "
+        f"transfers ok {counter_value(snapshot, 'transfers_total', result='ok')}, "
+        f"failed {counter_value(snapshot, 'transfers_total', result='error')}"
+    ]
+    for entry in snapshot['gauges']:
+        if entry['name'] == 'sessions_connected':
+            lines.append(f"Connected devices {entry['value']}")
+
+    lines.append("")
+    lines.append(f"{'stage':<14} {'count':>8} {'total s':>9} {'mean ms':>9} {'p99 ms':>9}")
+    for entry in snapshot['histograms']:
+        if entry['name'] != 'stage_seconds':
+            continue
+        mean = entry['sum'] / entry['count'] * 1000 if entry['count'] else 0.0
+        lines.append(f"{entry['labels'].get('stage', ''):<14} {entry['count']:>8} {entry['sum']:>9.2f} "
+                     f"{mean:>9.2f} {quantile(entry, 0.99) * 1000:>9.2f}")
+
+    lines.append("")
+    for entry in snapshot['histograms']:
+        if entry['name'] == 'ui_frame_seconds':
+            lines.append(f"UI: {counter_value(snapshot, 'ui_events_total')} events "
+                         f"({counter_value(snapshot, 'ui_events_coalesced_total')} coalesced) in {entry['count']} "
+                         f"frames, p99 frame <= {quantile(entry, 0.99) * 1000:.2f}ms")
+    for entry in snapshot['histograms']:
+        if entry['name'] == 'frame_latency_seconds':
+            lines.append(f"Frame latency ({entry['labels'].get('priority')}): "
+                         f"p50 <= {quantile(entry, 0.5) * 1000:.2f}ms, p99 <= {quantile(entry, 0.99) * 1000:.2f}ms, "
+                         f"{entry['count']} frames")
+
+    queues = snapshot.get('queues') or {}
+    if queues:
+        lines.append("")
+        for session_id, stats in queues.items():
+            lines.append(f"Send queue {stats.get('device', session_id)}: control {stats['control_queued']} "
+                         f"(max {stats['control_high_water']}), bulk {stats['bulk_queued']} "
+                         f"(max {stats['bulk_high_water']}), longest bulk wait {stats['bulk_max_wait_ms']:.1f}ms")
+
+    compression = snapshot.get('compression') or {}
+    if compression:
+        lines.append("")
+        for codec, stats in compression.items():
+            lines.append(f"Compression {codec}: ratio {stats['ratio']:.2f}, {stats['mb_per_cpu_s']:.0f} MB per CPU s, "
+                         f"{stats['compressed']} compressed, {stats['probed_raw'] + stats['incompressible']} raw")
+
+    if snapshot['transfers']:
+        lines.append("")
+        lines.append("Recent transfers")
+        for entry in reversed(snapshot['transfers']):
+            lines.append(f"  {entry['direction']:<8} {entry['name']:<32} {entry['bytes'] / megabyte:>9.1f} MB "
+                         f"{entry['mb_per_s']:>8.1f} MB/s  {entry['device']}")
+    return '\n'.join(lines)
+
+
+# Frames of threads that are waiting rather than working
+IDLE_FUNCTIONS = {
+    ('selectors.py', 'select'), ('threading.py', 'wait'), ('queue.py', 'get'),
+    ('socket.py', 'accept'), ('clipsync.py', 'wait'), ('thread.py', '_worker'),
+    ('process.py', '_worker'), ('connection.py', '_recv'), ('connection.py', 'wait')
+}
+
+
+class SamplingProfiler:
+    # Samples the Python stacks of every other thread at a fixed interval
+    # using sys._current_frames(); nothing is collected until start(). The
+    # counts can be read as the hottest functions or written as collapsed
+    # stacks for flame graph tools.
+    def __init__(self, interval=0.005, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = collections.Counter()
+        self.lock = threading.Lock()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = None
+        self.started = None
+        self.elapsed = 0.0
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self.stopped.clear()
+        self.started = time.perf_counter()
+        self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.elapsed += time.perf_counter() - self.started
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            sampled = []
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append((os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                if stack and stack[0] in IDLE_FUNCTIONS:
+                    continue
+                stack.append((names.get(ident, 'thread'), ''))
+                sampled.append(tuple(reversed(stack)))
+            with self.lock:
+                self.stacks.update(sampled)
+                self.samples += 1
+
+    def top(self, limit=20):
+        # [(function, self samples, inclusive samples)] by self samples
+        own = collections.Counter()
+        inclusive = collections.Counter()
+        with self.lock:
+            stacks = list(self.stacks.items())
+        for stack, count in stacks:
+            own[stack[-1]] += count
+            for frame in set(stack[1:]):
+                inclusive[frame] += count
+        result = []
+        for frame, count in own.most_common(limit):
+            file_name, name = frame
+            result.append((f"{name} ({file_name})", count, inclusive[frame]))
+        return result
+
+    def format_top(self, limit=20):
+        if not self.samples:
+            return "No profile samples"
+        lines = [f"{self.samples} samples every {self.interval * 1000:.0f}ms; busy threads only",
+                 f"{'self':>7} {'total':>7}  function"]
+        for function, own, inclusive in self.top(limit):
+            lines.append(f"{own:>7} {inclusive:>7}  {function}")
+        return '\n'.join(lines)
+
+    def write_collapsed(self, path):
+        # One "frame;frame;frame count" line per stack (flamegraph.pl, speedscope)
+        with self.lock:
+            stacks = self.stacks.most_common()
+        with open(path, 'w') as f:
+            for stack, count in stacks:
+                frames = [stack[0][0]] + [f"{name} ({file_name})" for file_name, name in stack[1:]]
+                f.write(f"{';'.join(frames)} {count}\n")
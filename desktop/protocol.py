@@ -0,0 +1,69 @@
+# Wire protocol shared by the desktop app and the mobile clients.
+#
+# Every frame starts with a 4-byte big-endian length word. Legacy frames carry
+# a UTF-8 JSON object. When the top bit of the length word is set the frame is
+# binary instead: a small header (flags, stream id) followed by raw payload
+# bytes. Binary frames are only sent to peers that advertised the matching
+# capability during the connection handshake.
+import json
+import struct
+
+LENGTH = struct.Struct('>I')
+BINARY_HEADER = struct.Struct('>BI')  # flags, stream id
+BINARY_FLAG = 0x80000000
+MAX_FRAME_SIZE = BINARY_FLAG - 1
+
+# Binary header flags
+FLAG_COMPRESSED = 0x01  # payload is compressed with the codec agreed in the handshake
+FLAG_MESSAGE = 0x02  # payload is a JSON message rather than stream data
+
+# Payload size of a single file chunk frame
+CHUNK_SIZE = 256 * 1024
+
+# Capabilities advertised in the handshake
+CAP_STREAM = 'stream'  # file_start / binary chunks / file_end
+CAP_RESUME = 'resume'  # file_accept / file_done replies, resume_request on reconnect
+CAP_DELTA = 'delta'  # signature_request / signatures / delta_start, delta_copy, delta_end / file_done
+CAP_FOLDER = 'folder'  # folder_sync_start / folder_manifest / folder_sync_end
+CAP_STRIPE = 'stripe'  # data channels, stripe_start / stripe_range / stripe_ack
+CAP_CLIPBOARD = 'clipboard'  # clipboard_start / binary chunks for large clipboard text
+CAP_COMPRESS = 'compress'  # FLAG_COMPRESSED frames; codecs offered as 'compression'
+CAP_KEEPALIVE = 'keepalive'  # answers ping with pong; silent peers are dropped
+CAP_CLIPBOARD_IMAGE = 'clipboard_image'  # clipboard_start with an image 'format', e.g. image/png
+
+CAPABILITIES = [CAP_STREAM, CAP_RESUME, CAP_DELTA, CAP_FOLDER, CAP_STRIPE, CAP_CLIPBOARD, CAP_COMPRESS,
+                CAP_KEEPALIVE, CAP_CLIPBOARD_IMAGE]
+
+
+def encode_message(message):
+    data = json.dumps(message).encode('utf-8')
+    return LENGTH.pack(len(data)) + data
+
+
+def decode_message(data):
+    return json.loads(bytes(data).decode('utf-8'))
+
+
+def encode_binary_header(stream_id, payload_size, flags=0):
+    # Length word plus binary header; the payload follows on the wire as-is
+    frame_size = BINARY_HEADER.size + payload_size
+    if frame_size > MAX_FRAME_SIZE:
+        raise ValueError(f"Binary frame too large: {payload_size} bytes")
+    return LENGTH.pack(frame_size | BINARY_FLAG) + BINARY_HEADER.pack(flags, stream_id)
+
+
+def encode_compressed_message(payload):
+    # A JSON message whose compressed bytes travel in a binary frame
+    return encode_binary_header(0, len(payload), FLAG_MESSAGE | FLAG_COMPRESSED) + payload
+
+
+def split_length(length_word):
+    # Returns (is_binary, frame_size) for a decoded length word
+    return bool(length_word & BINARY_FLAG), length_word & MAX_FRAME_SIZE
+
+
+def parse_handshake(data):
+    # Old clients send only device_name/platform; newer ones list capabilities
+    device_info = json.loads(data.decode('utf-8'))
+    capabilities = set(device_info.get('capabilities') or [])
+    return device_info, capabilities
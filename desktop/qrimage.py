@@ -0,0 +1,141 @@
+# Pairing QR codes for the Connection tab. Rendering imports the qrcode
+# package, so it runs on a worker thread rather than inside a button click.
+# Images are cached per pairing address, device and certificate, in memory
+# and on disk, so restarting the server (or the app) shows the code at once.
+# They are encoded as PNG directly, which Tk reads without Pillow.
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import threading
+import zlib
+
+CACHE_DIR = "sync_qr_cache"
+
+# Rendered images kept on disk; one per network/port the desktop has used
+CACHE_FILES = 16
+
+# Target width and height in pixels; modules are scaled by whole pixels
+SIZE = 300
+
+# Quiet zone around the code, in modules
+BORDER = 5
+
+
+def cache_key(info):
+    # The timestamp in pairing info does not change what the phone connects
+    # to. Addresses come as a list; the key must be hashable.
+    return (info['ip'], info['port'], info['device_name'], info.get('fingerprint'),
+            tuple(info.get('addresses') or ()))
+
+
+def encode_png(rows, width):
+    # 8-bit grayscale PNG from rows of `width` bytes
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    raw = b''.join(b'\0' + row for row in rows)  # filter type 0 per row
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, len(rows), 8, 0, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw, 6))
+            + chunk(b'IEND', b''))
+
+
+def matrix_png(matrix, size=SIZE):
+    # Scales each module to the same whole number of pixels, so the edges stay
+    # sharp, and centres the code on a white square of at least `size`
+    scale = max(1, size // len(matrix))
+    side = max(size, len(matrix) * scale)
+    margin = (side - len(matrix) * scale) // 2
+    blank = b'\xff' * side
+    rows = [blank] * margin
+    for line in matrix:
+        row = b''.join((b'\0' if dark else b'\xff') * scale for dark in line)
+        rows.extend([b'\xff' * margin + row + b'\xff' * (side - margin - len(row))] * scale)
+    rows.extend([blank] * (side - len(rows)))
+    return encode_png(rows, side)
+
+
+def render(data, size=SIZE):
+    import qrcode
+    qr = qrcode.QRCode(version=1, border=BORDER)
+    qr.add_data(data)
+    qr.make(fit=True)
+    return matrix_png(qr.get_matrix(), size)  # the matrix includes the border
+
+
+class QrCache:
+    def __init__(self, folder=CACHE_DIR):
+        self.folder = folder
+        self.images = {}  # key -> PNG bytes
+        self.waiting = {}  # key -> callbacks for a render in progress
+        self.lock = threading.Lock()
+
+    def path(self, key):
+        digest = hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.folder, f"qr-{digest}.png")
+
+    def cached(self, info):
+        # PNG bytes if this pairing was rendered before, else None
+        key = cache_key(info)
+        with self.lock:
+            png = self.images.get(key)
+        if png is not None:
+            return png
+        try:
+            with open(self.path(key), 'rb') as f:
+                png = f.read()
+        except OSError:
+            return None
+        with self.lock:
+            self.images[key] = png
+        return png
+
+    def request(self, info, callback=None):
+        # Returns the PNG when cached. Otherwise renders it on a worker thread
+        # and calls callback(info, png, error) there when done.
+        png = self.cached(info)
+        if png is not None:
+            return png
+        key = cache_key(info)
+        with self.lock:
+            callbacks = self.waiting.get(key)
+            if callbacks is not None:
+                if callback is not None:
+                    callbacks.append(callback)
+                return None
+            self.waiting[key] = [callback] if callback is not None else []
+        threading.Thread(target=self.generate, args=(key, info), name='qr-render', daemon=True).start()
+        return None
+
+    def generate(self, key, info):
+        png, error = None, None
+        try:
+            png = render(json.dumps(info))
+        except Exception as e:
+            error = e
+            print(f"Error generating QR code: {e}")
+        with self.lock:
+            if png is not None:
+                self.images[key] = png
+            callbacks = self.waiting.pop(key, [])
+        if png is not None:
+            self.store(key, png)
+        for callback in callbacks:
+            callback(info, png, error)
+
+    def store(self, key, png):
+        # Atomic write, then drop the oldest images beyond CACHE_FILES
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.folder, prefix='.qr-')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(png)
+            os.replace(temp_path, self.path(key))
+            images = sorted((entry.stat().st_mtime, entry.path) for entry in os.scandir(self.folder)
+                            if entry.name.startswith('qr-'))
+            for _, path in images[:-CACHE_FILES]:
+                os.unlink(path)
+        except OSError as e:
+            print(f"Error caching QR code: {e}")
@@ -0,0 +1,295 @@
+# Byte transport under a connection: plain TCP, or TLS through the stdlib
+# ssl module. asyncio's sock_* calls do not take SSL sockets, so TLS runs on
+# an SSLObject over memory BIOs, with the encrypted records moved by the same
+# sock_recv_into / sock_sendall calls the plain link uses.
+#
+# The desktop has a long-lived self-signed certificate (its identity). Its
+# SHA-256 fingerprint travels in the pairing QR code and clients pin it, so
+# no certificate authority is involved. Clients keep the TLS session from
+# their first connection and resume it when they reconnect or open data
+# channels, skipping the full key exchange.
+#
+# Records carrying file data are encrypted and decrypted on executor
+# threads (OpenSSL runs without the GIL), so bulk transfers to one device do
+# not hold up the loop that serves control and clipboard traffic for all of
+# them. Small records stay on the loop, where a thread hop would cost more
+# than the cipher.
+import asyncio
+import functools
+import hashlib
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+
+import metrics
+import transfer
+
+# Encrypted bytes read from the socket per call
+RECV_SIZE = 256 * 1024
+
+# Writes and reads at least this large are encrypted or decrypted off the loop
+OFFLOAD_SIZE = 64 * 1024
+
+# Certificates are generated valid for this long
+CERT_DAYS = 3650
+
+
+def is_client_hello(data):
+    # A TLS handshake record, as opposed to the JSON device handshake
+    return len(data) >= 3 and data[0] == 0x16 and data[1] == 0x03
+
+
+class PlainLink:
+    encrypted = False
+    resumed = False
+
+    def __init__(self, loop, sock):
+        self.loop = loop
+        self.sock = sock
+        # Bound straight to the loop's socket calls; no extra coroutine per read
+        self.recv_into = functools.partial(loop.sock_recv_into, sock)
+        self.recv = functools.partial(loop.sock_recv, sock)
+        self.sendall = functools.partial(loop.sock_sendall, sock)
+
+    async def send_range(self, f, offset, count, buffer):
+        await transfer.send_file_range(self.loop, self.sock, f, offset, count, buffer)
+
+
+class TlsLink:
+    encrypted = True
+
+    def __init__(self, loop, sock, context, server_side, session=None, initial=b''):
+        self.loop = loop
+        self.sock = sock
+        self.incoming = ssl.MemoryBIO()
+        self.outgoing = ssl.MemoryBIO()
+        if initial:
+            self.incoming.write(initial)  # bytes already read while sniffing the protocol
+        self.ssl = context.wrap_bio(self.incoming, self.outgoing, server_side=server_side, session=session)
+        self.recv_buffer = bytearray(RECV_SIZE)
+        self.send_lock = asyncio.Lock()  # records from reader and writer must not interleave
+        # The SSLObject is used from the loop and from executor threads, one at a time
+        self.crypto_lock = threading.Lock()
+
+    @property
+    def resumed(self):
+        return self.ssl.session_reused
+
+    @property
+    def session(self):
+        # For the client to resume with; only set once the server's ticket arrived
+        return self.ssl.session
+
+    async def fill(self):
+        count = await self.loop.sock_recv_into(self.sock, self.recv_buffer)
+        if not count:
+            raise ConnectionError("Connection closed by peer")
+        with self.crypto_lock:
+            self.incoming.write(memoryview(self.recv_buffer)[:count])
+
+    async def flush(self):
+        if self.outgoing.pending:
+            async with self.send_lock:
+                with self.crypto_lock:
+                    records = self.outgoing.read()
+                await self.loop.sock_sendall(self.sock, records)
+
+    async def handshake(self):
+        while True:
+            try:
+                self.ssl.do_handshake()
+                break
+            except ssl.SSLWantReadError:
+                await self.flush()
+                await self.fill()
+        await self.flush()
+        metrics.add('tls_handshakes_total', resumed=str(self.resumed).lower())
+
+    def verify(self, fingerprint):
+        # Client side: the server must present the certificate from the QR code
+        der = self.ssl.getpeercert(binary_form=True)
+        if der is None or hashlib.sha256(der).hexdigest() != fingerprint:
+            raise ssl.SSLError("Server certificate does not match the paired fingerprint")
+
+    def buffered(self):
+        # At least as many bytes as can be decrypted without another fill:
+        # plaintext left in OpenSSL plus the records behind it
+        with self.crypto_lock:
+            return self.ssl.pending() + self.incoming.pending
+
+    def decrypt(self, view):
+        # (bytes decrypted into view, whether the stream ended). Stops when
+        # the buffered records run out.
+        received = 0
+        with self.crypto_lock, metrics.stage('decrypt'):
+            try:
+                while received < len(view):
+                    count = self.ssl.read(len(view) - received, view[received:])
+                    if not count:
+                        return received, True
+                    received += count
+            except ssl.SSLWantReadError:
+                pass
+            except ssl.SSLZeroReturnError:
+                return received, True  # close_notify
+        return received, False
+
+    async def recv_into(self, view):
+        # Decrypts as much buffered data as fits before going back to the
+        # socket. Large views are read in full (FrameReader asks for exactly
+        # the payload still to come), so their records are decrypted in one
+        # executor call rather than a piece per socket read.
+        while True:
+            if len(view) >= OFFLOAD_SIZE:
+                while self.buffered() < len(view):
+                    await self.fill()
+                received, ended = await self.loop.run_in_executor(None, self.decrypt, view)
+            else:
+                received, ended = self.decrypt(view)
+            if ended:
+                return received
+            if self.outgoing.pending:
+                await self.flush()  # post-handshake messages, e.g. a key update
+            if received:
+                return received
+            await self.fill()
+
+    async def recv(self, size):
+        buffer = bytearray(size)
+        count = await self.recv_into(memoryview(buffer))
+        return bytes(buffer[:count])
+
+    def encrypt(self, data):
+        with self.crypto_lock, metrics.stage('encrypt'):
+            self.ssl.write(data)
+            return self.outgoing.read()
+
+    async def sendall(self, data):
+        async with self.send_lock:
+            if len(data) >= OFFLOAD_SIZE:
+                records = await self.loop.run_in_executor(None, self.encrypt, data)
+            else:
+                records = self.encrypt(data)
+            await self.loop.sock_sendall(self.sock, records)
+
+    def read_encrypted(self, f, view):
+        # Executor side of send_range: one buffer of the file, as records
+        with metrics.stage('read'):
+            read = f.readinto(view)
+        if not read:
+            raise EOFError("File shrank while sending")
+        return read, self.encrypt(view[:read])
+
+    async def send_range(self, f, offset, count, buffer):
+        # No sendfile through TLS: each buffer of the file is read and
+        # encrypted in one executor call
+        view = memoryview(buffer)
+        f.seek(offset)
+        while count:
+            async with self.send_lock:
+                read, records = await self.loop.run_in_executor(
+                    None, self.read_encrypted, f, view[:min(count, len(buffer))])
+                await self.loop.sock_sendall(self.sock, records)
+            count -= read
+
+
+def server_context(identity_path):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    # AES-GCM first: hardware accelerated on desktop CPUs and phones alike
+    context.set_ciphers('ECDHE+AESGCM:ECDHE+CHACHA20')
+    context.load_cert_chain(identity_path)
+    return context
+
+
+def client_context():
+    # Trust comes from the pinned fingerprint (TlsLink.verify), not a CA
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def generate_identity(path):
+    # Self-signed EC certificate and key in one PEM file, readable only by
+    # the owner. Uses the cryptography package when installed and the
+    # openssl command otherwise.
+    name = f"SyncApp {socket.gethostname()}"
+    try:
+        pem = generate_with_cryptography(name)
+    except ImportError:
+        pem = generate_with_openssl(name)
+    folder = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.identity-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(pem)
+        os.chmod(temp_path, 0o600)
+        os.replace(temp_path, path)
+    except Exception:
+        os.unlink(temp_path)
+        raise
+
+
+def generate_with_cryptography(name):
+    import datetime
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, name)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder().subject_name(subject).issuer_name(subject)
+            .public_key(key.public_key()).serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=CERT_DAYS))
+            .sign(key, hashes.SHA256()))
+    return (key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                              serialization.NoEncryption())
+            + cert.public_bytes(serialization.Encoding.PEM))
+
+
+def generate_with_openssl(name):
+    command = shutil.which('openssl')
+    if command is None:
+        raise RuntimeError("Neither the cryptography package nor the openssl command is available")
+    with tempfile.TemporaryDirectory() as folder:
+        key_path = os.path.join(folder, 'key.pem')
+        cert_path = os.path.join(folder, 'cert.pem')
+        subprocess.run([command, 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+                        '-nodes', '-days', str(CERT_DAYS), '-subj', f"/CN={name}",
+                        '-keyout', key_path, '-out', cert_path],
+                       check=True, capture_output=True)
+        with open(key_path, 'rb') as key, open(cert_path, 'rb') as cert:
+            return key.read() + cert.read()
+
+
+class Identity:
+    # The desktop's certificate, its fingerprint and the server context
+    def __init__(self, path):
+        self.path = path
+        self.context = server_context(path)
+        with open(path) as f:
+            pem = f.read()
+        start = pem.index('-----BEGIN CERTIFICATE-----')
+        end = pem.index('-----END CERTIFICATE-----') + len('-----END CERTIFICATE-----')
+        self.fingerprint = hashlib.sha256(ssl.PEM_cert_to_DER_cert(pem[start:end])).hexdigest()
+
+
+def load_identity(path):
+    # Creates the identity on first use; None when that is not possible,
+    # in which case only plaintext connections are offered
+    try:
+        if not os.path.exists(path):
+            generate_identity(path)
+        return Identity(path)
+    except Exception as e:
+        print(f"Encryption unavailable: {e}")
+        return None
@@ -0,0 +1,1659 @@
+# Asyncio connection manager. One event loop thread serves every connected
+# device; each device gets a Session with its own reader task, writer task
+# and send queue.
+import asyncio
+import base64
+import concurrent.futures
+import itertools
+import collections
+import hashlib
+import os
+import secrets
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import archive
+import delta
+import foldersync
+import metrics
+import protocol
+import securelink
+import transfer
+import wirecodec
+import workerpool
+
+HANDSHAKE_TIMEOUT = 10
+ACCEPT_TIMEOUT = 30
+SCAN_TIMEOUT = 600
+SEND_QUEUE_DEPTH = 16
+
+# Seconds stop() waits for archive workers to finish their current deflate
+# job once pending ones are cancelled; stragglers are then terminated
+POOL_SHUTDOWN_TIMEOUT = 5
+
+# Send priorities. Control frames (replies, acks, clipboard messages)
+# overtake queued bulk frames; anything whose order relative to a stream's
+# chunks matters (file_end, stripe_range, delta_copy) is queued as bulk with
+# the chunks. Chunks of large clipboards are bulk too, so a screenshot does
+# not hold up replies and pings.
+PRIORITY_CONTROL = 0
+PRIORITY_BULK = 1
+PRIORITY_NAMES = ('control', 'bulk')
+
+# Unsent bytes the kernel may hold per socket (Linux). Keeps the backlog in
+# our priority queue instead of the socket buffer, so a control frame waits
+# behind at most this much bulk data.
+NOTSENT_LOWAT = 128 * 1024
+
+# Striped transfers: files at least this large are split into ranges of
+# STRIPE_RANGE_SIZE spread over the session's data channels
+MAX_STREAMS = 8
+STRIPE_MIN_SIZE = 16 * 1024 * 1024
+STRIPE_RANGE_SIZE = 8 * 1024 * 1024
+
+# Clipboard text above this size goes out as binary chunks instead of one
+# JSON message, to peers that support it; images always do. Incoming
+# clipboards are capped at MAX_CLIPBOARD_SIZE
+CLIPBOARD_INLINE_LIMIT = 64 * 1024
+MAX_CLIPBOARD_SIZE = 64 * 1024 * 1024
+
+# Keepalives. A session quiet for KEEPALIVE_INTERVAL seconds is pinged, and
+# one that sent nothing at all for KEEPALIVE_TIMEOUT is closed, so a phone
+# that left the hotspot is dropped in seconds. Clients without the
+# keepalive capability are covered by TCP keepalives instead: probes after
+# TCP_KEEPIDLE idle seconds, every TCP_KEEPINTVL, dropped after
+# TCP_KEEPCNT unanswered; and unacknowledged data times out after
+# TCP_USER_TIMEOUT ms (Linux).
+KEEPALIVE_INTERVAL = 5
+KEEPALIVE_TIMEOUT = 15
+TCP_KEEPIDLE = 10
+TCP_KEEPINTVL = 3
+TCP_KEEPCNT = 3
+TCP_USER_TIMEOUT = 30000
+
+
+def enable_keepalive(sock):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    try:
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, TCP_KEEPIDLE)
+        elif hasattr(socket, 'TCP_KEEPALIVE'):  # macOS
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, TCP_KEEPIDLE)
+        if hasattr(socket, 'TCP_KEEPINTVL'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, TCP_KEEPINTVL)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, TCP_KEEPCNT)
+        elif hasattr(socket, 'SIO_KEEPALIVE_VALS'):  # Windows
+            sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, TCP_KEEPIDLE * 1000, TCP_KEEPINTVL * 1000))
+        if hasattr(socket, 'TCP_USER_TIMEOUT'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, TCP_USER_TIMEOUT)
+    except OSError as e:
+        print(f"Could not tune TCP keepalive: {e}")
+
+
+def pack_message(data, compressor):
+    # An encoded JSON message as a compressed frame when the session has a
+    # codec and it pays off, otherwise unchanged
+    if compressor is not None and len(data) >= wirecodec.MIN_COMPRESS_SIZE:
+        compressed, payload = compressor.pack(memoryview(data)[protocol.LENGTH.size:])
+        if compressed:
+            return protocol.encode_compressed_message(payload)
+    return data
+
+
+class OutgoingFrame:
+    # Queue entry for a session's writer task: raw frame bytes, optionally
+    # followed by a file range sent with sendfile.
+    __slots__ = ('data', 'file', 'offset', 'count', 'on_sent', 'queued_at', 'priority')
+
+    def __init__(self, data, file=None, offset=0, count=0, on_sent=None):
+        self.data = data
+        self.file = file
+        self.offset = offset
+        self.count = count
+        self.on_sent = on_sent
+        self.queued_at = 0.0
+        self.priority = PRIORITY_BULK
+
+
+class SendScheduler:
+    # Send queue of one connection: one FIFO per priority, drained highest
+    # priority first. Bulk producers block once SEND_QUEUE_DEPTH bulk frames
+    # are waiting; control frames never wait for room.
+    def __init__(self, loop, depth):
+        self.loop = loop
+        self.depth = depth
+        self.queues = (collections.deque(), collections.deque())
+        self.getter = None
+        self.putters = collections.deque()
+
+        # Observability: frames sent, deepest queue seen and longest wait
+        # between enqueue and the start of sending, per priority
+        self.sent = [0, 0]
+        self.high_water = [0, 0]
+        self.max_wait = [0.0, 0.0]
+
+    async def put(self, frame, priority):
+        queue = self.queues[priority]
+        while priority == PRIORITY_BULK and len(queue) >= self.depth:
+            waiter = self.loop.create_future()
+            self.putters.append(waiter)
+            await waiter
+        frame.queued_at = time.perf_counter()
+        frame.priority = priority
+        queue.append((priority, frame))
+        self.high_water[priority] = max(self.high_water[priority], len(queue))
+        if self.getter is not None and not self.getter.done():
+            self.getter.set_result(None)
+
+    def pop(self, queue):
+        priority, frame = queue.popleft()
+        if priority == PRIORITY_BULK:
+            self.wake_putter()
+        self.sent[priority] += 1
+        self.max_wait[priority] = max(self.max_wait[priority], time.perf_counter() - frame.queued_at)
+        return frame
+
+    async def get(self):
+        while True:
+            for queue in self.queues:
+                if queue:
+                    return self.pop(queue)
+            self.getter = self.loop.create_future()
+            await self.getter
+
+    async def get_control(self, deadline):
+        # The next control frame, or None once the loop clock reaches deadline
+        queue = self.queues[PRIORITY_CONTROL]
+        while not queue:
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                return None
+            self.getter = self.loop.create_future()
+            await asyncio.wait([self.getter], timeout=remaining)
+        return self.pop(queue)
+
+    def wake_putter(self):
+        while self.putters:
+            waiter = self.putters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    def clear(self):
+        # Drop everything queued and unblock producers waiting for room
+        for queue in self.queues:
+            queue.clear()
+        while self.putters:
+            self.wake_putter()
+
+    def stats(self):
+        return {
+            'control_queued': len(self.queues[PRIORITY_CONTROL]),
+            'bulk_queued': len(self.queues[PRIORITY_BULK]),
+            'control_sent': self.sent[PRIORITY_CONTROL],
+            'bulk_sent': self.sent[PRIORITY_BULK],
+            'control_high_water': self.high_water[PRIORITY_CONTROL],
+            'bulk_high_water': self.high_water[PRIORITY_BULK],
+            'control_max_wait_ms': self.max_wait[PRIORITY_CONTROL] * 1000,
+            'bulk_max_wait_ms': self.max_wait[PRIORITY_BULK] * 1000
+        }
+
+
+class StripedSend:
+    # Sender-side state of a striped transfer: ranges not yet sent, and sent
+    # ranges not yet acknowledged with the connection that carried them.
+    # Ranges on a connection that drops go back to pending for another one.
+    def __init__(self, file_size, range_size):
+        self.pending = collections.deque(
+            (offset, min(range_size, file_size - offset)) for offset in range(0, file_size, range_size))
+        self.unacked = {}
+        self.changed = asyncio.Event()
+        self.sent = 0
+        self.wire_bytes = 0
+
+    @property
+    def finished(self):
+        return not self.pending and not self.unacked
+
+    def take(self, lane):
+        offset, length = self.pending.popleft()
+        self.unacked[offset] = (lane, length)
+        return offset, length
+
+    def ack(self, offset):
+        entry = self.unacked.pop(offset, None)
+        if entry is None:
+            # Acknowledged after its connection was given up on
+            for pending in list(self.pending):
+                if pending[0] == offset:
+                    self.pending.remove(pending)
+        self.changed.set()
+
+    def lane_failed(self, lane):
+        for offset, (owner, length) in list(self.unacked.items()):
+            if owner is lane:
+                del self.unacked[offset]
+                self.pending.append((offset, length))
+        self.changed.set()
+
+
+class Connection:
+    # A socket with its own reader and writer tasks. Sessions are device
+    # connections; data channels are the extra connections a session opens
+    # for striped transfers.
+    def __init__(self, manager, sock, address, link=None):
+        self.manager = manager
+        self.loop = manager.loop
+        self.sock = sock
+        self.address = address
+        self.link = link or securelink.PlainLink(self.loop, sock)  # plain TCP or TLS
+        self.send_queue = SendScheduler(self.loop, SEND_QUEUE_DEPTH)
+        self.send_buffer = bytearray(protocol.CHUNK_SIZE)
+        self.ranges = {}  # stream id -> [incoming file, offset, bytes left, range start]
+        self.tasks = []
+        self.closed = False
+        self.disconnected = self.loop.create_future()
+        self.last_received = self.loop.time()
+
+    @property
+    def handler(self):
+        return self.manager.handler
+
+    async def read_loop(self):
+        compressor = self.session.compressor
+        reader = transfer.FrameReader(self.link.recv_into,
+                                      decompress=compressor.unpack if compressor is not None else None)
+        while not self.closed:
+            try:
+                kind, frame = await reader.read_frame()
+                self.last_received = self.loop.time()
+                metrics.add('bytes_received_total', reader.frame_size)
+                metrics.add('frames_received_total', kind=kind)
+                if kind == 'binary':
+                    flags, stream_id, payload_size = frame
+                    if stream_id in self.ranges:
+                        await self.receive_range(reader, stream_id, payload_size)
+                    else:
+                        await self.receive_chunk(reader, stream_id, payload_size)
+                else:
+                    await self.process_message(frame)
+            except (ConnectionError, OSError, asyncio.IncompleteReadError):
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Message handling error: {e}")
+                break
+
+    async def write_loop(self):
+        try:
+            while True:
+                frame = await self.send_queue.get()
+                if frame.priority == PRIORITY_BULK:
+                    # Bulk data is paced to the bandwidth cap; control frames
+                    # queued during the wait still go out immediately
+                    delay = self.manager.bandwidth.reserve(len(frame.data) + frame.count)
+                    if delay:
+                        deadline = self.loop.time() + delay
+                        while True:
+                            control = await self.send_queue.get_control(deadline)
+                            if control is None:
+                                break
+                            await self.send_frame(control)
+                await self.send_frame(frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Failed to send message: {e}")
+            self.close()
+
+    async def send_frame(self, frame):
+        with metrics.stage('send'):
+            await self.link.sendall(frame.data)
+            if frame.file is not None:
+                await self.link.send_range(frame.file, frame.offset, frame.count, self.send_buffer)
+        priority = PRIORITY_NAMES[frame.priority]
+        metrics.add('bytes_sent_total', len(frame.data) + frame.count)
+        metrics.add('frames_sent_total', priority=priority)
+        metrics.observe('frame_latency_seconds', time.perf_counter() - frame.queued_at, priority=priority)
+        if frame.on_sent is not None:
+            frame.on_sent()
+
+    async def enqueue(self, frame, priority=PRIORITY_BULK):
+        if self.closed:
+            raise ConnectionError(f"{self.session.device_name} disconnected")
+        await self.send_queue.put(frame, priority)
+
+    def encode(self, message):
+        return pack_message(protocol.encode_message(message), self.session.compressor)
+
+    async def send_message(self, message, priority=PRIORITY_CONTROL):
+        await self.enqueue(OutgoingFrame(self.encode(message)), priority)
+
+    async def enqueue_range(self, stream_id, f, offset, count, on_sent=None, compress=False):
+        # One binary frame carrying a file range. Sent from the page cache
+        # with sendfile, or, with compress set, read and compressed in the
+        # executor first. Returns the payload bytes put on the wire.
+        compressor = self.session.compressor
+        if compress and compressor is not None:
+            compressed, payload = await self.loop.run_in_executor(
+                None, compressor.pack_range, f.fileno(), offset, count)
+            flags = protocol.FLAG_COMPRESSED if compressed else 0
+            await self.enqueue(OutgoingFrame(
+                protocol.encode_binary_header(stream_id, len(payload), flags) + payload, on_sent=on_sent))
+            return len(payload)
+        await self.enqueue(OutgoingFrame(protocol.encode_binary_header(stream_id, count), f, offset, count, on_sent))
+        return count
+
+    async def send_frame_and_wait(self, frame, priority=PRIORITY_BULK):
+        # Resolves once the writer task has actually put the frame on the wire
+        sent = self.loop.create_future()
+        frame.on_sent = lambda: sent.done() or sent.set_result(None)
+        await self.enqueue(frame, priority)
+        await asyncio.wait([sent, self.disconnected], return_when=asyncio.FIRST_COMPLETED)
+        if not sent.done():
+            raise ConnectionError(f"{self.session.device_name} disconnected")
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.disconnected.set_result(None)
+        current = asyncio.current_task()
+        running = [task for task in self.tasks if task is not current and not task.done()]
+        for task in running:
+            task.cancel()
+        if running:
+            # A cancelled sock_recv_into or sock_sendall leaves its fd with the
+            # selector until the task unwinds; closing the socket first makes
+            # the loop unregister a dead fd
+            closing = self.loop.create_task(self.close_after(running))
+            self.manager.closing.add(closing)
+            closing.add_done_callback(self.manager.closing.discard)
+        else:
+            self.close_socket()
+
+        # Unblock producers waiting on a full queue; their next enqueue fails
+        self.send_queue.clear()
+        self.ranges.clear()
+
+    async def close_after(self, tasks):
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.close_socket()
+
+    def close_socket(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    def start_range(self, message):
+        # The binary frames that follow on this connection fill one byte
+        # range of a striped transfer
+        stream_id = message.get('transfer_id')
+        incoming = self.session.incoming_files.get(stream_id)
+        if incoming is None or not incoming.striped:
+            return
+        offset = int(message['offset'])
+        self.ranges[stream_id] = [incoming, offset, int(message['length']), offset]
+
+    async def receive_range(self, reader, stream_id, payload_size):
+        entry = self.ranges[stream_id]
+        incoming, offset, remaining, start = entry
+        await incoming.receive(reader, payload_size, offset)
+        entry[1] += payload_size
+        entry[2] -= payload_size
+        self.handler.on_transfer_progress(self.session, incoming.name, incoming.received, incoming.size)
+        if entry[2] <= 0:
+            del self.ranges[stream_id]
+            await self.session.send_message({'type': 'stripe_ack', 'transfer_id': stream_id, 'offset': start})
+
+
+class DataChannel(Connection):
+    # Extra connection of a session; carries stripe_range headers and their
+    # binary frames in both directions, nothing else
+    def __init__(self, session, sock, address, link=None):
+        super().__init__(session.manager, sock, address, link)
+        self.session = session
+
+    async def run(self):
+        self.tasks.append(self.loop.create_task(self.write_loop()))
+        try:
+            await self.read_loop()
+        finally:
+            self.close()
+
+    async def process_message(self, message):
+        if message.get('type') == 'stripe_range':
+            self.start_range(message)
+
+    async def receive_chunk(self, reader, stream_id, payload_size):
+        await reader.skip(payload_size)
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        if self in self.session.channels:
+            self.session.channels.remove(self)
+
+
+class Session(Connection):
+    def __init__(self, manager, session_id, sock, address, device_info, capabilities, link=None):
+        super().__init__(manager, sock, address, link)
+        self.session = self
+        self.id = session_id
+        self.device_info = device_info
+        self.device_name = device_info.get('device_name', 'Unknown Device')
+        self.capabilities = capabilities
+        self.stream_ids = itertools.count(1)
+        self.incoming_files = {}
+        self.pending_replies = {}
+        self.outgoing_stripes = {}
+        self.incoming_clipboards = {}  # stream id -> [buffer, bytes received, sha256, format]
+        self.clipboard_sha256 = None  # of the image last sent or received; None after text
+        self.clipboard_lock = asyncio.Lock()  # clipboards are queued one at a time, in order
+        self.clipboard_chunks = 0  # clipboard chunks queued and not sent yet
+        self.channels = []
+        self.streams = 1
+        self.channel_token = None
+        self.compressor = None
+        if protocol.CAP_COMPRESS in capabilities:
+            codec = wirecodec.negotiate(device_info.get('compression'))
+            if codec is not None:
+                self.compressor = wirecodec.WireCompressor(codec, manager.codec_stats)
+
+    @property
+    def device_key(self):
+        # Identifies the device across reconnects for resumable transfers
+        return str(self.device_info.get('device_id') or self.device_name)
+
+    async def run(self):
+        # Tell newer clients what we support; old clients ignore unknown types
+        hello = {
+            'type': 'hello',
+            'device_name': socket.gethostname(),
+            'capabilities': protocol.CAPABILITIES,
+            'keepalive': KEEPALIVE_INTERVAL  # clients may treat longer silence as a dead link
+        }
+        if protocol.CAP_STRIPE in self.capabilities:
+            # The client may open streams - 1 data channels next to this one
+            requested = int(self.device_info.get('max_streams') or self.manager.streams)
+            self.streams = max(1, min(requested, self.manager.streams, MAX_STREAMS))
+            if self.streams > 1:
+                self.channel_token = secrets.token_hex(16)
+                self.manager.channel_owners[self.channel_token] = self
+                hello['streams'] = self.streams
+                hello['channel_token'] = self.channel_token
+        if self.compressor is not None:
+            hello['compression'] = self.compressor.codec.name
+        # Never compressed: the peer learns the codec from it
+        await self.enqueue(OutgoingFrame(protocol.encode_message(hello)), PRIORITY_CONTROL)
+        metrics.add('sessions_opened_total')
+        if self.device_key in self.manager.known_devices:
+            metrics.add('reconnects_total')
+        self.manager.known_devices.add(self.device_key)
+        self.handler.on_session_opened(self)
+
+        writer = self.loop.create_task(self.write_loop())
+        self.tasks.append(writer)
+        if protocol.CAP_KEEPALIVE in self.capabilities:
+            self.tasks.append(self.loop.create_task(self.keepalive_loop()))
+        if protocol.CAP_RESUME in self.capabilities:
+            await self.request_resume()
+        try:
+            await self.read_loop()
+        finally:
+            self.close()
+
+    async def keepalive_loop(self):
+        # Any frame counts as a sign of life, so a busy session is never pinged
+        while not self.closed:
+            await asyncio.sleep(KEEPALIVE_INTERVAL)
+            silent = self.loop.time() - max([self.last_received] +
+                                            [channel.last_received for channel in self.channels])
+            if silent >= KEEPALIVE_TIMEOUT:
+                print(f"{self.device_name} stopped responding for {silent:.0f}s, disconnecting")
+                metrics.add('keepalive_timeouts_total')
+                self.close()
+                return
+            if silent >= KEEPALIVE_INTERVAL:
+                try:
+                    await self.send_message({'type': 'ping'})
+                except ConnectionError:
+                    return
+
+    async def process_message(self, message):
+        msg_type = message.get('type')
+
+        if msg_type == 'file':
+            await self.receive_inline_file(message)
+        elif msg_type == 'file_start':
+            await self.start_incoming_file(message)
+        elif msg_type == 'file_end':
+            await self.finish_incoming_file(message)
+        elif msg_type in ('file_accept', 'file_done', 'signatures', 'folder_manifest', 'folder_sync_done',
+                          'stripe_accept'):
+            reply = self.pending_replies.pop((msg_type, message.get('transfer_id')), None)
+            if reply is not None and not reply.done():
+                reply.set_result(message)
+        elif msg_type == 'signature_request':
+            self.loop.create_task(self.send_signatures(message))
+        elif msg_type == 'delta_start':
+            self.start_delta(message)
+        elif msg_type == 'delta_copy':
+            self.apply_delta_copy(message)
+        elif msg_type == 'delta_end':
+            await self.finish_incoming_file(message)
+        elif msg_type == 'folder_sync_start':
+            self.loop.create_task(self.send_manifest(message))
+        elif msg_type == 'folder_sync_end':
+            await self.finish_folder_sync(message)
+        elif msg_type == 'stripe_start':
+            await self.start_striped_file(message)
+        elif msg_type == 'stripe_range':
+            self.start_range(message)
+        elif msg_type == 'stripe_ack':
+            stripe = self.outgoing_stripes.get(message.get('transfer_id'))
+            if stripe is not None:
+                stripe.ack(message.get('offset'))
+        elif msg_type == 'clipboard_start':
+            self.start_incoming_clipboard(message)
+        elif msg_type == 'resume_request':
+            self.resume_outgoing(message.get('transfers') or [])
+        elif msg_type == 'ping':
+            await self.send_message({'type': 'pong'})
+        elif msg_type == 'pong':
+            pass  # last_received is all it is for
+        elif msg_type == 'clipboard':
+            self.clipboard_sha256 = None  # the device's clipboard holds text now
+            self.handler.on_message(self, message)
+        else:
+            self.handler.on_message(self, message)
+
+    # Outgoing files
+
+    async def send_file(self, file_path, file_name, extra=None, on_progress=None):
+        # extra carries additional header fields, e.g. the relative path and
+        # folder sync id of files sent by a folder sync. on_progress(session,
+        # done, total) follows this transfer alone, e.g. for its queue job.
+        extra = extra or {}
+        file_size = os.path.getsize(file_path)
+        meter = transfer.CpuMeter()
+        wire_bytes = None
+
+        def progress(done):
+            self.handler.on_transfer_progress(self, file_name, done, file_size)
+            if on_progress is not None:
+                on_progress(self, done, file_size)
+
+        try:
+            if protocol.CAP_DELTA in self.capabilities and file_size >= delta.MIN_DELTA_SIZE:
+                wire_bytes = await self.send_delta(file_path, file_name, file_size, extra, progress)
+            if wire_bytes is None:
+                if self.channels and file_size >= STRIPE_MIN_SIZE:
+                    wire_bytes = await self.send_striped(file_path, file_name, file_size, extra, progress)
+                elif protocol.CAP_STREAM in self.capabilities:
+                    wire_bytes = await self.stream_file(file_path, file_name, file_size, extra, progress)
+                else:
+                    await self.send_file_inline(file_path, file_name, file_size, progress)
+        except Exception:
+            metrics.record_transfer('send', self.device_name, file_name, file_size, 0, ok=False)
+            raise
+        report = meter.report(file_size, wire_bytes)
+        metrics.record_transfer('send', self.device_name, file_name, file_size, report['seconds'],
+                                report['wire_bytes'])
+        return report
+
+    async def should_compress(self, file_path):
+        # Media and archives are not worth a second pass; everything else is
+        # still probed chunk by chunk
+        if self.compressor is None:
+            return False
+        return not await self.loop.run_in_executor(None, archive.looks_compressed, file_path)
+
+    async def stream_file(self, file_path, file_name, file_size, extra, progress):
+        # Header frame, fixed-size binary chunks sent from the page cache with
+        # sendfile, then an end frame with the checksum computed alongside.
+        # Peers that support resume answer the header with the offset they
+        # already hold, and only the remaining range is sent. Returns the
+        # payload bytes put on the wire.
+        stream_id = next(self.stream_ids)
+        digest = self.loop.run_in_executor(None, transfer.hash_file, file_path)
+        start = {
+            'type': 'file_start',
+            'transfer_id': stream_id,
+            'name': file_name,
+            'size': file_size,
+            'chunk_size': protocol.CHUNK_SIZE,
+            **extra
+        }
+
+        key = None
+        if protocol.CAP_RESUME in self.capabilities:
+            key = transfer.resume_key(file_path, file_name, file_size)
+            start['resume_key'] = key
+            self.manager.interrupted[key] = (file_path, file_name, extra)
+
+        try:
+            if key is None:
+                await self.send_message(start)
+                offset = 0
+            else:
+                accepted = await self.request_reply('file_accept', stream_id, start)
+                offset = max(0, min(int(accepted.get('offset', 0)), file_size))
+            done = self.expect_reply('file_done', stream_id) if key is not None else None
+            wire_bytes = await self.send_chunks(stream_id, file_path, file_size, offset, digest, progress)
+        except Exception:
+            digest.cancel()
+            raise
+
+        if done is not None:
+            # Bytes in the socket buffer are not a finished transfer; keep the
+            # resume entry until the peer confirms it has the whole file
+            result = await self.wait_reply(done, 'file_done', stream_id)
+            self.manager.interrupted.pop(key, None)
+            if not result.get('ok'):
+                raise ValueError(result.get('error') or f"{self.device_name} rejected {file_name}")
+        return wire_bytes
+
+    async def send_striped(self, file_path, file_name, file_size, extra, progress):
+        # Byte ranges go out in parallel over this connection and every data
+        # channel; the receiver writes each at its offset and acknowledges it
+        # here. Ranges lost with a dropped channel are sent again elsewhere.
+        stream_id = next(self.stream_ids)
+        digest = self.loop.run_in_executor(None, transfer.hash_file, file_path)
+        try:
+            accepted = await self.request_reply('stripe_accept', stream_id, {
+                'type': 'stripe_start',
+                'transfer_id': stream_id,
+                'name': file_name,
+                'size': file_size,
+                'chunk_size': protocol.CHUNK_SIZE,
+                **extra
+            })
+            if accepted.get('error'):
+                raise ValueError(accepted['error'])
+
+            stripe = StripedSend(file_size, STRIPE_RANGE_SIZE)
+            self.outgoing_stripes[stream_id] = stripe
+            compress = await self.should_compress(file_path)
+            try:
+                lanes = [self] + self.channels
+                await asyncio.gather(*(self.send_stripes(lane, stripe, stream_id, file_path, file_size, compress,
+                                                         progress)
+                                       for lane in lanes))
+            finally:
+                self.outgoing_stripes.pop(stream_id, None)
+            if not stripe.finished:
+                raise ConnectionError(f"{self.device_name} disconnected")
+
+            result = await self.request_reply('file_done', stream_id, {
+                'type': 'file_end',
+                'transfer_id': stream_id,
+                'size': file_size,
+                'sha256': await digest
+            })
+        except Exception:
+            digest.cancel()
+            raise
+        if not result.get('ok'):
+            raise ValueError(result.get('error') or f"{self.device_name} rejected {file_name}")
+        return stripe.wire_bytes
+
+    async def send_stripes(self, lane, stripe, stream_id, file_path, file_size, compress, progress):
+        # One worker per connection; its own file object, since sendfile
+        # moves the file position
+        def chunk_sent(count):
+            stripe.sent += count
+            progress(min(stripe.sent, file_size))
+
+        with open(file_path, 'rb') as f:
+            while not stripe.finished and not lane.closed and not self.closed:
+                if not stripe.pending:
+                    # Wait for acks, or for ranges coming back from a dropped channel
+                    stripe.changed.clear()
+                    changed = self.loop.create_task(stripe.changed.wait())
+                    await asyncio.wait([changed, lane.disconnected, self.disconnected],
+                                       return_when=asyncio.FIRST_COMPLETED)
+                    changed.cancel()
+                    continue
+
+                offset, length = stripe.take(lane)
+                try:
+                    await lane.send_message({
+                        'type': 'stripe_range',
+                        'transfer_id': stream_id,
+                        'offset': offset,
+                        'length': length
+                    }, PRIORITY_BULK)
+                    end = offset + length
+                    while offset < end:
+                        count = min(protocol.CHUNK_SIZE, end - offset)
+                        sent = await lane.enqueue_range(
+                            stream_id, f, offset, count, lambda count=count: chunk_sent(count), compress)
+                        stripe.wire_bytes += sent
+                        offset += count
+                except ConnectionError:
+                    break
+        if lane.closed:
+            stripe.lane_failed(lane)
+
+    def expect_reply(self, msg_type, transfer_id):
+        reply = self.loop.create_future()
+        self.pending_replies[(msg_type, transfer_id)] = reply
+        return reply
+
+    async def wait_reply(self, reply, msg_type, transfer_id, timeout=ACCEPT_TIMEOUT):
+        await asyncio.wait([reply, self.disconnected], timeout=timeout,
+                           return_when=asyncio.FIRST_COMPLETED)
+        self.pending_replies.pop((msg_type, transfer_id), None)
+        if not reply.done() or reply.cancelled():
+            raise ConnectionError(f"No {msg_type} from {self.device_name}")
+        return reply.result()
+
+    async def request_reply(self, msg_type, transfer_id, message, timeout=ACCEPT_TIMEOUT):
+        reply = self.expect_reply(msg_type, transfer_id)
+        await self.send_message(message)
+        return await self.wait_reply(reply, msg_type, transfer_id, timeout)
+
+    async def send_chunks(self, stream_id, file_path, file_size, offset, digest, progress):
+        sent = {'bytes': offset}
+
+        def chunk_sent(count):
+            sent['bytes'] += count
+            progress(sent['bytes'])
+
+        compress = await self.should_compress(file_path)
+        wire_bytes = 0
+        with open(file_path, 'rb') as f:
+            while offset < file_size:
+                count = min(protocol.CHUNK_SIZE, file_size - offset)
+                wire_bytes += await self.enqueue_range(
+                    stream_id, f, offset, count, lambda count=count: chunk_sent(count), compress)
+                offset += count
+
+            await self.send_frame_and_wait(OutgoingFrame(self.encode({
+                'type': 'file_end',
+                'transfer_id': stream_id,
+                'size': file_size,
+                'sha256': await digest
+            })))
+        return wire_bytes
+
+    async def send_delta(self, file_path, file_name, file_size, extra, progress):
+        # Ask the peer for signatures of its existing copy and send only the
+        # changed ranges. Returns the literal bytes put on the wire, or None
+        # when the peer has no copy, the delta is not worth it, or the peer
+        # could not rebuild the file; the caller then sends it whole.
+        stream_id = next(self.stream_ids)
+        reply = self.expect_reply('signatures', stream_id)
+        await self.send_message({
+            'type': 'signature_request',
+            'transfer_id': stream_id,
+            'name': file_name,
+            'size': file_size,
+            **extra
+        })
+        signatures = await self.wait_reply(reply, 'signatures', stream_id, SCAN_TIMEOUT)
+        if not signatures.get('blocks'):
+            return None
+
+        block_size = int(signatures['block_size'])
+        ops = await self.loop.run_in_executor(None, delta.compute_delta, file_path,
+                                              block_size, signatures['blocks'])
+        if ops is None:
+            return None
+
+        digest = self.loop.run_in_executor(None, transfer.hash_file, file_path)
+        await self.send_message({
+            'type': 'delta_start',
+            'transfer_id': stream_id,
+            'name': file_name,
+            'size': file_size,
+            'block_size': block_size,
+            **extra
+        })
+
+        compress = await self.should_compress(file_path)
+        wire_bytes = 0
+        with open(file_path, 'rb') as f:
+            copies = []
+            for kind, start, length in ops:
+                if kind == 'copy':
+                    copies.append([start, length])
+                    continue
+                if copies:
+                    await self.send_message({'type': 'delta_copy', 'transfer_id': stream_id, 'blocks': copies},
+                                            PRIORITY_BULK)
+                    copies = []
+                end = start + length
+                while start < end:
+                    count = min(protocol.CHUNK_SIZE, end - start)
+                    wire_bytes += await self.enqueue_range(stream_id, f, start, count, compress=compress)
+                    start += count
+            if copies:
+                await self.send_message({'type': 'delta_copy', 'transfer_id': stream_id, 'blocks': copies},
+                                        PRIORITY_BULK)
+
+            done = self.expect_reply('file_done', stream_id)
+            await self.send_frame_and_wait(OutgoingFrame(self.encode({
+                'type': 'delta_end',
+                'transfer_id': stream_id,
+                'size': file_size,
+                'sha256': await digest
+            })))
+        result = await self.wait_reply(done, 'file_done', stream_id, SCAN_TIMEOUT)
+        if not result.get('ok'):
+            print(f"Delta of {file_name} to {self.device_name} failed, sending it whole: {result.get('error')}")
+            return None
+        progress(file_size)
+        return wire_bytes
+
+    def resume_outgoing(self, transfers):
+        # The peer lists partial files it holds from us; re-send the ones we
+        # still know about, which continue from the peer's offset.
+        for entry in transfers:
+            known = self.manager.interrupted.get(entry.get('resume_key'))
+            if known is not None:
+                self.loop.create_task(self.resend(*known))
+
+    async def resend(self, file_path, file_name, extra):
+        try:
+            await self.send_file(file_path, file_name, extra)
+        except Exception as e:
+            self.handler.on_transfer_error(self, file_name, e)
+
+    async def request_resume(self):
+        # Ask the peer for the rest of any partial files it was sending us
+        journal = transfer.ResumeJournal(self.manager.sync_folder())
+        entries = await self.loop.run_in_executor(None, journal.entries, self.device_key)
+        if entries:
+            await self.send_message({
+                'type': 'resume_request',
+                'transfers': [{'resume_key': entry['resume_key'], 'offset': entry['committed']}
+                              for entry in entries]
+            })
+
+    async def send_file_inline(self, file_path, file_name, file_size, progress):
+        # Legacy single-message transfer for clients without streaming support
+        def encode():
+            with open(file_path, 'rb') as f:
+                return protocol.encode_message({
+                    'type': 'file',
+                    'name': file_name,
+                    'size': file_size,
+                    'data': base64.b64encode(f.read()).decode('utf-8')
+                })
+
+        data = await self.loop.run_in_executor(None, encode)
+        await self.send_frame_and_wait(OutgoingFrame(data))
+        progress(file_size)
+
+    # Incoming files
+
+    def target_path(self, message):
+        # Files sent by a folder sync name their place under the sync folder;
+        # anything else lands at the top level under a fresh name
+        if message.get('path'):
+            return transfer.safe_join(self.manager.sync_folder(), message['path'])
+        return None
+
+    def place_incoming(self, incoming, message):
+        target = self.target_path(message)
+        if target is not None:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            incoming.target_path = target
+        incoming.folder_sync = message.get('folder_sync')
+        self.incoming_files[message['transfer_id']] = incoming
+
+    async def start_incoming_file(self, message):
+        incoming = None
+        try:
+            key = message.get('resume_key')
+            folder = self.manager.sync_folder()
+            size = message.get('size', 0)
+            if key:
+                incoming = await self.open_resumable(folder, message['name'], size, key)
+            else:
+                incoming = transfer.IncomingFile(folder, message['name'], size, self.manager.write_behind)
+            self.place_incoming(incoming, message)
+            self.handler.on_transfer_progress(self, incoming.name, incoming.received, incoming.size)
+        except Exception as e:
+            if incoming is not None:
+                incoming.abort()  # the part file is already open and preallocated
+            self.handler.on_transfer_error(self, message.get('name'), e)
+            return
+
+        if key:
+            await self.send_message({
+                'type': 'file_accept',
+                'transfer_id': message['transfer_id'],
+                'resume_key': key,
+                'offset': incoming.received
+            })
+
+    async def start_striped_file(self, message):
+        # Ranges arrive on any connection of this session, in any order
+        reply = {'type': 'stripe_accept', 'transfer_id': message.get('transfer_id')}
+        incoming = None
+        try:
+            incoming = transfer.IncomingFile(self.manager.sync_folder(), message['name'], message.get('size', 0),
+                                             self.manager.write_behind)
+            incoming.striped = True
+            self.place_incoming(incoming, message)
+        except Exception as e:
+            if incoming is not None:
+                incoming.abort()
+            reply['error'] = str(e)
+            self.handler.on_transfer_error(self, message.get('name'), e)
+        await self.send_message(reply)
+
+    async def send_signatures(self, message):
+        # Signatures of our copy of the file, computed on the executor
+        blocks = None
+        block_size = 0
+        try:
+            path = self.target_path(message) or \
+                os.path.join(self.manager.sync_folder(), os.path.basename(message['name']))
+            if os.path.isfile(path):
+                block_size = delta.block_size_for(os.path.getsize(path))
+                blocks = await self.loop.run_in_executor(None, delta.signatures, path, block_size)
+        except Exception as e:
+            print(f"Failed to compute signatures: {e}")
+        await self.send_message({
+            'type': 'signatures',
+            'transfer_id': message.get('transfer_id'),
+            'block_size': block_size,
+            'blocks': blocks
+        })
+
+    def start_delta(self, message):
+        # Rebuild the file into a part file from our copy plus the sender's
+        # literals, then swap it in over the old copy
+        incoming = None
+        try:
+            folder = self.manager.sync_folder()
+            basis_path = self.target_path(message) or os.path.join(folder, os.path.basename(message['name']))
+            incoming = transfer.IncomingFile(folder, message['name'], message.get('size', 0),
+                                             self.manager.write_behind)
+            incoming.basis_fd = os.open(basis_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+            incoming.block_size = int(message['block_size'])
+            self.place_incoming(incoming, message)
+            incoming.target_path = basis_path
+        except Exception as e:
+            if incoming is not None:
+                incoming.abort()  # also closes the basis file if it was opened
+            self.handler.on_transfer_error(self, message.get('name'), e)
+
+    def apply_delta_copy(self, message):
+        incoming = self.incoming_files.get(message.get('transfer_id'))
+        if incoming is None or incoming.basis_fd is None:
+            return
+        basis_size = os.fstat(incoming.basis_fd).st_size
+        for offset, length in delta.copy_ranges(message.get('blocks') or [], incoming.block_size, basis_size):
+            incoming.copy(incoming.basis_fd, offset, length)
+
+    async def open_resumable(self, folder, name, size, key):
+        # A previous session may still be parking this transfer
+        suspending = self.manager.suspending.get(key)
+        if suspending is not None:
+            await asyncio.wait([suspending])
+        cached = self.manager.partial_digests.pop(key, None)
+        return await self.loop.run_in_executor(
+            None, transfer.IncomingFile.resume, folder, name, size, self.manager.write_behind,
+            transfer.ResumeJournal(folder), key, self.device_key, cached)
+
+    async def receive_chunk(self, reader, stream_id, payload_size):
+        if stream_id in self.incoming_clipboards:
+            await self.receive_clipboard_chunk(reader, stream_id, payload_size)
+            return
+
+        incoming = self.incoming_files.get(stream_id)
+        if incoming is None:
+            await reader.skip(payload_size)
+            return
+
+        await incoming.receive(reader, payload_size)
+        self.handler.on_transfer_progress(self, incoming.name, incoming.received, incoming.size)
+
+    async def finish_incoming_file(self, message):
+        # file_end or delta_end. Resumable, striped and delta transfers are
+        # answered with file_done; a delta that could not start is refused
+        # here, and the sender falls back to sending the whole file.
+        is_delta = message.get('type') == 'delta_end'
+        incoming = self.incoming_files.pop(message.get('transfer_id'), None)
+        if incoming is None:
+            if is_delta:
+                await self.send_message({
+                    'type': 'file_done',
+                    'transfer_id': message.get('transfer_id'),
+                    'ok': False,
+                    'error': "No delta in progress"
+                })
+            return
+
+        try:
+            file_path = await self.loop.run_in_executor(None, incoming.finish, message.get('sha256'))
+            error = None
+            metrics.record_transfer('receive', self.device_name, incoming.name, incoming.size,
+                                    time.perf_counter() - incoming.started)
+            if incoming.folder_sync is None:
+                self.handler.on_file_received(self, file_path)
+        except Exception as e:
+            error = str(e)
+            metrics.record_transfer('receive', self.device_name, incoming.name, incoming.size, 0, ok=False)
+            self.handler.on_transfer_error(self, incoming.name, e)
+
+        if incoming.key is not None or incoming.striped or is_delta:
+            await self.send_message({
+                'type': 'file_done',
+                'transfer_id': message.get('transfer_id'),
+                'resume_key': incoming.key,
+                'ok': error is None,
+                'error': error
+            })
+
+    # Clipboard
+
+    async def send_clipboard(self, data, sha256, mime=None):
+        # Large clipboard text (UTF-8 encoded) or an image (mime) as binary
+        # chunks from memory. Text chunks are compressed in the executor when
+        # the session has a codec; images are compressed already. The start
+        # message is control, the chunks bulk; bulk is sent in order, so
+        # clipboards still complete on the device in the order they were sent.
+        async with self.clipboard_lock:
+            stream_id = next(self.stream_ids)
+            start = {
+                'type': 'clipboard_start',
+                'transfer_id': stream_id,
+                'size': len(data),
+                'sha256': sha256
+            }
+            if mime is not None:
+                start['format'] = mime
+            self.clipboard_sha256 = sha256 if mime is not None else None
+            await self.send_message(start)
+            view = memoryview(data)
+            for start in range(0, len(view), protocol.CHUNK_SIZE):
+                chunk = view[start:start + protocol.CHUNK_SIZE]
+                flags = 0
+                if self.compressor is not None and mime is None:
+                    compressed, chunk = await self.loop.run_in_executor(None, self.compressor.pack, chunk)
+                    flags = protocol.FLAG_COMPRESSED if compressed else 0
+                self.clipboard_chunks += 1
+                await self.enqueue(OutgoingFrame(protocol.encode_binary_header(stream_id, len(chunk), flags) + chunk,
+                                                 on_sent=self.clipboard_chunk_sent))
+
+    def clipboard_chunk_sent(self):
+        self.clipboard_chunks -= 1
+
+    async def send_clipboard_message(self, frame):
+        # Small clipboard text in one message. It waits behind the chunks of
+        # an earlier clipboard still queued, so it cannot be overwritten by
+        # that older one when it completes.
+        async with self.clipboard_lock:
+            self.clipboard_sha256 = None
+            await self.enqueue(OutgoingFrame(frame), PRIORITY_BULK if self.clipboard_chunks else PRIORITY_CONTROL)
+
+    def start_incoming_clipboard(self, message):
+        size = int(message.get('size', 0))
+        if not 0 < size <= MAX_CLIPBOARD_SIZE:
+            print(f"Ignoring clipboard of {size} bytes from {self.device_name}")
+            return
+        mime = message.get('format')
+        if mime is not None and not str(mime).startswith('image/'):
+            mime = None  # text/plain, or a format we cannot use
+        self.incoming_clipboards[message['transfer_id']] = [bytearray(size), 0, message.get('sha256'), mime]
+
+    async def receive_clipboard_chunk(self, reader, stream_id, payload_size):
+        entry = self.incoming_clipboards[stream_id]
+        buffer, received, sha256, mime = entry
+        if received + payload_size > len(buffer):
+            del self.incoming_clipboards[stream_id]
+            await reader.skip(payload_size)
+            print(f"Oversized clipboard from {self.device_name}")
+            return
+        await reader.read_exact(memoryview(buffer)[received:received + payload_size])
+        entry[1] += payload_size
+        if entry[1] < len(buffer):
+            return
+
+        del self.incoming_clipboards[stream_id]
+        if sha256 and hashlib.sha256(buffer).hexdigest() != sha256:
+            print(f"Clipboard checksum mismatch from {self.device_name}")
+            return
+        if mime is None:
+            # Delivered like a small clipboard message
+            self.clipboard_sha256 = None
+            self.handler.on_message(self, {'type': 'clipboard', 'data': buffer.decode('utf-8', 'replace')})
+            return
+        if sha256 and sha256 == self.clipboard_sha256:
+            return  # the image we sent, coming back
+        self.clipboard_sha256 = sha256
+        # Still encoded; decoding is left to whoever needs the pixels
+        self.handler.on_message(self, {'type': 'clipboard_image', 'format': mime, 'data': buffer})
+
+    # Folder sync
+
+    async def sync_directory(self, folder_path):
+        # Push folder_path to the peer's sync folder: compare manifests, send
+        # new and changed files, carry deletions over
+        sync_id = next(self.stream_ids)
+        folder_name = os.path.basename(os.path.normpath(folder_path))
+        started = transfer.CpuMeter()
+        manifest = await self.loop.run_in_executor(None, self.manager.index.scan, folder_path)
+
+        remote = await self.request_reply('folder_manifest', sync_id, {
+            'type': 'folder_sync_start',
+            'transfer_id': sync_id,
+            'folder': folder_name,
+            'digest': foldersync.manifest_digest(manifest),
+            'count': len(manifest)
+        }, SCAN_TIMEOUT)
+        if remote.get('error'):
+            raise ValueError(remote['error'])
+
+        if remote.get('in_sync'):
+            changed, deleted = [], []
+        else:
+            changed, deleted = foldersync.diff_manifests(manifest, remote.get('files') or {})
+
+        sent_bytes = 0
+        for rel_path in changed:
+            await self.send_file(os.path.join(folder_path, *rel_path.split('/')), os.path.basename(rel_path), {
+                'path': f"{folder_name}/{rel_path}",
+                'folder_sync': sync_id
+            })
+            sent_bytes += manifest[rel_path][0]
+
+        await self.request_reply('folder_sync_done', sync_id, {
+            'type': 'folder_sync_end',
+            'transfer_id': sync_id,
+            'folder': folder_name,
+            'sent': len(changed),
+            'deleted': deleted
+        }, SCAN_TIMEOUT)
+        report = started.report(sent_bytes)
+        report.update({'files': len(manifest), 'sent': len(changed), 'deleted': len(deleted)})
+        return report
+
+    def sync_root(self, message):
+        return transfer.safe_join(self.manager.sync_folder(), message.get('folder', ''))
+
+    async def send_manifest(self, message):
+        # Receiver side: describe what we already hold for this folder
+        reply = {'type': 'folder_manifest', 'transfer_id': message.get('transfer_id')}
+        try:
+            root = self.sync_root(message)
+            os.makedirs(root, exist_ok=True)
+            manifest = await self.loop.run_in_executor(None, self.manager.index.scan, root)
+            reply['in_sync'] = foldersync.manifest_digest(manifest) == message.get('digest')
+            if not reply['in_sync']:
+                reply['files'] = {path: list(entry) for path, entry in manifest.items()}
+        except Exception as e:
+            reply['error'] = str(e)
+        await self.send_message(reply)
+
+    async def finish_folder_sync(self, message):
+        summary = {'received': message.get('sent', 0), 'deleted': 0}
+        try:
+            root = self.sync_root(message)
+            summary['deleted'] = await self.loop.run_in_executor(
+                None, foldersync.remove_files, root, message.get('deleted') or [])
+            self.handler.on_folder_synced(self, message.get('folder'), summary)
+            error = None
+        except Exception as e:
+            error = str(e)
+            self.handler.on_transfer_error(self, message.get('folder'), e)
+        await self.send_message({
+            'type': 'folder_sync_done',
+            'transfer_id': message.get('transfer_id'),
+            'ok': error is None,
+            'error': error
+        })
+
+    async def receive_inline_file(self, message):
+        try:
+            # Decoded slice by slice straight into the sync folder
+            file_path = await self.loop.run_in_executor(
+                None, transfer.receive_base64, self.manager.sync_folder(),
+                message['name'], message['data'], self.manager.write_behind)
+            self.handler.on_file_received(self, file_path)
+        except Exception as e:
+            self.handler.on_transfer_error(self, message.get('name'), e)
+
+    def discard_incoming_files(self):
+        # Connection went away mid-transfer: park resumable files in the
+        # journal and drop the rest
+        for incoming in self.incoming_files.values():
+            def suspend(incoming=incoming):
+                self.manager.write_behind.flush(incoming)
+                return incoming.suspend()
+
+            suspending = self.loop.run_in_executor(None, suspend)
+            if incoming.key is not None:
+                self.manager.suspending[incoming.key] = suspending
+                suspending.add_done_callback(
+                    lambda future, key=incoming.key: self.manager.partial_suspended(key, future))
+        self.incoming_files.clear()
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        for reply in self.pending_replies.values():
+            reply.cancel()
+        for channel in list(self.channels):
+            channel.close()
+        self.manager.channel_owners.pop(self.channel_token, None)
+        self.discard_incoming_files()
+        if self.manager.sessions.pop(self.id, None) is not None:
+            metrics.add('sessions_closed_total')
+            self.handler.on_session_closed(self)
+
+
+class ConnectionManager:
+    # Accepts any number of devices on one event loop thread. Public methods
+    # are safe to call from other threads (Tk callbacks, worker threads).
+    def __init__(self, handler, sync_folder, index_path=':memory:', streams=1, bandwidth=0, identity=None):
+        self.handler = handler
+        self.sync_folder = sync_folder
+        self.identity = identity  # securelink.Identity; None offers plaintext only
+        self.require_tls = False  # refuse plaintext clients
+        self.streams = streams  # connections per device for striped transfers
+        self.bandwidth = transfer.TokenBucket(bandwidth)  # shared by every connection's bulk frames
+        self.index = foldersync.ContentIndex(index_path)
+        self.codec_stats = wirecodec.CodecStats()
+        self.loop = None
+        self.thread = None
+        self.server_socket = None
+        self.sessions = {}
+        self.session_ids = itertools.count(1)
+        self.write_behind = transfer.WriteBehind()
+        self.accept_task = None
+        self.archive_pool = None
+        self.handshakes = set()
+        self.closing = set()  # tasks closing sockets once their connection's tasks end
+        self.channel_owners = {}
+        self.known_devices = set()  # device keys seen since start, to count reconnects
+
+        # Resume state: outgoing files that did not finish (resume key ->
+        # (path, name)), incoming ones being parked and their running hashes
+        self.interrupted = {}
+        self.suspending = {}
+        self.partial_digests = {}
+
+    def start(self, host, port, backlog=64):
+        # Bind synchronously so the caller sees address errors immediately
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            server_socket.bind((host, port))
+            server_socket.listen(backlog)
+        except Exception:
+            server_socket.close()
+            raise
+        server_socket.setblocking(False)
+        self.server_socket = server_socket
+
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+        self.thread = threading.Thread(target=self._run_loop, args=(started,), daemon=True)
+        self.thread.start()
+        started.wait()
+        return server_socket.getsockname()
+
+    def _run_loop(self, started):
+        asyncio.set_event_loop(self.loop)
+        self.accept_task = self.loop.create_task(self.accept_connections())
+        self.loop.call_soon(started.set)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    async def accept_connections(self):
+        while True:
+            try:
+                client_socket, address = await self.loop.sock_accept(self.server_socket)
+            except asyncio.CancelledError:
+                raise
+            except OSError as e:
+                print(f"Connection error: {e}")
+                return
+            client_socket.setblocking(False)
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            enable_keepalive(client_socket)
+            if sys.platform.startswith('linux'):
+                try:
+                    client_socket.setsockopt(socket.IPPROTO_TCP, getattr(socket, 'TCP_NOTSENT_LOWAT', 25),
+                                             NOTSENT_LOWAT)
+                except OSError:
+                    pass
+            task = self.loop.create_task(self.open_connection(client_socket, address))
+            self.handshakes.add(task)
+            task.add_done_callback(self.handshakes.discard)
+
+    async def accept_link(self, client_socket):
+        # Clients that paired with our fingerprint open with a TLS
+        # ClientHello; older ones send the JSON handshake straight away.
+        # Returns the link and the handshake bytes.
+        data = await self.loop.sock_recv(client_socket, 1024)
+        if not securelink.is_client_hello(data):
+            if self.require_tls:
+                raise ConnectionError("Plaintext connection refused")
+            return securelink.PlainLink(self.loop, client_socket), data
+        if self.identity is None:
+            raise ConnectionError("TLS requested but no identity is configured")
+        link = securelink.TlsLink(self.loop, client_socket, self.identity.context, server_side=True, initial=data)
+        await link.handshake()
+        return link, await link.recv(1024)
+
+    async def open_connection(self, client_socket, address):
+        # The first bytes are either a device handshake or, for a data
+        # channel, the token its session was given in hello
+        try:
+            link, data = await asyncio.wait_for(self.accept_link(client_socket), HANDSHAKE_TIMEOUT)
+            device_info, capabilities = protocol.parse_handshake(data)
+        except Exception as e:
+            print(f"Handshake failed from {address}: {e}")
+            client_socket.close()
+            return
+
+        token = device_info.get('channel_token')
+        if token:
+            owner = self.channel_owners.get(token)
+            # A data channel is at least as private as its session
+            if (owner is None or owner.closed or len(owner.channels) >= owner.streams - 1
+                    or (owner.link.encrypted and not link.encrypted)):
+                print(f"Rejected data channel from {address}")
+                client_socket.close()
+                return
+            connection = DataChannel(owner, client_socket, address, link)
+            owner.channels.append(connection)
+        else:
+            connection = Session(self, next(self.session_ids), client_socket, address, device_info, capabilities,
+                                 link)
+            self.sessions[connection.id] = connection
+
+        self.handshakes.discard(asyncio.current_task())
+        connection.tasks.append(asyncio.current_task())
+        await connection.run()
+
+    def forget_interrupted(self, path):
+        # Drop resume entries for path (or files under it) so a peer's
+        # resume_request does not re-send them; the caller sends them again
+        # itself. Safe from any thread.
+        prefix = os.path.join(os.path.abspath(path), '')
+
+        def forget():
+            for key, (file_path, _, _) in list(self.interrupted.items()):
+                file_path = os.path.abspath(file_path)
+                if file_path == os.path.abspath(path) or file_path.startswith(prefix):
+                    del self.interrupted[key]
+
+        if self.loop is not None and self.loop.is_running():
+            self.loop.call_soon_threadsafe(forget)
+        else:
+            forget()
+
+    def partial_suspended(self, key, future):
+        if self.suspending.get(key) is future:
+            del self.suspending[key]
+        if not future.cancelled() and future.exception() is None and future.result():
+            self.partial_digests[key] = future.result()
+
+    def stop(self):
+        if self.loop is None:
+            return
+
+        async def shutdown():
+            self.accept_task.cancel()
+            tasks = [self.accept_task]
+            for task in list(self.handshakes):
+                task.cancel()
+                tasks.append(task)
+            for session in list(self.sessions.values()):
+                tasks.extend(session.tasks)
+                session.close()
+            self.server_socket.close()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await asyncio.gather(*self.closing, return_exceptions=True)
+
+        try:
+            asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result(timeout=5)
+        except Exception as e:
+            print(f"Error stopping server: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=5)
+        self.loop = None
+        self.server_socket = None
+        if self.archive_pool is not None:
+            pool, self.archive_pool = self.archive_pool, None
+            workerpool.shutdown(pool, POOL_SHUTDOWN_TIMEOUT, 'archive')
+
+    @property
+    def is_running(self):
+        return self.loop is not None
+
+    def queue_stats(self):
+        # Send queue figures per connected device, data channels included
+        stats = {}
+        for session in self.target_sessions():
+            entry = session.send_queue.stats()
+            entry['channels'] = [channel.send_queue.stats() for channel in session.channels]
+            stats[session.id] = entry
+        return stats
+
+    def compression_stats(self):
+        # Ratio and CPU cost per wire codec since start
+        return self.codec_stats.snapshot()
+
+    def pack_for(self, sessions, data):
+        # An encoded message as one frame per session, compressed once per codec
+        packed = {}
+        frames = []
+        for session in sessions:
+            compressor = session.compressor
+            name = compressor.codec.name if compressor is not None else None
+            if name not in packed:
+                packed[name] = pack_message(data, compressor)
+            frames.append(packed[name])
+        return frames
+
+    def target_sessions(self, session_ids=None):
+        sessions = list(self.sessions.values())
+        if session_ids is not None:
+            sessions = [s for s in sessions if s.id in session_ids]
+        return [s for s in sessions if not s.closed and s.device_info]
+
+    def submit(self, coro):
+        # Schedule a coroutine on the loop and return a concurrent future
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def broadcast(self, message, session_ids=None):
+        # Fan a JSON message out to every (or the selected) session; encoded
+        # once per codec
+        if not self.is_running:
+            return False
+        sessions = self.target_sessions(session_ids)
+        if not sessions:
+            return False
+        frames = self.pack_for(sessions, protocol.encode_message(message))
+
+        async def fan_out():
+            await asyncio.gather(*(s.enqueue(OutgoingFrame(data), PRIORITY_CONTROL)
+                                   for s, data in zip(sessions, frames)),
+                                 return_exceptions=True)
+
+        self.submit(fan_out())
+        return True
+
+    def send_clipboard(self, text, session_ids=None):
+        # Small text goes out as one clipboard message to every session;
+        # large text is chunked for peers that support it
+        if not self.is_running:
+            return False
+        sessions = self.target_sessions(session_ids)
+        if not sessions:
+            return False
+        message = protocol.encode_message({'type': 'clipboard', 'data': text})
+        data = None
+        if len(message) > CLIPBOARD_INLINE_LIMIT:
+            data = text.encode('utf-8', 'surrogatepass')
+            sha256 = hashlib.sha256(data).hexdigest()
+        inline = [s for s in sessions if data is None or protocol.CAP_CLIPBOARD not in s.capabilities]
+        frames = dict(zip(inline, self.pack_for(inline, message)))
+
+        async def fan_out():
+            sends = []
+            for session in sessions:
+                if session in frames:
+                    sends.append(session.send_clipboard_message(frames[session]))
+                else:
+                    sends.append(session.send_clipboard(data, sha256))
+            await asyncio.gather(*sends, return_exceptions=True)
+
+        self.submit(fan_out())
+        return True
+
+    def send_clipboard_image(self, data, mime, session_ids=None):
+        # An encoded image, always chunked, to the sessions that take images
+        # and do not have this one on their clipboard already; False when
+        # that leaves nobody
+        if not self.is_running:
+            return False
+        sha256 = hashlib.sha256(data).hexdigest()
+        sessions = [s for s in self.target_sessions(session_ids)
+                    if protocol.CAP_CLIPBOARD_IMAGE in s.capabilities and s.clipboard_sha256 != sha256]
+        if not sessions:
+            return False
+
+        async def fan_out():
+            await asyncio.gather(*(s.send_clipboard(data, sha256, mime) for s in sessions),
+                                 return_exceptions=True)
+
+        self.submit(fan_out())
+        return True
+
+    def send_file(self, file_path, file_name=None, session_ids=None, on_progress=None):
+        # Returns a concurrent future resolving to one CPU/throughput report per session
+        file_name = file_name or os.path.basename(file_path)
+        sessions = self.target_sessions(session_ids)
+
+        async def send_all():
+            return await asyncio.gather(*(s.send_file(file_path, file_name, on_progress=on_progress)
+                                          for s in sessions))
+
+        return self.submit(send_all())
+
+    def sync_directory(self, folder_path, session_ids=None):
+        # Returns a concurrent future resolving to one sync summary per session
+        sessions = [s for s in self.target_sessions(session_ids) if protocol.CAP_FOLDER in s.capabilities]
+        if not sessions:
+            raise ValueError("No connected device supports folder sync")
+
+        async def sync_all():
+            return await asyncio.gather(*(s.sync_directory(folder_path) for s in sessions))
+
+        return self.submit(sync_all())
+
+    def compression_pool(self):
+        # Worker processes for folder archives, started on first use
+        if self.archive_pool is None:
+            self.archive_pool = concurrent.futures.ProcessPoolExecutor()
+        return self.archive_pool
+
+    def send_folder(self, folder_path, archive_name, session_ids=None, on_progress=None):
+        # Zip folder_path on the fly and send it as archive_name. Streaming
+        # peers get the archive while it is being built; older ones get it
+        # once it has been written to a temporary file. Returns a concurrent
+        # future resolving to one report per session.
+        sessions = self.target_sessions(session_ids)
+        streaming = [s for s in sessions if protocol.CAP_STREAM in s.capabilities]
+        legacy = [s for s in sessions if protocol.CAP_STREAM not in s.capabilities]
+
+        async def send_all():
+            reports = []
+            if streaming:
+                reports.extend(await self.stream_archive(streaming, folder_path, archive_name, on_progress))
+            if legacy:
+                reports.extend(await self.send_archive_file(legacy, folder_path, archive_name, on_progress))
+            return reports
+
+        return self.submit(send_all())
+
+    async def stream_archive(self, sessions, folder_path, archive_name, on_progress=None):
+        # One producer feeds every session, so the folder is read and
+        # compressed once; the slowest device sets the pace. A device that
+        # drops out is left behind and the others carry on.
+        meter = transfer.CpuMeter()
+        source = await self.loop.run_in_executor(
+            None, archive.StreamingArchive, folder_path, self.compression_pool())
+        streams = [(session, next(session.stream_ids)) for session in sessions]
+        failed = []
+
+        async def to_each(send):
+            # send(session, stream_id) for every stream still going
+            results = await asyncio.gather(*(send(session, stream_id) for session, stream_id in streams),
+                                           return_exceptions=True)
+            for stream, result in list(zip(streams, results)):
+                if isinstance(result, Exception):
+                    streams.remove(stream)
+                    failed.append((stream[0], result))
+                    self.handler.on_transfer_error(stream[0], archive_name, result)
+                    metrics.record_transfer('send', stream[0].device_name, archive_name, source.total, 0, ok=False)
+            if not streams:
+                raise failed[0][1]
+
+        try:
+            # No size up front: the receiver learns it from file_end
+            await to_each(lambda session, stream_id: session.send_message({
+                'type': 'file_start',
+                'transfer_id': stream_id,
+                'name': archive_name,
+                'chunk_size': protocol.CHUNK_SIZE
+            }))
+
+            while True:
+                piece = await self.loop.run_in_executor(None, source.read)
+                if not piece:
+                    break
+                view = memoryview(piece)
+                for start in range(0, len(view), protocol.CHUNK_SIZE):
+                    chunk = view[start:start + protocol.CHUNK_SIZE]
+                    await to_each(lambda session, stream_id: session.enqueue(OutgoingFrame(
+                        protocol.encode_binary_header(stream_id, len(chunk)) + chunk)))
+                for session, stream_id in streams:
+                    self.handler.on_transfer_progress(session, archive_name, source.done, source.total)
+                    if on_progress is not None:
+                        on_progress(session, source.done, source.total)
+
+            end = {'type': 'file_end', 'size': source.offset, 'sha256': source.sha256.hexdigest()}
+            await to_each(lambda session, stream_id: session.send_frame_and_wait(OutgoingFrame(session.encode(
+                {**end, 'transfer_id': stream_id}))))
+        finally:
+            # Deflate jobs still queued in the pool are not needed any more
+            await self.loop.run_in_executor(None, source.close)
+
+        report = meter.report(source.total, source.offset)
+        report['stored_files'] = source.stored
+        for session, stream_id in streams:
+            metrics.record_transfer('send', session.device_name, archive_name, source.total, report['seconds'],
+                                    source.offset)
+        return [report] * len(streams)
+
+    async def send_archive_file(self, sessions, folder_path, archive_name, on_progress=None):
+        fd, temp_path = tempfile.mkstemp(suffix='.zip')
+        os.close(fd)
+        try:
+            await self.loop.run_in_executor(
+                None, archive.write_archive, folder_path, temp_path, self.compression_pool())
+            return await asyncio.gather(*(s.send_file(temp_path, archive_name, on_progress=on_progress)
+                                          for s in sessions))
+        finally:
+            os.unlink(temp_path)
@@ -0,0 +1,179 @@
+# Command line entry point: runs the sync engine without a display, for
+# servers and kiosks. Settings come from the same config file as the
+# desktop app and can be overridden with flags; events are printed.
+# Ctrl+C or SIGTERM stops it.
+#
+#   python desktop/syncd.py --port 8888 --sync-folder /srv/sync
+import argparse
+import json
+import os
+import signal
+import threading
+
+import engine
+import metrics
+import transfer
+import transferqueue
+
+
+class ConsoleListener(engine.Listener):
+    def __init__(self, send_paths):
+        self.sync_engine = None
+        self.send_paths = list(send_paths)  # sent to the first device that connects
+        self.reported = {}  # transfer name -> last progress decile printed
+
+    def on_session_opened(self, session):
+        print(f"{session.device_name} connected from {session.address[0]}"
+              f"{' (encrypted)' if session.link.encrypted else ''}")
+        paths, self.send_paths = self.send_paths, []
+        for path in paths:
+            try:
+                if os.path.isdir(path):
+                    self.sync_engine.queue_folder(path, {session.id})
+                else:
+                    self.sync_engine.queue_file(path, None, {session.id})
+            except Exception as e:
+                print(f"Failed to queue {path}: {e}")
+
+    def on_session_closed(self, session):
+        print(f"{session.device_name} disconnected")
+
+    def on_clipboard_received(self, session, text):
+        print(f"Clipboard from {session.device_name} ({len(text)} characters)")
+
+    def on_clipboard_image_received(self, session, image):
+        width, height = image.size
+        print(f"Clipboard image from {session.device_name} ({width}x{height}, {len(image.data) // 1024} KB)")
+
+    def on_transfer_progress(self, session, name, done, total):
+        if not total:
+            return
+        decile = done * 10 // total
+        if decile != self.reported.get(name):
+            self.reported[name] = decile
+            print(f"{name}: {decile * 10}%")
+
+    def on_file_received(self, session, file_path):
+        print(f"Received {file_path} from {session.device_name}")
+
+    def on_transfer_error(self, session, name, error):
+        print(f"Transfer of {name} failed: {error}")
+
+    def on_folder_synced(self, session, folder, summary):
+        print(f"{folder} synced from {session.device_name}: "
+              f"{summary['received']} updated, {summary['deleted']} deleted")
+
+    def on_addresses_changed(self, addresses):
+        print(f"Network changed, now reachable at {', '.join(addresses)}")
+        print(f"Pairing info: {json.dumps(self.sync_engine.pairing_info())}")
+
+    def on_job_finished(self, job):
+        if job.state == transferqueue.DONE and job.kind != 'sync':
+            for report in job.reports:
+                print(f"Sent {job.path}: {transfer.format_report(report)}")
+        elif job.state == transferqueue.FAILED:
+            print(f"Failed to send {job.path}: {job.error}")
+
+
+def system_clipboard():
+    try:
+        import pyperclip
+        pyperclip.paste()
+        return pyperclip
+    except Exception as e:
+        print(f"System clipboard unavailable, clipboard sync disabled: {e}")
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless SyncApp server")
+    parser.add_argument('--config', default=engine.CONFIG_FILE)
+    parser.add_argument('--host', help="address to listen on (default: every interface)")
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--sync-folder')
+    parser.add_argument('--streams', type=int, help="parallel streams per device")
+    parser.add_argument('--index', default=engine.INDEX_FILE, help="content index for folder sync")
+    parser.add_argument('--queue', default=engine.QUEUE_FILE, help="persistent transfer queue")
+    parser.add_argument('--identity', default=engine.IDENTITY_FILE,
+                        help="TLS certificate and key, created on first run")
+    parser.add_argument('--require-encryption', action='store_true', help="refuse devices that connect without TLS")
+    parser.add_argument('--no-discovery', action='store_true',
+                        help="do not answer or announce on the local network")
+    parser.add_argument('--concurrent', type=int, help="transfers run at once")
+    parser.add_argument('--bandwidth-limit', type=int, metavar='KB_PER_S', help="cap on outgoing data, 0 for none")
+    parser.add_argument('--clipboard', choices=['system', 'memory', 'off'], default='system',
+                        help="clipboard to keep in sync; 'memory' keeps one in this process")
+    parser.add_argument('--send', action='append', default=[], metavar='PATH',
+                        help="queue this file or folder for the first device that connects; repeatable")
+    parser.add_argument('--metrics-file', metavar='PATH',
+                        help="write a metrics snapshot here periodically; Prometheus text for *.prom, JSON otherwise")
+    parser.add_argument('--metrics-interval', type=float, default=10.0, help="seconds between snapshots")
+    parser.add_argument('--profile', metavar='PATH',
+                        help="run the sampling profiler and write collapsed stacks here on exit")
+    args = parser.parse_args()
+
+    config = engine.load_config(args.config)
+    if args.port is not None:
+        config['port'] = args.port
+    if args.sync_folder:
+        config['sync_folder'] = args.sync_folder
+    if args.streams is not None:
+        config['parallel_streams'] = args.streams
+    if args.concurrent is not None:
+        config['concurrent_transfers'] = args.concurrent
+    if args.bandwidth_limit is not None:
+        config['bandwidth_limit'] = args.bandwidth_limit
+    if args.require_encryption:
+        config['require_encryption'] = True
+    if args.no_discovery:
+        config['discovery'] = False
+
+    clipboard = None
+    if args.clipboard == 'system':
+        clipboard = system_clipboard()
+    elif args.clipboard == 'memory':
+        clipboard = engine.MemoryClipboard()
+
+    listener = ConsoleListener(args.send)
+    sync_engine = engine.SyncEngine(config, args.config, clipboard, listener, args.index, args.queue, args.identity)
+    listener.sync_engine = sync_engine
+    _, port = sync_engine.start(args.host)
+    # Pairing info carries the certificate fingerprint, which may still be
+    # being generated on first run
+    sync_engine.identity_ready.wait()
+    print(f"Listening on {', '.join(sync_engine.addresses)} port {port}, sync folder {config['sync_folder']}")
+    print(f"Pairing info: {json.dumps(sync_engine.pairing_info())}")
+    if sync_engine.fingerprint is None:
+        print("Warning: connections are not encrypted")
+
+    if args.profile:
+        sync_engine.start_profiler()
+
+    stopped = threading.Event()
+    signal.signal(signal.SIGINT, lambda *args: stopped.set())
+    signal.signal(signal.SIGTERM, lambda *args: stopped.set())
+
+    interval = args.metrics_interval if args.metrics_file else 1
+    try:
+        while not stopped.wait(interval):
+            if args.metrics_file:
+                write_metrics(sync_engine, args.metrics_file)
+    finally:
+        print("Stopping")
+        if args.metrics_file:
+            write_metrics(sync_engine, args.metrics_file)
+        sync_engine.close()
+        if args.profile:
+            sync_engine.profiler.write_collapsed(args.profile)
+            print(sync_engine.profiler.format_top())
+
+
+def write_metrics(sync_engine, path):
+    try:
+        metrics.write_snapshot(sync_engine.metrics_snapshot(), path)
+    except Exception as e:
+        print(f"Failed to write metrics: {e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+# A stand-in phone for the tests: speaks the device handshake and frames
+# over a plain asyncio stream, with the capabilities each test asks for
+import asyncio
+import json
+
+import protocol
+import transfer
+
+
+class StandInDevice:
+    def __init__(self, name='test-device', capabilities=(protocol.CAP_STREAM,)):
+        self.name = name
+        self.capabilities = list(capabilities)
+        self.reader = None
+        self.writer = None
+        self.frames = None
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(json.dumps({
+            'device_name': self.name,
+            'platform': 'test',
+            'capabilities': self.capabilities
+        }).encode('utf-8'))
+        await self.writer.drain()
+        self.frames = transfer.FrameReader(self.recv_into)
+        hello = await self.read_message()
+        assert hello['type'] == 'hello', hello
+        return hello
+
+    async def recv_into(self, view):
+        data = await self.reader.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    async def read_frame(self):
+        # ('message', dict) or ('binary', (stream_id, payload bytes))
+        kind, frame = await self.frames.read_frame()
+        if kind == 'message':
+            return kind, frame
+        flags, stream_id, size = frame
+        payload = bytearray(size)
+        await self.frames.read_exact(memoryview(payload))
+        return kind, (stream_id, bytes(payload))
+
+    async def read_message(self, *types):
+        # The next JSON message, of one of types if any are given
+        while True:
+            kind, frame = await self.read_frame()
+            if kind == 'message' and (not types or frame.get('type') in types):
+                return frame
+
+    async def send_message(self, message):
+        self.writer.write(protocol.encode_message(message))
+        await self.writer.drain()
+
+    async def send_binary(self, stream_id, payload):
+        self.writer.write(protocol.encode_binary_header(stream_id, len(payload)) + payload)
+        await self.writer.drain()
+
+    def close(self):
+        self.writer.close()
@@ -0,0 +1,133 @@
+import concurrent.futures
+import hashlib
+import os
+import random
+import zipfile
+import zlib
+
+import pytest
+
+import archive
+import engine
+
+
+@pytest.fixture(scope='module')
+def pool():
+    pool = concurrent.futures.ProcessPoolExecutor(2)
+    yield pool
+    pool.shutdown(wait=True)
+
+
+def make_folder(root):
+    rng = random.Random(8)
+    files = {
+        'notes.txt': b'hello archive\n' * 1000,  # small: deflated inline
+        'big/log.txt': b''.join(b'line %d of the log\n' % n for n in range(200_000)),  # several pool chunks
+        'big/random.bin': rng.randbytes(archive.SMALL_FILE * 3),  # high entropy: stored
+        'photos/IMG_0001.jpg': rng.randbytes(5000),  # stored by extension
+        'empty.txt': b'',
+        'unicodé/naïve.md': 'größe\n'.encode('utf-8') * 100,
+    }
+    for name, data in files.items():
+        path = os.path.join(root, *name.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+    return files
+
+
+def check(path, files):
+    with zipfile.ZipFile(path) as zf:
+        assert zf.testzip() is None
+        assert sorted(zf.namelist()) == sorted(files)
+        for name, data in files.items():
+            assert zf.read(name) == data
+            info = zf.getinfo(name)
+            assert info.flag_bits & archive.FLAG_DATA_DESCRIPTOR
+            assert info.CRC == zlib.crc32(data)
+        return {info.filename: info for info in zf.infolist()}
+
+
+def test_archive_through_pool(tmp_path, pool):
+    files = make_folder(str(tmp_path / 'folder'))
+    assert len(files['big/log.txt']) > 2 * archive.ARCHIVE_CHUNK
+    result = archive.write_archive(str(tmp_path / 'folder'), str(tmp_path / 'out.zip'), pool)
+    infos = check(str(tmp_path / 'out.zip'), files)
+    assert infos['big/log.txt'].compress_type == zipfile.ZIP_DEFLATED
+    assert infos['big/random.bin'].compress_type == zipfile.ZIP_STORED
+    assert infos['photos/IMG_0001.jpg'].compress_type == zipfile.ZIP_STORED
+    assert result.stored == 2
+    with open(tmp_path / 'out.zip', 'rb') as f:
+        assert result.sha256.hexdigest() == hashlib.sha256(f.read()).hexdigest()
+
+
+def test_streamed_pieces_make_the_same_archive(tmp_path, pool):
+    files = make_folder(str(tmp_path / 'folder'))
+    stream = archive.StreamingArchive(str(tmp_path / 'folder'), pool, lookahead=1)
+    with open(tmp_path / 'out.zip', 'wb') as f:
+        while True:
+            piece = stream.read()
+            if not piece:
+                break
+            f.write(piece)
+    check(str(tmp_path / 'out.zip'), files)
+    assert stream.done == stream.total
+
+
+def test_close_part_way_cancels_queued_jobs(tmp_path, pool):
+    (tmp_path / 'folder').mkdir()
+    (tmp_path / 'folder' / 'log.txt').write_bytes(b'a line of the log\n' * (archive.ARCHIVE_CHUNK // 2))
+    stream = archive.StreamingArchive(str(tmp_path / 'folder'), pool, lookahead=16)
+    assert stream.read()
+    futures = [part[2] for part in stream.window if part[0] == 'chunk']
+    assert len(futures) > 8
+    stream.close()
+    assert not stream.window
+    assert any(future.cancelled() for future in futures)
+    assert stream.read() == b''
+
+
+def test_zip64_entries(tmp_path, pool, monkeypatch):
+    # Entries of ZIP64_ENTRY_SIZE and up carry zip64 sizes and descriptors;
+    # lowered so the test does not need 2 GB files
+    monkeypatch.setattr(archive, 'ZIP64_ENTRY_SIZE', archive.SMALL_FILE)
+    files = make_folder(str(tmp_path / 'folder'))
+    archive.write_archive(str(tmp_path / 'folder'), str(tmp_path / 'out.zip'), pool)
+    infos = check(str(tmp_path / 'out.zip'), files)
+    for name in ('big/log.txt', 'big/random.bin'):
+        assert infos[name].extract_version >= 45
+        header_offset = infos[name].header_offset
+        with open(tmp_path / 'out.zip', 'rb') as f:
+            f.seek(header_offset)
+            fields = archive.LOCAL_HEADER.unpack(f.read(archive.LOCAL_HEADER.size))
+        assert fields[7] == fields[8] == archive.ZIP64_LIMIT  # sizes in the zip64 extra field
+    assert infos['notes.txt'].extract_version == 20
+
+
+@pytest.mark.parametrize('split', [0, 1, 7, 1000, 65536, 99_999, 100_000])
+def test_crc32_combine(split):
+    data = random.Random(split).randbytes(100_000)
+    first, second = data[:split], data[split:]
+    combined = archive.crc32_combine(zlib.crc32(first), zlib.crc32(second), len(second))
+    assert combined == zlib.crc32(data)
+
+
+def test_stop_waits_for_archive_workers(tmp_path):
+    config = dict(engine.default_config(), sync_folder=str(tmp_path / 'sync'), discovery=False)
+    sync_engine = engine.SyncEngine(config, str(tmp_path / 'config.json'), engine.MemoryClipboard(),
+                                    engine.Listener(), ':memory:', ':memory:', str(tmp_path / 'identity.pem'))
+    sync_engine.start('127.0.0.1', 0)
+    try:
+        path = str(tmp_path / 'data.txt')
+        with open(path, 'wb') as f:
+            f.write(b'compressible ' * 500_000)
+        pool = sync_engine.server.compression_pool()
+        futures = [pool.submit(archive.deflate_range, path, 0, archive.ARCHIVE_CHUNK, True) for _ in range(20)]
+        futures[0].result()
+        processes = list(pool._processes.values())
+        sync_engine.stop()
+        assert sync_engine.server.archive_pool is None
+        assert processes and not any(process.is_alive() for process in processes)
+        assert all(future.done() for future in futures)
+    finally:
+        sync_engine.close()
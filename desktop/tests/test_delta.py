@@ -0,0 +1,99 @@
+import os
+import random
+
+import pytest
+
+import delta
+
+SIZE = 256 * 1024
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+def patch(basis, new_path, block_size, ops):
+    # What the receiver rebuilds: copies from its own copy, literals from the sender
+    with open(new_path, 'rb') as f:
+        new = f.read()
+    out = bytearray()
+    for kind, start, length in ops:
+        if kind == 'copy':
+            for offset, count in delta.copy_ranges([[start, length]], block_size, len(basis)):
+                out += basis[offset:offset + count]
+        else:
+            out += new[start:start + length]
+    return bytes(out)
+
+
+def round_trip(tmp_path, old, new):
+    basis_path = write(tmp_path / 'basis.bin', old)
+    new_path = write(tmp_path / 'new.bin', new)
+    block_size = delta.block_size_for(len(old))
+    ops = delta.compute_delta(new_path, block_size, delta.signatures(basis_path, block_size))
+    if ops is not None:
+        assert patch(old, new_path, block_size, ops) == new
+    return ops
+
+
+@pytest.fixture
+def old():
+    return random.Random(6).randbytes(SIZE)
+
+
+def test_unchanged_file_is_all_copies(tmp_path, old):
+    ops = round_trip(tmp_path, old, old)
+    assert ops and delta.literal_size(ops) == 0
+    assert len(ops) == 1  # consecutive blocks coalesce
+
+
+def test_insert(tmp_path, old):
+    new = old[:100_000] + b'inserted' * 300 + old[100_000:]
+    ops = round_trip(tmp_path, old, new)
+    assert ops and delta.literal_size(ops) < 3 * delta.block_size_for(SIZE) + 2400
+
+
+def test_delete(tmp_path, old):
+    new = old[:50_000] + old[57_777:]
+    ops = round_trip(tmp_path, old, new)
+    assert ops and delta.literal_size(ops) < 2 * delta.block_size_for(SIZE)
+
+
+def test_random_edits(tmp_path, old):
+    rng = random.Random(7)
+    new = bytearray(old)
+    for _ in range(20):
+        at = rng.randrange(len(new))
+        if rng.random() < 0.5:
+            new[at:at] = rng.randbytes(rng.randint(1, 500))
+        else:
+            del new[at:at + rng.randint(1, 500)]
+    ops = round_trip(tmp_path, old, bytes(new))
+    assert ops is not None and delta.literal_size(ops) < len(new) // 2
+
+
+def test_edit_in_short_last_block(tmp_path, old):
+    # The basis ends in a partial block, which copies must not run past
+    old = old[:SIZE - 700]
+    new = old[:-10] + b'0123456789'
+    round_trip(tmp_path, old, new)
+
+
+def test_empty_new_file_is_sent_whole(tmp_path, old):
+    assert round_trip(tmp_path, old, b'') is None
+
+
+def test_empty_basis_is_sent_whole(tmp_path, old):
+    assert round_trip(tmp_path, b'', old) is None
+
+
+def test_file_shorter_than_a_block_is_sent_whole(tmp_path, old):
+    short = old[:delta.block_size_for(SIZE) - 1]
+    assert round_trip(tmp_path, old, short) is None
+    assert round_trip(tmp_path, short, short + b'x') is None
+
+
+def test_unrelated_file_is_sent_whole(tmp_path, old):
+    assert round_trip(tmp_path, old, random.Random(8).randbytes(SIZE)) is None
@@ -0,0 +1,73 @@
+import asyncio
+import threading
+
+import clipimage
+import engine
+import securelink
+from device import StandInDevice
+
+
+def test_identity_loads_in_the_background(tmp_path, monkeypatch):
+    # Generating the certificate must not hold up the engine; devices get
+    # plaintext until it is ready
+    release = threading.Event()
+    load_identity = securelink.load_identity
+
+    def slow_load_identity(path):
+        release.wait(10)
+        return load_identity(path)
+
+    monkeypatch.setattr(securelink, 'load_identity', slow_load_identity)
+    ready = []
+
+    class Listener(engine.Listener):
+        def on_identity_ready(self, fingerprint):
+            ready.append(fingerprint)
+
+    config = dict(engine.default_config(), sync_folder=str(tmp_path / 'sync'), discovery=False,
+                  require_encryption=True)
+    sync_engine = engine.SyncEngine(config, str(tmp_path / 'config.json'), None, Listener(), ':memory:',
+                                    ':memory:', str(tmp_path / 'identity.pem'))
+    try:
+        assert sync_engine.fingerprint is None and not sync_engine.server.require_tls
+        address = sync_engine.start('127.0.0.1', 0)
+        assert 'fingerprint' not in sync_engine.pairing_info()
+
+        async def connect():
+            device = StandInDevice()
+            await device.connect(*address)
+            device.close()
+
+        asyncio.run(asyncio.wait_for(connect(), 10))
+
+        release.set()
+        assert sync_engine.identity_ready.wait(30)
+        assert ready == [sync_engine.fingerprint]
+        if sync_engine.fingerprint is not None:
+            assert sync_engine.server.identity is sync_engine.identity
+            assert sync_engine.server.require_tls
+            assert sync_engine.pairing_info()['fingerprint'] == sync_engine.fingerprint
+    finally:
+        release.set()
+        sync_engine.stop()
+        sync_engine.close()
+
+
+def test_polled_image_is_grabbed_only_when_the_probe_changes(monkeypatch):
+    probes = iter([b'', b'', b'shot1', b'shot1', b'shot1', b'shot2', None, None])
+    grabbed = []
+
+    def grab():
+        grabbed.append(object())
+        return grabbed[-1]
+
+    monkeypatch.setattr(clipimage, 'probe', lambda: next(probes))
+    monkeypatch.setattr(clipimage, 'grab', grab)
+    clipboard = engine.SystemClipboard()
+    images = [clipboard.paste_image() for _ in range(8)]
+    # No image, then one grab per new image; without a probe every read grabs
+    assert images[:2] == [None, None]
+    assert images[2] is images[3] is images[4] is grabbed[0]
+    assert images[5] is grabbed[1]
+    assert images[6:] == grabbed[2:]
+    assert len(grabbed) == 4
@@ -0,0 +1,69 @@
+import os
+
+import pytest
+
+import foldersync
+import transfer
+
+
+def make(root, files):
+    for rel_path, data in files.items():
+        path = os.path.join(root, *rel_path.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+
+def listing(root):
+    return sorted(rel_path for rel_path, _ in foldersync.walk_files(root))
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = foldersync.ContentIndex(str(tmp_path / 'index.sqlite3'))
+    yield index
+    index.close()
+
+
+def test_diff_sends_changes_and_deletes_only_old_files(tmp_path, index):
+    local, remote = str(tmp_path / 'local'), str(tmp_path / 'remote')
+    make(local, {'same.txt': b'same', 'changed.txt': b'new', 'added/one.txt': b'1'})
+    make(remote, {'same.txt': b'same', 'changed.txt': b'old', 'gone.txt': b'x', 'old/dir/two.txt': b'2'})
+    changed, deleted = foldersync.diff_manifests(index.scan(local), index.scan(remote))
+    assert changed == ['added/one.txt', 'changed.txt']
+    assert deleted == ['gone.txt', 'old/dir/two.txt']
+
+    # Arrived on the remote side after its manifest was taken
+    make(remote, {'late.txt': b'late', 'old/kept.txt': b'k'})
+    assert foldersync.remove_files(remote, deleted) == 2
+    assert listing(remote) == ['changed.txt', 'late.txt', 'old/kept.txt', 'same.txt']
+
+
+def test_remove_prunes_emptied_folders_but_not_the_root(tmp_path):
+    root = str(tmp_path / 'root')
+    make(root, {'a/b/c.txt': b'c'})
+    assert foldersync.remove_files(root, ['a/b/c.txt']) == 1
+    assert os.listdir(root) == []
+
+
+def test_remove_ignores_paths_outside_the_root(tmp_path):
+    root = str(tmp_path / 'root')
+    make(root, {'inside.txt': b'i'})
+    make(str(tmp_path), {'outside.txt': b'o'})
+    unsafe = ['../outside.txt', 'sub/../../outside.txt', str(tmp_path / 'outside.txt')]
+    assert foldersync.remove_files(root, unsafe) == 0
+    assert os.path.exists(tmp_path / 'outside.txt')
+    assert listing(root) == ['inside.txt']
+
+
+@pytest.mark.parametrize('name', ['..', '../x', 'a/../../x', 'a/..', '..\\x', 'a\\..\\..\\x', '/etc/passwd',
+                                  '/', 'C:\\Windows\\x', 'C:x', '', '.', './'])
+def test_safe_join_rejects_escapes(tmp_path, name):
+    with pytest.raises(ValueError):
+        transfer.safe_join(str(tmp_path), name)
+
+
+@pytest.mark.parametrize('name, parts', [('a.txt', ['a.txt']), ('a/b.txt', ['a', 'b.txt']),
+                                         ('a\\b.txt', ['a', 'b.txt']), ('./a//b.txt', ['a', 'b.txt'])])
+def test_safe_join_keeps_names_inside(tmp_path, name, parts):
+    assert transfer.safe_join(str(tmp_path), name) == os.path.join(str(tmp_path), *parts)
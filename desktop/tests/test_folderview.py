@@ -0,0 +1,80 @@
+import random
+
+import pytest
+
+import folderview
+from folderview import FileEntry, FolderView
+
+
+def names(view):
+    return [view.row(i).name for i in range(len(view))]
+
+
+def make_view(entries, column='name', reverse=False):
+    view = FolderView()
+    view.apply({entry.name: entry for entry in entries}, [], True)
+    view.set_sort(column, reverse)
+    return view
+
+
+@pytest.mark.parametrize('column', sorted(folderview.SORT_KEYS))
+def test_names_differing_only_by_case_sort_on_every_column(column):
+    view = make_view([FileEntry('README.txt', 10, 1.0), FileEntry('readme.txt', 10, 1.0),
+                      FileEntry('a.txt', 10, 1.0)], column)
+    assert names(view) == ['a.txt', 'README.txt', 'readme.txt']
+
+
+@pytest.mark.parametrize('column', sorted(folderview.SORT_KEYS))
+def test_apply_removes_the_named_row_among_ties(column):
+    view = make_view([FileEntry('README.txt', 10, 1.0), FileEntry('readme.txt', 10, 1.0)], column)
+    view.apply({}, ['readme.txt'], False)
+    assert names(view) == ['README.txt']
+    view.apply({'Readme.txt': FileEntry('Readme.txt', 10, 1.0)}, ['README.txt'], False)
+    assert names(view) == ['Readme.txt']
+
+
+def test_sort_columns_and_reverse():
+    view = make_view([FileEntry('b', 300, 1.0), FileEntry('a', 200, 3.0), FileEntry('c', 100, 2.0)])
+    assert names(view) == ['a', 'b', 'c']
+    view.set_sort('size', False)
+    assert names(view) == ['c', 'a', 'b']
+    view.set_sort('modified', True)
+    assert names(view) == ['a', 'c', 'b']
+    assert [view.index_of(name) for name in ('a', 'b', 'c')] == [0, 2, 1]
+
+
+def test_filter_is_case_insensitive_and_applies_to_changes():
+    view = make_view([FileEntry('Holiday.JPG', 1, 1.0), FileEntry('notes.txt', 1, 1.0)])
+    view.set_filter('jpg')
+    assert names(view) == ['Holiday.JPG']
+    view.apply({'beach.jpg': FileEntry('beach.jpg', 1, 1.0), 'todo.txt': FileEntry('todo.txt', 1, 1.0)}, [], False)
+    assert names(view) == ['beach.jpg', 'Holiday.JPG']
+    assert view.index_of('todo.txt') is None
+    view.set_filter('')
+    assert len(view) == 4
+
+
+@pytest.mark.parametrize('column', sorted(folderview.SORT_KEYS))
+def test_small_batches_match_a_full_rebuild(column):
+    # Bisect updates with many ties give the same rows as sorting afresh
+    rng = random.Random(column)
+    view = make_view([], column)
+    for _ in range(200):
+        changed = {}
+        for _ in range(rng.randint(0, 4)):
+            name = rng.choice(['a', 'A', 'b', 'B', 'c', 'C', 'd', 'D'])
+            changed[name] = FileEntry(name, rng.choice([1, 2]), rng.choice([1.0, 2.0]))
+        removed = [name for name in list(view.entries) if name not in changed and rng.random() < 0.2]
+        view.apply(changed, removed, False)
+        expected = make_view(view.entries.values(), column)
+        assert names(view) == names(expected)
+        assert all(view.index_of(name) == i for i, name in enumerate(names(view)))
+
+
+def test_scan_lists_regular_visible_files(tmp_path):
+    (tmp_path / 'a.txt').write_bytes(b'12345')
+    (tmp_path / '.part-a').write_bytes(b'x')
+    (tmp_path / 'folder').mkdir()
+    entries = folderview.scan(str(tmp_path))
+    assert list(entries) == ['a.txt']
+    assert entries['a.txt'].size == 5
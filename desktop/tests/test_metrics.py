@@ -0,0 +1,40 @@
+import metrics
+
+
+def test_prometheus_text():
+    registry = metrics.Registry()
+    registry.add('bytes_sent_total', 100)
+    registry.add('bytes_sent_total', 50)
+    registry.add('transfers_total', direction='send', result='ok')
+    registry.add('transfers_total', direction='send', result='error')
+    registry.observe('transfer_seconds', 0.003, direction='send')
+    registry.observe('transfer_seconds', 20.0, direction='send')
+    registry.add('frames_sent_total', device='Pixel "7"\n')
+    snapshot = registry.snapshot()
+    snapshot['gauges'] = [{'name': 'sessions_connected', 'labels': {}, 'value': 2}]
+    lines = metrics.prometheus_text(snapshot).splitlines()
+
+    assert lines.count('# TYPE syncapp_transfers_total counter') == 1
+    assert 'syncapp_bytes_sent_total 150' in lines
+    assert 'syncapp_transfers_total{direction="send",result="error"} 1' in lines
+    assert r'syncapp_frames_sent_total{device="Pixel \"7\"\n"} 1' in lines
+    assert '# TYPE syncapp_sessions_connected gauge' in lines
+    assert 'syncapp_sessions_connected 2' in lines
+    assert '# TYPE syncapp_transfer_seconds histogram' in lines
+    assert 'syncapp_transfer_seconds_bucket{direction="send",le="0.0025"} 0' in lines
+    assert 'syncapp_transfer_seconds_bucket{direction="send",le="0.005"} 1' in lines
+    assert 'syncapp_transfer_seconds_bucket{direction="send",le="10.0"} 1' in lines
+    assert 'syncapp_transfer_seconds_bucket{direction="send",le="+Inf"} 2' in lines
+    assert 'syncapp_transfer_seconds_count{direction="send"} 2' in lines
+    assert 'syncapp_transfer_seconds_sum{direction="send"} 20.003' in lines
+
+
+def test_write_snapshot_picks_the_format_by_extension(tmp_path):
+    registry = metrics.Registry()
+    registry.add('reconnects_total')
+    snapshot = registry.snapshot()
+    metrics.write_snapshot(snapshot, str(tmp_path / 'syncapp.prom'))
+    metrics.write_snapshot(snapshot, str(tmp_path / 'syncapp.json'))
+    assert 'syncapp_reconnects_total 1' in (tmp_path / 'syncapp.prom').read_text()
+    assert '"reconnects_total"' in (tmp_path / 'syncapp.json').read_text()
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['syncapp.json', 'syncapp.prom']
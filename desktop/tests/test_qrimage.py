@@ -0,0 +1,43 @@
+import importlib.util
+import threading
+
+import engine
+import qrimage
+
+ADDRESSES = ['192.168.137.1', '10.0.0.12', '172.16.4.2']
+
+
+def pairing_info():
+    return engine.pairing_info(ADDRESSES[0], 8765, 'ab:cd', ADDRESSES)
+
+
+def test_request_with_several_addresses(tmp_path):
+    info = pairing_info()
+    assert isinstance(info['addresses'], list)
+    cache = qrimage.QrCache(str(tmp_path))
+    done = threading.Event()
+    results = []
+
+    def callback(info, png, error):
+        results.append((png, error))
+        done.set()
+
+    assert cache.request(info, callback) is None
+    assert done.wait(30)
+    png, error = results[0]
+    if importlib.util.find_spec('qrcode') is None:
+        assert isinstance(error, ImportError)
+        return
+    assert error is None and png.startswith(b'\x89PNG')
+    assert cache.request(info) == png
+    assert qrimage.QrCache(str(tmp_path)).cached(pairing_info()) == png
+
+
+def test_cached_from_disk_with_several_addresses(tmp_path):
+    # Another run of the app finds the image by the same key
+    info = pairing_info()
+    png = qrimage.matrix_png([[True, False], [False, True]], size=20)
+    qrimage.QrCache(str(tmp_path)).store(qrimage.cache_key(info), png)
+    assert qrimage.QrCache(str(tmp_path)).cached(pairing_info()) == png
+    other = dict(info, addresses=ADDRESSES[:2])
+    assert qrimage.QrCache(str(tmp_path)).cached(other) is None
@@ -0,0 +1,95 @@
+import asyncio
+import os
+import socket
+
+import pytest
+
+import protocol
+import securelink
+import transfer
+
+
+@pytest.fixture
+def identity(tmp_path):
+    identity = securelink.load_identity(str(tmp_path / 'identity.pem'))
+    if identity is None:
+        pytest.skip("no way to generate a certificate here")
+    return identity
+
+
+async def connect(identity):
+    loop = asyncio.get_running_loop()
+    server_sock, client_sock = socket.socketpair()
+    for sock in (server_sock, client_sock):
+        sock.setblocking(False)
+    server = securelink.TlsLink(loop, server_sock, identity.context, server_side=True)
+    client = securelink.TlsLink(loop, client_sock, securelink.client_context(), server_side=False)
+    await asyncio.gather(server.handshake(), client.handshake())
+    client.verify(identity.fingerprint)
+    return server, client
+
+
+def test_frames_both_ways(identity, tmp_path):
+    # Payloads on both sides of OFFLOAD_SIZE, from memory and from a file.
+    # The last frame is followed by nothing: reading it must not wait for
+    # more records than its own.
+    sizes = [0, 1, 5000, securelink.OFFLOAD_SIZE - 1, securelink.OFFLOAD_SIZE, protocol.CHUNK_SIZE,
+             protocol.CHUNK_SIZE - 7]
+    payloads = [os.urandom(size) for size in sizes]
+    file_path = tmp_path / 'payload.bin'
+    file_path.write_bytes(b''.join(payloads))
+
+    async def send(link, from_file):
+        buffer = bytearray(protocol.CHUNK_SIZE)
+        offset = 0
+        with open(file_path, 'rb') as f:
+            for stream_id, payload in enumerate(payloads):
+                await link.sendall(protocol.encode_message({'type': 'next', 'size': len(payload)}))
+                if from_file:
+                    await link.sendall(protocol.encode_binary_header(stream_id, len(payload)))
+                    await link.send_range(f, offset, len(payload), buffer)
+                else:
+                    await link.sendall(protocol.encode_binary_header(stream_id, len(payload)) + payload)
+                offset += len(payload)
+
+    async def receive(link):
+        reader = transfer.FrameReader(link.recv_into, buffer_size=protocol.CHUNK_SIZE)
+        received = []
+        for _ in payloads:
+            kind, message = await reader.read_frame()
+            assert kind == 'message' and message['type'] == 'next'
+            kind, (flags, stream_id, size) = await reader.read_frame()
+            assert kind == 'binary' and size == message['size']
+            data = bytearray(size)
+            await reader.read_exact(memoryview(data))
+            received.append(bytes(data))
+        return received
+
+    async def run():
+        server, client = await connect(identity)
+        try:
+            downloaded, _ = await asyncio.wait_for(asyncio.gather(receive(client), send(server, True)), 30)
+            uploaded, _ = await asyncio.wait_for(asyncio.gather(receive(server), send(client, False)), 30)
+        finally:
+            server.sock.close()
+            client.sock.close()
+        return downloaded, uploaded
+
+    downloaded, uploaded = asyncio.run(run())
+    assert downloaded == payloads
+    assert uploaded == payloads
+
+
+def test_small_reads_return_what_is_there(identity):
+    # recv() below OFFLOAD_SIZE answers with what has arrived, as a plain
+    # socket read does
+    async def run():
+        server, client = await connect(identity)
+        try:
+            await server.sendall(b'hello')
+            return await asyncio.wait_for(client.recv(1024), 5)
+        finally:
+            server.sock.close()
+            client.sock.close()
+
+    assert asyncio.run(run()) == b'hello'
@@ -0,0 +1,296 @@
+import asyncio
+import hashlib
+import io
+import os
+import zipfile
+
+import pytest
+
+import delta
+import engine
+import protocol
+from device import StandInDevice
+from server import PRIORITY_BULK, PRIORITY_CONTROL, ConnectionManager, OutgoingFrame, SendScheduler, StripedSend
+
+
+def test_stop_closes_sockets_after_tasks(tmp_path, capfd):
+    # Stopping with a device connected and its reader waiting on the socket
+    config = dict(engine.default_config(), sync_folder=str(tmp_path / 'sync'), discovery=False)
+    sync_engine = engine.SyncEngine(config, str(tmp_path / 'config.json'), engine.MemoryClipboard(),
+                                    engine.Listener(), ':memory:', ':memory:', str(tmp_path / 'identity.pem'))
+    address = sync_engine.start('127.0.0.1', 0)
+    manager = sync_engine.server
+
+    async def run():
+        client = StandInDevice()
+        await client.connect(*address)
+        await asyncio.sleep(0.2)
+        sessions = list(manager.sessions.values())
+        await asyncio.get_running_loop().run_in_executor(None, sync_engine.stop)
+        # The server side went away: the device reads end of stream
+        assert await asyncio.wait_for(client.reader.read(), 5) == b''
+        client.close()
+        return sessions
+
+    try:
+        sessions = asyncio.run(run())
+    finally:
+        sync_engine.close()
+    assert sessions and all(session.sock.fileno() == -1 for session in sessions)
+    assert not manager.closing
+    captured = capfd.readouterr()
+    assert 'Bad file descriptor' not in captured.err
+    assert 'Exception in callback' not in captured.err
+
+
+def run_manager(tmp_path, scenario, handler=None):
+    # Runs scenario(manager, address) against a connection manager serving
+    # tmp_path/'sync'
+    sync_folder = tmp_path / 'sync'
+    sync_folder.mkdir(exist_ok=True)
+    manager = ConnectionManager(handler or engine.Listener(), lambda: str(sync_folder))
+    address = manager.start('127.0.0.1', 0)
+    try:
+        return asyncio.run(asyncio.wait_for(scenario(manager, address), 30))
+    finally:
+        manager.stop()
+
+
+DELTA_DEVICE = [protocol.CAP_STREAM, protocol.CAP_DELTA]
+
+
+@pytest.mark.parametrize('accepted', [True, False])
+def test_delta_waits_for_file_done_and_falls_back(tmp_path, accepted):
+    # The device reports whether it rebuilt the file; a failed delta is
+    # followed by the whole file
+    data = os.urandom(2 * 1024 * 1024)
+    path = tmp_path / 'doc.bin'
+    path.write_bytes(data)
+    old = tmp_path / 'old.bin'
+    old.write_bytes(data[:1000] + b'changed' + data[1007:])
+
+    async def scenario(manager, address):
+        device = StandInDevice(capabilities=DELTA_DEVICE)
+        await device.connect(*address)
+        future = asyncio.wrap_future(manager.send_file(str(path)))
+        request = await device.read_message('signature_request')
+        block_size = delta.block_size_for(len(data))
+        await device.send_message({'type': 'signatures', 'transfer_id': request['transfer_id'],
+                                   'block_size': block_size, 'blocks': delta.signatures(str(old), block_size)})
+        end = await device.read_message('delta_end')
+        await device.send_message({'type': 'file_done', 'transfer_id': end['transfer_id'], 'ok': accepted,
+                                   'error': None if accepted else "sha256 mismatch"})
+        whole = None
+        if not accepted:
+            start = await device.read_message('file_start')
+            chunks = []
+            while True:
+                kind, frame = await device.read_frame()
+                if kind == 'binary' and frame[0] == start['transfer_id']:
+                    chunks.append(frame[1])
+                elif kind == 'message' and frame['type'] == 'file_end':
+                    break
+            whole = b''.join(chunks)
+        reports = await future
+        device.close()
+        return reports, whole
+
+    reports, whole = run_manager(tmp_path, scenario)
+    assert len(reports) == 1
+    assert whole == (None if accepted else data)
+
+
+def test_delta_receiver_confirms_or_refuses(tmp_path):
+    # Our side rebuilding a file from a device's delta: a good one is
+    # confirmed, one without a copy to build on is refused
+    basis = os.urandom(64 * 1024)
+    (tmp_path / 'sync').mkdir()
+    (tmp_path / 'sync' / 'notes.bin').write_bytes(basis)
+    block_size = delta.MIN_BLOCK_SIZE
+
+    async def scenario(manager, address):
+        device = StandInDevice(capabilities=DELTA_DEVICE)
+        await device.connect(*address)
+        replies = []
+        for transfer_id, name in ((1, 'notes.bin'), (2, 'missing.bin')):
+            await device.send_message({'type': 'delta_start', 'transfer_id': transfer_id, 'name': name,
+                                       'size': len(basis), 'block_size': block_size})
+            await device.send_message({'type': 'delta_copy', 'transfer_id': transfer_id,
+                                       'blocks': [[0, len(basis) // block_size]]})
+            await device.send_message({'type': 'delta_end', 'transfer_id': transfer_id, 'size': len(basis),
+                                       'sha256': hashlib.sha256(basis).hexdigest()})
+            replies.append(await device.read_message('file_done'))
+        device.close()
+        return replies
+
+    confirmed, refused = run_manager(tmp_path, scenario)
+    assert confirmed['ok'] and confirmed['transfer_id'] == 1
+    assert not refused['ok'] and refused['transfer_id'] == 2
+    assert (tmp_path / 'sync' / 'notes.bin').read_bytes() == basis
+
+
+def test_refused_incoming_files_leave_no_part_files(tmp_path):
+    # Transfers refused after their part file was opened: names escaping
+    # the sync folder, and a delta with no copy to build on
+    errors = []
+
+    class Handler(engine.Listener):
+        def on_transfer_error(self, session, name, error):
+            errors.append(name)
+
+    async def scenario(manager, address):
+        device = StandInDevice(capabilities=[protocol.CAP_STREAM, protocol.CAP_RESUME, protocol.CAP_DELTA,
+                                             protocol.CAP_STRIPE])
+        await device.connect(*address)
+        await device.send_message({'type': 'file_start', 'transfer_id': 1, 'name': 'a.bin', 'size': 4096,
+                                   'path': '../a.bin'})
+        await device.send_message({'type': 'file_start', 'transfer_id': 2, 'name': 'b.bin', 'size': 4096,
+                                   'path': '../../b.bin', 'resume_key': 'k' * 64})
+        await device.send_message({'type': 'stripe_start', 'transfer_id': 3, 'name': 'c.bin', 'size': 4096,
+                                   'path': '/tmp/c.bin'})
+        stripe = await device.read_message('stripe_accept')
+        await device.send_message({'type': 'delta_start', 'transfer_id': 4, 'name': 'd.bin', 'size': 4096,
+                                   'block_size': delta.MIN_BLOCK_SIZE})
+        await device.send_message({'type': 'delta_end', 'transfer_id': 4, 'size': 4096, 'sha256': ''})
+        done = await device.read_message('file_done')
+        device.close()
+        return stripe, done, dict(manager.sessions)
+
+    stripe, done, sessions = run_manager(tmp_path, scenario, Handler())
+    assert stripe.get('error') and not done['ok']
+    assert sorted(errors) == ['a.bin', 'b.bin', 'c.bin', 'd.bin']
+    assert all(not session.incoming_files for session in sessions.values())
+    leftovers = [os.path.relpath(os.path.join(root, name), tmp_path)
+                 for root, dirs, files in os.walk(tmp_path) for name in files]
+    assert leftovers == []
+
+
+def test_archive_keeps_streaming_when_a_device_drops(tmp_path):
+    # Two devices get the same streamed archive; the one that disconnects
+    # part way is dropped and the other still receives all of it
+    folder = tmp_path / 'folder'
+    folder.mkdir()
+    files = {'file%d.bin' % n: os.urandom(1024 * 1024) for n in range(8)}
+    for name, data in files.items():
+        (folder / name).write_bytes(data)
+    errors = []
+
+    class Handler(engine.Listener):
+        def on_transfer_error(self, session, name, error):
+            errors.append(session.device_name)
+
+    async def scenario(manager, address):
+        staying, leaving = StandInDevice('staying'), StandInDevice('leaving')
+        for device in (staying, leaving):
+            await device.connect(*address)
+        future = asyncio.wrap_future(manager.send_folder(str(folder), 'folder.zip'))
+        await leaving.read_message('file_start')
+        leaving.close()
+        start = await staying.read_message('file_start')
+        chunks = []
+        while True:
+            kind, frame = await staying.read_frame()
+            if kind == 'binary' and frame[0] == start['transfer_id']:
+                chunks.append(frame[1])
+            elif kind == 'message' and frame['type'] == 'file_end':
+                end = frame
+                break
+        reports = await future
+        staying.close()
+        return reports, end, b''.join(chunks)
+
+    reports, end, data = run_manager(tmp_path, scenario, Handler())
+    assert len(reports) == 1 and errors == ['leaving']
+    assert end['size'] == len(data) and end['sha256'] == hashlib.sha256(data).hexdigest()
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.testzip() is None
+        assert {name: zf.read(name) for name in zf.namelist()} == files
+
+
+def test_scheduler_sends_control_first_and_bounds_bulk():
+    async def run():
+        scheduler = SendScheduler(asyncio.get_running_loop(), 2)
+        for name in (b'bulk1', b'bulk2'):
+            await scheduler.put(OutgoingFrame(name), PRIORITY_BULK)
+        # A third bulk frame waits for room; control frames never do
+        blocked = asyncio.ensure_future(scheduler.put(OutgoingFrame(b'bulk3'), PRIORITY_BULK))
+        await asyncio.sleep(0)
+        await scheduler.put(OutgoingFrame(b'ping'), PRIORITY_CONTROL)
+        await scheduler.put(OutgoingFrame(b'pong'), PRIORITY_CONTROL)
+        assert not blocked.done()
+        sent = [(await scheduler.get()).data for _ in range(3)]
+        await asyncio.wait_for(blocked, 1)
+        sent += [(await scheduler.get()).data for _ in range(2)]
+        return sent, scheduler.stats()
+
+    sent, stats = asyncio.run(run())
+    assert sent == [b'ping', b'pong', b'bulk1', b'bulk2', b'bulk3']
+    assert stats['control_sent'] == 2 and stats['bulk_sent'] == 3
+    assert stats['bulk_high_water'] == 2 and stats['bulk_queued'] == 0
+
+
+def test_scheduler_control_deadline():
+    async def run():
+        loop = asyncio.get_running_loop()
+        scheduler = SendScheduler(loop, 2)
+        await scheduler.put(OutgoingFrame(b'bulk'), PRIORITY_BULK)
+        assert await scheduler.get_control(loop.time() + 0.05) is None
+        loop.call_later(0.01, lambda: asyncio.ensure_future(scheduler.put(OutgoingFrame(b'ping'), PRIORITY_CONTROL)))
+        return (await scheduler.get_control(loop.time() + 5)).data
+
+    assert asyncio.run(run()) == b'ping'
+
+
+def test_striped_ranges_cover_the_file_once_when_a_lane_fails():
+    async def run():
+        striped = StripedSend(10 * 1000 + 1, 1000)
+        lanes = ['lane0', 'lane1']
+        taken = [striped.take(lanes[n % 2]) for n in range(6)]
+        for offset, length in taken:
+            if offset // 1000 % 2 == 0:
+                striped.ack(offset)
+        # lane1's unacknowledged ranges go back for lane0 to send
+        striped.lane_failed('lane1')
+        received = {offset: length for offset, length in taken if offset // 1000 % 2 == 0}
+        while striped.pending:
+            offset, length = striped.take('lane0')
+            assert offset not in received
+            received[offset] = length
+            striped.ack(offset)
+        # A late ack from the failed lane is harmless
+        striped.ack(1000)
+        return striped, received
+
+    striped, received = asyncio.run(run())
+    assert striped.finished
+    assert sorted(received.items()) == [(offset, 1000) for offset in range(0, 10 * 1000, 1000)] + [(10000, 1)]
+
+
+def test_clipboard_chunks_go_as_bulk_and_clipboards_arrive_in_order(tmp_path):
+    # A large clipboard's chunks are bulk frames; smaller text copied right
+    # after it must still reach the device last
+    large = 'x' * (3 * protocol.CHUNK_SIZE)
+
+    async def scenario(manager, address):
+        device = StandInDevice(capabilities=[protocol.CAP_STREAM, protocol.CAP_CLIPBOARD])
+        await device.connect(*address)
+        await asyncio.sleep(0.1)
+        session, = manager.sessions.values()
+        assert manager.send_clipboard(large) and manager.send_clipboard('small')
+        start = await device.read_message('clipboard_start')
+        received = bytearray()
+        while True:
+            kind, frame = await device.read_frame()
+            if kind == 'binary':
+                assert frame[0] == start['transfer_id']
+                received += frame[1]
+            elif frame['type'] == 'clipboard':
+                break
+        stats = session.send_queue.stats()
+        device.close()
+        return received, frame, stats
+
+    received, last, stats = run_manager(tmp_path, scenario)
+    assert received.decode('utf-8') == large
+    assert last['data'] == 'small'
+    assert stats['bulk_sent'] >= 3
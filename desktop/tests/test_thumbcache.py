@@ -0,0 +1,149 @@
+import io
+import os
+import threading
+
+import pytest
+
+import thumbcache
+
+
+class Ready:
+    # on_ready target: wait(key) until that result is stored
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.keys = []
+
+    def __call__(self, key):
+        with self.condition:
+            self.keys.append(key)
+            self.condition.notify_all()
+
+    def wait(self, key, timeout=30):
+        with self.condition:
+            assert self.condition.wait_for(lambda: key in self.keys, timeout)
+
+
+@pytest.fixture
+def ready():
+    return Ready()
+
+
+@pytest.fixture
+def cache(tmp_path, ready):
+    cache = thumbcache.ThumbnailCache(str(tmp_path / 'thumbs.sqlite3'), on_ready=ready, workers=1)
+    yield cache
+    cache.close()
+
+
+def write(path, text, mtime=None):
+    path.write_text(text)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return str(path)
+
+
+def request(cache, path, kind=thumbcache.TEXT):
+    info = os.stat(path)
+    return cache.request(path, info.st_size, info.st_mtime, kind)
+
+
+def fetch(cache, ready, path, kind=thumbcache.TEXT):
+    # Generated if need be; returns the cached bytes
+    key, data = request(cache, path, kind)
+    if data is None:
+        ready.wait(key)
+        key, data = request(cache, path, kind)
+    return data
+
+
+def test_hit_after_generating(tmp_path, cache, ready):
+    path = write(tmp_path / 'notes.txt', 'first line\nsecond line\n')
+    key, data = request(cache, path)
+    assert data is None
+    ready.wait(key)
+    assert request(cache, path) == (key, b'first line\nsecond line')
+    assert cache.get(key) == b'first line\nsecond line'
+
+
+def test_hit_from_the_cache_file_needs_no_worker(tmp_path, cache, ready):
+    path = write(tmp_path / 'notes.txt', 'cached\n')
+    assert fetch(cache, ready, path) == b'cached'
+    cache.close()
+    reopened = thumbcache.ThumbnailCache(str(tmp_path / 'thumbs.sqlite3'))
+    try:
+        assert request(reopened, path)[1] == b'cached'
+        assert reopened.pool is None
+    finally:
+        reopened.close()
+
+
+def test_size_change_invalidates(tmp_path, cache, ready):
+    path = write(tmp_path / 'notes.txt', 'short\n', mtime=1_600_000_000)
+    assert fetch(cache, ready, path) == b'short'
+    write(tmp_path / 'notes.txt', 'much longer now\n', mtime=1_600_000_000)
+    assert request(cache, path)[1] is None
+    assert fetch(cache, ready, path) == b'much longer now'
+
+
+def test_mtime_change_invalidates(tmp_path, cache, ready):
+    path = write(tmp_path / 'notes.txt', 'before\n', mtime=1_600_000_000)
+    assert fetch(cache, ready, path) == b'before'
+    write(tmp_path / 'notes.txt', 'after!\n', mtime=1_600_000_060)  # same size
+    assert request(cache, path)[1] is None
+    assert fetch(cache, ready, path) == b'after!'
+
+
+def test_same_file_elsewhere_is_a_different_entry(tmp_path, cache, ready):
+    first = write(tmp_path / 'a.txt', 'same\n', mtime=1_600_000_000)
+    second = write(tmp_path / 'b.txt', 'same\n', mtime=1_600_000_000)
+    fetch(cache, ready, first)
+    assert request(cache, second)[1] is None
+
+
+def test_binary_file_has_no_preview(tmp_path, cache, ready):
+    path = tmp_path / 'data.txt'
+    path.write_bytes(b'\x00\x01\x02' * 100)
+    assert fetch(cache, ready, str(path)) == b''
+
+
+def test_least_recently_used_are_evicted(tmp_path, ready):
+    cache = thumbcache.ThumbnailCache(str(tmp_path / 'thumbs.sqlite3'), limit=4000, on_ready=ready, workers=1)
+    try:
+        paths = [write(tmp_path / f'{n}.txt', (str(n) * 60 + '\n') * 20) for n in range(4)]  # 1.2 KB heads
+        for path in paths[:3]:
+            fetch(cache, ready, path)
+        fetch(cache, ready, paths[0])  # used again: now newer than 1 and 2
+        fetch(cache, ready, paths[3])  # over the limit
+        assert cache.total <= 4000
+        cache.close()
+        cache = thumbcache.ThumbnailCache(str(tmp_path / 'thumbs.sqlite3'), limit=4000)
+        assert [request(cache, path)[1] is not None for path in paths] == [True, False, False, True]
+    finally:
+        cache.close()
+
+
+def test_scrolled_past_rows_are_dropped(tmp_path, cache):
+    paths = [write(tmp_path / f'{n}.txt', f'{n}\n') for n in range(50)]
+    keys = [request(cache, path)[0] for path in paths]
+    cache.keep({keys[-1]}, thumbcache.TEXT)
+    assert len(cache.pending) < 50
+    assert keys[-1] in cache.pending or cache.get(keys[-1]) is not None
+
+
+def test_close_joins_the_workers(tmp_path, cache):
+    paths = [write(tmp_path / f'{n}.txt', f'{n}\n') for n in range(20)]
+    for path in paths:
+        request(cache, path)
+    processes = list(cache.pool._processes.values())
+    cache.close()
+    assert processes and not any(process.is_alive() for process in processes)
+
+
+def test_image_thumbnail(tmp_path, cache, ready):
+    Image = pytest.importorskip('PIL.Image')
+    path = str(tmp_path / 'photo.jpg')
+    Image.new('RGB', (1600, 1200), (200, 40, 40)).save(path)
+    data = fetch(cache, ready, path, thumbcache.THUMB)
+    with Image.open(io.BytesIO(data)) as thumbnail:
+        assert thumbnail.format == 'PNG'
+        assert max(thumbnail.size) == thumbcache.BOXES[thumbcache.THUMB]
@@ -0,0 +1,162 @@
+import asyncio
+import hashlib
+import os
+import random
+import zlib
+
+import pytest
+
+import protocol
+import transfer
+
+
+def trickle(data, seed=0):
+    # recv_into over data that hands out a few bytes at a time, the way a
+    # socket does under load
+    rng = random.Random(seed)
+    view = memoryview(data)
+
+    async def recv_into(buffer):
+        nonlocal view
+        count = min(len(buffer), len(view), rng.randint(1, 5000))
+        buffer[:count] = view[:count]
+        view = view[count:]
+        return count
+
+    return recv_into
+
+
+def test_frame_reader_reads_messages_and_binary_frames():
+    payload = os.urandom(100_000)
+    packed = zlib.compress(payload)
+    big = {'type': 'manifest', 'names': ['file%d' % n for n in range(50_000)]}
+    stream = b''.join([
+        protocol.encode_message({'type': 'hello', 'text': 'grüße'}),
+        protocol.encode_binary_header(7, len(payload)) + payload,
+        protocol.encode_binary_header(8, len(packed), protocol.FLAG_COMPRESSED) + packed,
+        protocol.encode_compressed_message(zlib.compress(protocol.encode_message(big)[protocol.LENGTH.size:])),
+        protocol.encode_message(big),
+        protocol.encode_binary_header(9, 0),
+    ])
+
+    async def run():
+        reader = transfer.FrameReader(trickle(stream), buffer_size=1024, decompress=zlib.decompress)
+        frames = []
+        while len(frames) < 6:
+            kind, frame = await reader.read_frame()
+            if kind == 'binary':
+                flags, stream_id, size = frame
+                data = bytearray(size)
+                await reader.read_exact(memoryview(data))
+                frame = (stream_id, bytes(data))
+            frames.append((kind, frame))
+        with pytest.raises(ConnectionError):
+            await reader.read_frame()
+        return frames
+
+    assert asyncio.run(run()) == [
+        ('message', {'type': 'hello', 'text': 'grüße'}),
+        ('binary', (7, payload)),
+        ('binary', (8, payload)),
+        ('message', big),
+        ('message', big),
+        ('binary', (9, b'')),
+    ]
+
+
+def test_frame_reader_refuses_compressed_frames_without_a_codec():
+    stream = protocol.encode_binary_header(1, 4, protocol.FLAG_COMPRESSED) + b'abcd'
+
+    async def run():
+        await transfer.FrameReader(trickle(stream)).read_frame()
+
+    with pytest.raises(ValueError):
+        asyncio.run(run())
+
+
+@pytest.fixture
+def writer():
+    return transfer.WriteBehind(transfer.BufferPool(4, 64 * 1024))
+
+
+def write(incoming, data):
+    incoming.write_bytes(data)
+    incoming.writer.flush(incoming)
+
+
+def test_journal_entries_and_keys(tmp_path):
+    journal = transfer.ResumeJournal(str(tmp_path))
+    assert journal.entries() == []
+    for key, device in (('a' * 32, 'phone'), ('b' * 32, 'tablet')):
+        journal.part_path(key)
+        journal.save({'resume_key': key, 'name': 'x.bin', 'size': 10, 'committed': 0, 'device': device})
+    assert [entry['resume_key'] for entry in journal.entries('phone')] == ['a' * 32]
+    assert len(journal.entries()) == 2
+    journal.remove('a' * 32)
+    assert journal.load('a' * 32) is None
+    with pytest.raises(ValueError):
+        journal.part_path('../../etc/passwd')
+
+
+def test_resume_continues_after_the_committed_bytes(tmp_path, writer, monkeypatch):
+    monkeypatch.setattr(transfer, 'CHECKPOINT_BYTES', 64 * 1024)
+    data = os.urandom(300 * 1024)
+    journal = transfer.ResumeJournal(str(tmp_path))
+    key = 'c' * 32
+
+    incoming = transfer.IncomingFile(str(tmp_path), 'photo.jpg', len(data), writer, journal, key, 'phone')
+    incoming.save_journal()
+    write(incoming, data[:200 * 1024])
+    cached = incoming.suspend()
+    assert cached[0] == journal.load(key)['committed'] == 200 * 1024
+
+    # Re-hashed from disk as after a restart, then from the digest kept in
+    # memory while the app was running
+    incoming = transfer.IncomingFile.resume(str(tmp_path), 'photo.jpg', len(data), writer, journal, key, 'phone')
+    assert incoming.received == 200 * 1024
+    cached = incoming.suspend()
+    incoming = transfer.IncomingFile.resume(str(tmp_path), 'photo.jpg', len(data), writer, journal, key, 'phone',
+                                            cached)
+    assert incoming.digest is cached[1]
+    write(incoming, data[200 * 1024:])
+    path = incoming.finish(hashlib.sha256(data).hexdigest())
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    assert journal.entries() == []
+
+
+def test_resume_starts_over_when_the_journal_does_not_match(tmp_path, writer):
+    journal = transfer.ResumeJournal(str(tmp_path))
+    key = 'd' * 32
+    incoming = transfer.IncomingFile(str(tmp_path), 'a.bin', 1000, writer, journal, key, 'phone')
+    write(incoming, b'x' * 500)
+    incoming.suspend()
+
+    incoming = transfer.IncomingFile.resume(str(tmp_path), 'a.bin', 2000, writer, journal, key, 'phone')
+    assert incoming.received == 0
+    assert journal.load(key)['size'] == 2000
+    incoming.abort()
+    assert not os.path.exists(incoming.part_path) and journal.load(key) is None
+
+
+def test_striped_ranges_reassemble_out_of_order(tmp_path, writer):
+    data = os.urandom(5 * 64 * 1024 + 123)
+    ranges = [(offset, data[offset:offset + 64 * 1024]) for offset in range(0, len(data), 64 * 1024)]
+    random.Random(3).shuffle(ranges)
+    incoming = transfer.IncomingFile(str(tmp_path), 'video.mp4', len(data), writer)
+    incoming.striped = True
+    for offset, chunk in ranges:
+        buffer = writer.pool.acquire()
+        buffer[:len(chunk)] = chunk
+        writer.submit(incoming, offset, buffer, len(chunk))
+    path = incoming.finish(hashlib.sha256(data).hexdigest())
+    with open(path, 'rb') as f:
+        assert f.read() == data
+
+
+def test_checksum_mismatch_removes_the_part_file(tmp_path, writer):
+    incoming = transfer.IncomingFile(str(tmp_path), 'a.bin', 4, writer)
+    write(incoming, b'abcd')
+    with pytest.raises(ValueError):
+        incoming.finish(hashlib.sha256(b'abce').hexdigest())
+    assert os.listdir(tmp_path) == []
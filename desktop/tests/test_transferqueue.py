@@ -0,0 +1,134 @@
+import asyncio
+import threading
+import time
+
+import engine
+import protocol
+import transferqueue
+from device import StandInDevice
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.02)
+
+
+def make_engine(tmp_path):
+    config = dict(engine.default_config(), sync_folder=str(tmp_path / 'sync'), discovery=False)
+    return engine.SyncEngine(config, str(tmp_path / 'config.json'), engine.MemoryClipboard(), engine.Listener(),
+                             ':memory:', str(tmp_path / 'queue.sqlite3'), str(tmp_path / 'identity.pem'))
+
+
+def test_job_interrupted_by_stop_is_queued_after_restart(tmp_path):
+    path = tmp_path / 'photo.bin'
+    path.write_bytes(bytes(2 * 1024 * 1024))
+    sync_engine = make_engine(tmp_path)
+    address = sync_engine.start('127.0.0.1', 0)
+    try:
+        async def run():
+            # The device connects and never answers file_start, so the transfer stays in flight
+            client = StandInDevice(capabilities=[protocol.CAP_STREAM, protocol.CAP_RESUME])
+            await client.connect(*address)
+            job = sync_engine.queue_file(str(path))
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, wait_for, lambda: job.state == transferqueue.RUNNING)
+            await loop.run_in_executor(None, sync_engine.stop)
+            client.close()
+            return job
+
+        job = asyncio.run(run())
+        wait_for(lambda: job.state == transferqueue.QUEUED)
+    finally:
+        sync_engine.close()
+
+    restarted = make_engine(tmp_path)
+    try:
+        jobs = restarted.queue.snapshot()
+        assert [(j.id, j.name, j.state) for j in jobs] == [(job.id, 'photo.bin', transferqueue.QUEUED)]
+        time.sleep(0.2)  # no device connected: it waits
+        assert jobs[0].state == transferqueue.QUEUED
+    finally:
+        restarted.close()
+
+
+def test_job_running_at_exit_is_queued_after_restart(tmp_path):
+    release = threading.Event()
+    db_path = str(tmp_path / 'queue.sqlite3')
+    queue = transferqueue.TransferQueue(db_path, lambda job: release.wait(), lambda job: True)
+    queue.start()
+    job = queue.add('file', str(tmp_path / 'a.bin'), 'a.bin')
+    wait_for(lambda: job.state == transferqueue.RUNNING)
+    queue.close()
+    release.set()
+
+    queue = transferqueue.TransferQueue(db_path, lambda job: [], lambda job: False)
+    try:
+        assert [j.state for j in queue.snapshot()] == [transferqueue.QUEUED]
+    finally:
+        queue.close()
+
+
+def test_concurrency_limit(tmp_path):
+    lock = threading.Lock()
+    release = threading.Event()
+    running = []
+    peak = []
+
+    def run_job(job):
+        with lock:
+            running.append(job.id)
+            peak.append(len(running))
+        release.wait(10)
+        time.sleep(0.01)
+        with lock:
+            running.remove(job.id)
+        return []
+
+    queue = transferqueue.TransferQueue(str(tmp_path / 'queue.sqlite3'), run_job, lambda job: True, limit=2)
+    queue.start()
+    try:
+        jobs = [queue.add('file', str(tmp_path / f'{n}.bin'), f'{n}.bin') for n in range(6)]
+        wait_for(lambda: len(running) == 2)
+        time.sleep(0.2)  # nothing else may start while both are busy
+        assert len(running) == 2
+        assert sum(job.state == transferqueue.RUNNING for job in jobs) == 2
+        release.set()
+        wait_for(lambda: all(job.state == transferqueue.DONE for job in jobs))
+        assert max(peak) == 2
+    finally:
+        queue.close()
+
+
+def test_progress_follows_the_job_not_the_name(tmp_path):
+    # Two queued files with the same name, sent at once, and an incoming
+    # one by that name too: each job only counts its own bytes
+    sizes = [3 * 256 * 1024, 5 * 256 * 1024 + 17]
+    paths = []
+    for n, size in enumerate(sizes):
+        (tmp_path / str(n)).mkdir()
+        paths.append(tmp_path / str(n) / 'report.pdf')
+        paths[-1].write_bytes(bytes(size))
+    sync_engine = make_engine(tmp_path)
+    address = sync_engine.start('127.0.0.1', 0)
+    try:
+        async def run():
+            device = StandInDevice()
+            await device.connect(*address)
+            loop = asyncio.get_running_loop()
+            jobs = [sync_engine.queue_file(str(path)) for path in paths]
+            await device.send_message({'type': 'file_start', 'transfer_id': 1, 'name': 'report.pdf', 'size': 10})
+            await device.send_binary(1, b'0123456789')
+            await device.send_message({'type': 'file_end', 'transfer_id': 1, 'size': 10})
+            for _ in jobs:
+                await device.read_message('file_end')
+            await loop.run_in_executor(None, wait_for,
+                                       lambda: all(job.state == transferqueue.DONE for job in jobs))
+            device.close()
+            return jobs
+
+        jobs = asyncio.run(run())
+    finally:
+        sync_engine.close()
+    assert [(job.size, job.done) for job in jobs] == [(size, size) for size in sizes]
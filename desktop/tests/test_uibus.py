@@ -0,0 +1,79 @@
+import threading
+
+import uibus
+
+
+class Root:
+    # Records root.after calls instead of running a Tk main loop
+    def __init__(self):
+        self.scheduled = []
+
+    def after(self, delay, callback):
+        self.scheduled.append(callback)
+
+    def run(self):
+        scheduled, self.scheduled = self.scheduled, []
+        for callback in scheduled:
+            callback()
+
+
+def test_events_in_a_frame_are_coalesced():
+    root = Root()
+    bus = uibus.UiBus(root)
+    calls = []
+    for n in range(100):
+        bus.latest('status', lambda text: calls.append(('status', text)), f"status {n}")
+        bus.merge('progress', lambda items: calls.append(('progress', items)), f"file{n % 3}", n)
+        bus.collect('files', lambda items: calls.append(('files', items)), f"file{n}")
+    bus.call(calls.append, 'once')
+    bus.call(calls.append, 'twice')
+    assert len(root.scheduled) == 1
+
+    root.run()
+    assert calls == [
+        ('status', 'status 99'),
+        ('progress', {'file0': 99, 'file1': 97, 'file2': 98}),
+        ('files', [f"file{n}" for n in range(100)]),
+        'once',
+        'twice',
+    ]
+
+    # Events after a frame go into the next one
+    bus.latest('status', lambda text: calls.append(('status', text)), 'idle')
+    assert len(root.scheduled) == 1
+    root.run()
+    assert calls[-1] == ('status', 'idle')
+
+
+def test_posting_from_threads_and_after_close():
+    root = Root()
+    bus = uibus.UiBus(root)
+    items = []
+
+    def post(start):
+        for n in range(start, start + 500):
+            bus.collect('files', items.extend, n)
+
+    threads = [threading.Thread(target=post, args=(n * 500,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    root.run()
+    assert sorted(items) == list(range(2000))
+
+    bus.close()
+    bus.call(items.append, 'late')
+    assert root.scheduled == []
+    assert items[-1] != 'late'
+
+
+def test_a_failing_callback_does_not_stop_the_frame(capsys):
+    root = Root()
+    bus = uibus.UiBus(root)
+    calls = []
+    bus.call(lambda: 1 / 0)
+    bus.call(calls.append, 'after')
+    root.run()
+    assert calls == ['after']
+    assert 'UI update failed' in capsys.readouterr().out
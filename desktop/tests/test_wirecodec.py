@@ -0,0 +1,46 @@
+import pytest
+
+import wirecodec
+
+
+def codecs():
+    # Every codec this module knows, skipping those not installed
+    yield wirecodec.ZlibCodec()
+    if wirecodec.zstandard is not None:
+        yield wirecodec.ZstdCodec()
+    if wirecodec.lz4 is not None:
+        yield wirecodec.Lz4Codec()
+
+
+@pytest.fixture(params=list(codecs()), ids=lambda codec: codec.name)
+def codec(request):
+    return request.param
+
+
+def test_round_trip(codec):
+    data = b'clipboard text and file chunks ' * 1000
+    assert codec.decompress(codec.compress(data)) == data
+
+
+def test_payload_at_the_limit(codec):
+    data = bytes(wirecodec.MAX_DECOMPRESSED)
+    assert len(codec.decompress(codec.compress(data))) == wirecodec.MAX_DECOMPRESSED
+
+
+def test_rejects_payload_over_the_limit(codec):
+    bomb = codec.compress(bytes(wirecodec.MAX_DECOMPRESSED + 1))
+    assert len(bomb) < 1024 * 1024
+    with pytest.raises(Exception):
+        codec.decompress(bomb)
+
+
+def test_rejects_truncated_payload(codec):
+    packed = codec.compress(b'clipboard text and file chunks ' * 1000)
+    with pytest.raises(Exception):
+        codec.decompress(packed[:len(packed) // 2])
+
+
+def test_zlib_truncated_stream_is_a_value_error():
+    packed = wirecodec.ZlibCodec().compress(bytes(range(256)) * 100)
+    with pytest.raises(ValueError):
+        wirecodec.ZlibCodec().decompress(packed[:-4])
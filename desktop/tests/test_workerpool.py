@@ -0,0 +1,19 @@
+import concurrent.futures
+import time
+
+import workerpool
+
+
+def test_queued_jobs_are_cancelled_and_stragglers_terminated(capsys):
+    pool = concurrent.futures.ProcessPoolExecutor(1)
+    pool.submit(time.sleep, 0).result()
+    pool.submit(time.sleep, 60)
+    queued = [pool.submit(time.sleep, 60) for _ in range(4)]
+    time.sleep(0.2)
+    processes = list(pool._processes.values())
+    started = time.monotonic()
+    workerpool.shutdown(pool, 0.5, 'test')
+    assert time.monotonic() - started < 10
+    assert all(not process.is_alive() for process in processes)
+    assert any(future.cancelled() for future in queued)
+    assert 'Test workers did not stop in time' in capsys.readouterr().out
@@ -0,0 +1,265 @@
+# Thumbnails and previews for the Files tab. Images are scaled and text
+# files read in worker processes, so decoding a folder of photos never
+# runs on the Tk thread, and the results are kept in an SQLite cache
+# (sync_thumbs.sqlite3) keyed by path, size and mtime: a file that changes
+# gets a new key, and its old entries age out. The cache is trimmed, least
+# recently used first, when it grows past CACHE_BYTES. Recent results are
+# also held in memory, so scrolling back over rows already seen does not
+# touch the disk at all.
+#
+# PIL is optional: without it images get no thumbnail and text previews
+# work as before.
+import collections
+import concurrent.futures
+import hashlib
+import importlib.util
+import io
+import os
+import sqlite3
+import threading
+import time
+
+import workerpool
+
+CACHE_FILE = "sync_thumbs.sqlite3"
+CACHE_BYTES = 64 * 1024 * 1024
+
+# Bytes of recent results held in memory in front of the cache file
+MEMORY_BYTES = 8 * 1024 * 1024
+
+# Last-used times are written in batches of this many hits
+TOUCH_BATCH = 64
+
+# Seconds close() waits for workers to finish the file they are on once
+# queued ones are cancelled; stragglers are then terminated
+SHUTDOWN_TIMEOUT = 5
+
+# Kinds of result: a row icon and a preview for images, a head for text
+THUMB = 'thumb'
+PREVIEW = 'preview'
+TEXT = 'text'
+BOXES = {THUMB: 32, PREVIEW: 320}
+
+TEXT_HEAD_BYTES = 8 * 1024
+TEXT_HEAD_LINES = 60
+
+# Images with more pixels than this are not decoded
+MAX_PIXELS = 100 * 1024 * 1024
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.tif', '.tiff', '.ico'}
+TEXT_EXTENSIONS = {
+    '.txt', '.md', '.rst', '.log', '.csv', '.tsv', '.json', '.xml', '.html', '.htm', '.css', '.js', '.ts',
+    '.py', '.java', '.kt', '.dart', '.c', '.h', '.cpp', '.hpp', '.go', '.rs', '.sh', '.bat', '.ps1',
+    '.yaml', '.yml', '.toml', '.ini', '.cfg', '.conf', '.sql'
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS thumbnails (
+    key TEXT PRIMARY KEY,
+    data BLOB NOT NULL,
+    used REAL NOT NULL
+)
+"""
+USED_INDEX = "CREATE INDEX IF NOT EXISTS thumbnails_used ON thumbnails (used)"
+
+
+def preview_kind(name):
+    # 'image', 'text' or None for files without a preview
+    extension = os.path.splitext(name)[1].lower()
+    if extension in IMAGE_EXTENSIONS:
+        return 'image'
+    if extension in TEXT_EXTENSIONS:
+        return 'text'
+    return None
+
+
+def cache_key(path, size, mtime, kind):
+    return hashlib.blake2b(f"{kind}\0{size}\0{mtime!r}\0{path}".encode('utf-8', 'surrogateescape'),
+                           digest_size=16).hexdigest()
+
+
+# Worker process side. Each returns the bytes to cache: a PNG for images,
+# UTF-8 text for text heads, and b'' when the file has no preview.
+
+def render_image(path, box):
+    from PIL import Image, ImageOps
+    with Image.open(path) as image:
+        if image.size[0] * image.size[1] > MAX_PIXELS:
+            return b''
+        # JPEGs decode at 1/2 to 1/8 scale straight away, the bulk of the saving
+        image.draft('RGB', (box, box))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((box, box))
+        if image.mode not in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA'):
+            image = image.convert('RGBA')
+        buffer = io.BytesIO()
+        image.save(buffer, 'PNG', compress_level=1)
+        return buffer.getvalue()
+
+
+def read_text_head(path):
+    with open(path, 'rb') as f:
+        data = f.read(TEXT_HEAD_BYTES)
+    if b'\0' in data:
+        return b''  # binary after all
+    lines = data.decode('utf-8', 'replace').splitlines()[:TEXT_HEAD_LINES]
+    return '\n'.join(lines).encode('utf-8')
+
+
+def generate(path, kind):
+    try:
+        if kind == TEXT:
+            return read_text_head(path)
+        return render_image(path, BOXES[kind])
+    except ImportError:
+        raise
+    except Exception:
+        # Unreadable or not really an image; cached so it is not tried again
+        return b''
+
+
+class ThumbnailCache:
+    # get() answers from memory or the cache file at once. request() does
+    # the same and, on a miss, queues the file for a worker process;
+    # on_ready(key) is called from a pool thread once the result is stored.
+    def __init__(self, db_path=CACHE_FILE, limit=CACHE_BYTES, on_ready=None, workers=None):
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.limit = limit
+        self.on_ready = on_ready or (lambda key: None)
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.memory = collections.OrderedDict()  # key -> data, least recently used first
+        self.memory_bytes = 0
+        self.touched = {}  # key -> last used, not yet written
+        self.pending = {}  # key -> (future, kind)
+        self.pool = None
+        self.closed = False
+        self.images = importlib.util.find_spec('PIL') is not None
+        with self.lock, self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute(SCHEMA)
+            self.db.execute(USED_INDEX)
+            self.total = self.db.execute('SELECT COALESCE(SUM(LENGTH(data)), 0) FROM thumbnails').fetchone()[0]
+
+    def available(self, kind):
+        return kind == TEXT or self.images
+
+    def get(self, key):
+        # Cached bytes (b'' for no preview), or None on a miss
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+            else:
+                row = self.db.execute('SELECT data FROM thumbnails WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    return None
+                data = bytes(row[0])
+                self.remember(key, data)
+            self.touched[key] = time.time()
+            if len(self.touched) >= TOUCH_BATCH:
+                self.write_touched()
+        return data
+
+    def request(self, path, size, mtime, kind):
+        # (key, cached bytes or None); a miss starts generating it unless it
+        # is already on its way
+        key = cache_key(path, size, mtime, kind)
+        data = self.get(key)
+        if data is not None or not self.available(kind):
+            return key, data
+        with self.lock:
+            if self.closed or key in self.pending:
+                return key, None
+            if self.pool is None:
+                self.pool = concurrent.futures.ProcessPoolExecutor(self.workers)
+            future = self.pool.submit(generate, path, kind)
+            self.pending[key] = (future, kind)
+        future.add_done_callback(lambda future: self.finish(key, future))
+        return key, None
+
+    def keep(self, keys, kind=THUMB):
+        # Drops queued work of this kind for keys not in keys: rows that
+        # scrolled out of view before a worker got to them
+        with self.lock:
+            stale = [future for key, (future, queued) in self.pending.items() if queued == kind and key not in keys]
+        for future in stale:
+            future.cancel()  # outside the lock: finish() runs from here
+
+    def finish(self, key, future):
+        if future.cancelled():
+            with self.lock:
+                self.pending.pop(key, None)
+            return
+        try:
+            data = future.result()
+        except ImportError:
+            self.images = False  # no PIL in the workers; stop asking
+            data = None
+        except Exception as e:
+            print(f"Preview failed: {e}")
+            data = None
+        with self.lock:
+            self.pending.pop(key, None)
+            if data is None or self.closed:
+                return
+            self.store(key, data)
+        self.on_ready(key)
+
+    def store(self, key, data):
+        # With the lock held
+        with self.db:
+            previous = self.db.execute('SELECT LENGTH(data) FROM thumbnails WHERE key = ?', (key,)).fetchone()
+            self.db.execute('INSERT OR REPLACE INTO thumbnails (key, data, used) VALUES (?, ?, ?)',
+                            (key, data, time.time()))
+        self.total += len(data) - (previous[0] if previous else 0)
+        self.remember(key, data)
+        if self.total > self.limit:
+            self.trim()
+
+    def remember(self, key, data):
+        previous = self.memory.pop(key, None)
+        if previous is not None:
+            self.memory_bytes -= len(previous)
+        self.memory[key] = data
+        self.memory_bytes += len(data)
+        while self.memory_bytes > MEMORY_BYTES and len(self.memory) > 1:
+            _, dropped = self.memory.popitem(last=False)
+            self.memory_bytes -= len(dropped)
+
+    def write_touched(self):
+        if self.touched:
+            with self.db:
+                self.db.executemany('UPDATE thumbnails SET used = ? WHERE key = ?',
+                                    [(used, key) for key, used in self.touched.items()])
+            self.touched.clear()
+
+    def trim(self):
+        # Least recently used entries go until the cache is a tenth under
+        # its limit, so it is not trimmed again on the next insert
+        self.write_touched()
+        target = self.limit * 9 // 10
+        with self.db:
+            rows = self.db.execute('SELECT key, LENGTH(data) FROM thumbnails ORDER BY used').fetchall()
+            doomed = []
+            for key, size in rows:
+                if self.total <= target:
+                    break
+                doomed.append((key,))
+                self.total -= size
+            self.db.executemany('DELETE FROM thumbnails WHERE key = ?', doomed)
+        for (key,) in doomed:
+            data = self.memory.pop(key, None)
+            if data is not None:
+                self.memory_bytes -= len(data)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            workerpool.shutdown(pool, SHUTDOWN_TIMEOUT, 'thumbnail')
+        with self.lock:
+            self.write_touched()
+            self.db.close()
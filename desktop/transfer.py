@@ -0,0 +1,587 @@
+# File transfer engine: frame reading with reusable buffers, incoming files
+# written to disk by a write-behind thread and outgoing file data pushed to
+# the socket with sendfile. Socket I/O runs on the connection manager's
+# asyncio loop; disk writes and hashing stay off it.
+import asyncio
+import binascii
+import hashlib
+import json
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+
+import metrics
+import protocol
+
+# Frames larger than this get a one-off buffer instead of growing the shared one
+MAX_REUSED_FRAME = 4 * 1024 * 1024
+
+# Legacy base64 payloads are decoded and written in slices of this size
+BASE64_SLICE = 4 * 1024 * 1024
+
+# Partially received files that can be resumed live in this hidden folder
+JOURNAL_DIR = '.syncapp-partial'
+
+# How often a resumable transfer records its progress in the journal
+CHECKPOINT_BYTES = 8 * 1024 * 1024
+
+RESUME_KEY = re.compile(r'[0-9a-f]{16,64}')
+
+
+class FrameReader:
+    # Reads length-prefixed frames with recv_into so no intermediate bytes
+    # objects are built while a frame arrives. recv_into is the link's
+    # (plain or TLS) coroutine filling a buffer.
+    def __init__(self, recv_into, buffer_size=64 * 1024, decompress=None):
+        self.recv_into = recv_into
+        self.header = bytearray(protocol.LENGTH.size + protocol.BINARY_HEADER.size)
+        self.header_view = memoryview(self.header)
+        self.buffer = bytearray(buffer_size)
+        self.decompress = decompress  # for FLAG_COMPRESSED payloads
+        self.payload = None  # decompressed payload still to be consumed
+        self.frame_size = 0  # wire bytes of the last frame read
+
+    async def read_exact(self, view):
+        if self.payload is not None:
+            # Serve the current frame's decompressed payload instead of the socket
+            size = len(view)
+            view[:] = self.payload[:size]
+            self.payload = self.payload[size:]
+            return
+
+        received = 0
+        size = len(view)
+        while received < size:
+            count = await self.recv_into(view[received:])
+            if not count:
+                raise ConnectionError("Connection closed by peer")
+            received += count
+
+    async def read_frame(self):
+        # Returns ('message', dict) for JSON frames and
+        # ('binary', (flags, stream_id, payload_size)) for binary frames; the
+        # caller must then consume the payload with read_exact. Compressed
+        # payloads are decompressed here, so callers see the original bytes.
+        self.payload = None
+        await self.read_exact(self.header_view[:protocol.LENGTH.size])
+        is_binary, frame_size = protocol.split_length(protocol.LENGTH.unpack_from(self.header)[0])
+
+        self.frame_size = protocol.LENGTH.size + frame_size
+        if is_binary:
+            await self.read_exact(self.header_view[protocol.LENGTH.size:])
+            flags, stream_id = protocol.BINARY_HEADER.unpack_from(self.header, protocol.LENGTH.size)
+            payload_size = frame_size - protocol.BINARY_HEADER.size
+            if flags & (protocol.FLAG_COMPRESSED | protocol.FLAG_MESSAGE):
+                data = bytearray(payload_size)
+                await self.read_exact(memoryview(data))
+                if flags & protocol.FLAG_COMPRESSED:
+                    if self.decompress is None:
+                        raise ValueError("Compressed frame without a negotiated codec")
+                    data = self.decompress(data)
+                if flags & protocol.FLAG_MESSAGE:
+                    return 'message', protocol.decode_message(data)
+                self.payload = memoryview(data)
+                payload_size = len(data)
+            return 'binary', (flags, stream_id, payload_size)
+
+        if frame_size > MAX_REUSED_FRAME:
+            buffer = bytearray(frame_size)
+        else:
+            if frame_size > len(self.buffer):
+                self.buffer = bytearray(frame_size)
+            buffer = self.buffer
+        view = memoryview(buffer)[:frame_size]
+        await self.read_exact(view)
+        return 'message', protocol.decode_message(view)
+
+    async def skip(self, size):
+        # Discard a payload nobody is waiting for
+        view = memoryview(self.buffer)
+        while size:
+            count = min(size, len(view))
+            await self.read_exact(view[:count])
+            size -= count
+
+
+class BufferPool:
+    # Fixed set of reusable chunk buffers. Acquiring blocks when the disk
+    # writer falls behind, which bounds memory and pushes back on the socket.
+    def __init__(self, count=8, size=protocol.CHUNK_SIZE):
+        self.size = size
+        self.free = queue.Queue()
+        for _ in range(count):
+            self.free.put(bytearray(size))
+
+    def acquire(self):
+        return self.free.get()
+
+    async def acquire_async(self, loop):
+        # Only parks an executor thread when the writer is actually behind
+        try:
+            return self.free.get_nowait()
+        except queue.Empty:
+            return await loop.run_in_executor(None, self.free.get)
+
+    def release(self, buffer):
+        self.free.put(buffer)
+
+
+class CopyRange:
+    # Write-behind job payload: copy bytes from another open file (the
+    # receiver's existing copy when applying a delta)
+    __slots__ = ('fd', 'offset')
+
+    def __init__(self, fd, offset):
+        self.fd = fd
+        self.offset = offset
+
+
+class WriteBehind:
+    # Single background thread that writes received chunks at their offsets
+    # and hashes them, shared by every incoming file.
+    def __init__(self, pool=None):
+        self.pool = pool or BufferPool()
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, incoming, offset, buffer, size):
+        self.jobs.put((incoming, offset, buffer, size))
+
+    def submit_copy(self, incoming, offset, source_fd, source_offset, size):
+        self.jobs.put((incoming, offset, CopyRange(source_fd, source_offset), size))
+
+    def flush(self, incoming):
+        # Wait until every chunk queued for this file has been written
+        done = threading.Event()
+        self.jobs.put((incoming, None, done, 0))
+        done.wait()
+
+    def _run(self):
+        while True:
+            incoming, offset, buffer, size = self.jobs.get()
+            if offset is None:
+                buffer.set()
+                continue
+            if isinstance(buffer, CopyRange):
+                try:
+                    if incoming.error is None:
+                        incoming.copy_at(offset, buffer.fd, buffer.offset, size)
+                except Exception as e:
+                    incoming.error = e
+                continue
+            try:
+                if incoming.error is None:
+                    incoming.write_at(offset, memoryview(buffer)[:size])
+            except Exception as e:
+                incoming.error = e
+            finally:
+                self.pool.release(buffer)
+
+
+def unique_path(folder, file_name):
+    file_path = os.path.join(folder, os.path.basename(file_name))
+
+    # Handle duplicate names
+    counter = 1
+    original_path = file_path
+    while os.path.exists(file_path):
+        name, ext = os.path.splitext(original_path)
+        file_path = f"{name}_{counter}{ext}"
+        counter += 1
+    return file_path
+
+
+def safe_join(folder, rel_path):
+    # Resolve a peer-supplied relative path without letting it escape folder
+    parts = [part for part in str(rel_path).replace('\\', '/').split('/') if part not in ('', '.')]
+    if not parts or '..' in parts or os.path.isabs(rel_path) or ':' in parts[0]:
+        raise ValueError(f"Unsafe path: {rel_path!r}")
+    return os.path.join(folder, *parts)
+
+
+def preallocate(fd, size):
+    if size <= 0:
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        os.truncate(fd, size)
+
+
+def resume_key(file_path, file_name, file_size):
+    # Stable id for an outgoing file; changes whenever the file does
+    stat = os.stat(file_path)
+    identity = f"{os.path.abspath(file_path)}\0{file_name}\0{file_size}\0{stat.st_mtime_ns}"
+    return hashlib.sha256(identity.encode('utf-8')).hexdigest()[:32]
+
+
+class ResumeJournal:
+    # <key>.part holds the bytes received so far and <key>.json records the
+    # transfer id, expected size and bytes committed to the part file.
+    def __init__(self, sync_folder):
+        self.folder = os.path.join(sync_folder, JOURNAL_DIR)
+
+    def _path(self, key, suffix):
+        if not RESUME_KEY.fullmatch(key or ''):
+            raise ValueError(f"Invalid resume key: {key!r}")
+        return os.path.join(self.folder, key + suffix)
+
+    def part_path(self, key):
+        os.makedirs(self.folder, exist_ok=True)
+        return self._path(key, '.part')
+
+    def load(self, key):
+        try:
+            with open(self._path(key, '.json'), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, entry):
+        path = self._path(entry['resume_key'], '.json')
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+    def remove(self, key, keep_part=False):
+        suffixes = ('.json',) if keep_part else ('.json', '.part')
+        for suffix in suffixes:
+            try:
+                os.unlink(self._path(key, suffix))
+            except OSError:
+                pass
+
+    def entries(self, device=None):
+        try:
+            names = os.listdir(self.folder)
+        except OSError:
+            return []
+        entries = []
+        for name in names:
+            if name.endswith('.json'):
+                entry = self.load(name[:-5])
+                if entry and (device is None or entry.get('device') == device):
+                    entries.append(entry)
+        return entries
+
+
+class IncomingFile:
+    # A file being received into a hidden part file in the sync folder. The
+    # part file is preallocated, filled by the write-behind thread and
+    # atomically renamed into place once the checksum matches. Resumable
+    # transfers keep their part file in the journal folder instead, so an
+    # interrupted transfer can continue from the last committed byte.
+    def __init__(self, folder, name, size, writer, journal=None, key=None, device=None):
+        self.folder = folder
+        self.name = os.path.basename(name)
+        self.size = size
+        self.writer = writer
+        self.journal = journal
+        self.key = key
+        self.device = device
+        if journal is not None:
+            self.part_path = journal.part_path(key)
+            flags = os.O_RDWR | os.O_CREAT
+        else:
+            self.part_path = os.path.join(folder, f".{self.name}.{uuid.uuid4().hex[:8]}.part")
+            flags = os.O_RDWR | os.O_CREAT | os.O_TRUNC
+        self.fd = os.open(self.part_path, flags | getattr(os, 'O_BINARY', 0))
+        self.digest = hashlib.sha256()
+        self.received = 0
+        self.committed = 0
+        self.checkpoint = 0
+        self.error = None
+        self.target_path = None  # replace this file on finish instead of adding a new one
+        self.folder_sync = None  # id of the folder sync this file belongs to
+        self.basis_fd = None  # receiver's existing copy while a delta is applied
+        self.striped = False  # ranges arrive out of order; hashed once complete
+        self.started = time.perf_counter()
+        preallocate(self.fd, size)
+
+    @classmethod
+    def resume(cls, folder, name, size, writer, journal, key, device, cached=None):
+        # Reopen a journaled part file and continue after its committed bytes.
+        # cached is (committed, digest) kept in memory from the interrupted
+        # session; otherwise the committed prefix is re-hashed from disk.
+        incoming = cls(folder, name, size, writer, journal, key, device)
+        entry = journal.load(key)
+        if entry and entry.get('size') == size and entry.get('name') == incoming.name:
+            committed = min(entry.get('committed', 0), size)
+            if cached and cached[0] == committed:
+                incoming.digest = cached[1]
+            else:
+                incoming.digest = hash_prefix(incoming.fd, committed)
+            incoming.received = incoming.committed = incoming.checkpoint = committed
+        else:
+            # Stale or mismatched part file: start over
+            os.ftruncate(incoming.fd, 0)
+            preallocate(incoming.fd, size)
+        incoming.save_journal()
+        return incoming
+
+    def save_journal(self):
+        self.checkpoint = self.committed
+        self.journal.save({
+            'resume_key': self.key,
+            'name': self.name,
+            'size': self.size,
+            'committed': self.committed,
+            'device': self.device,
+            'updated': int(time.time())
+        })
+
+    def write_at(self, offset, view):
+        # Called on the write-behind thread, always in arrival order
+        if not self.striped:
+            with metrics.stage('hash'):
+                self.digest.update(view)
+        end = offset + len(view)
+        with metrics.stage('write'):
+            if hasattr(os, 'pwrite'):
+                while view:
+                    written = os.pwrite(self.fd, view, offset)
+                    view = view[written:]
+                    offset += written
+            else:
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                while view:
+                    view = view[os.write(self.fd, view):]
+        self.committed = end
+        if self.journal is not None and self.committed - self.checkpoint >= CHECKPOINT_BYTES:
+            self.save_journal()
+
+    def copy_at(self, offset, source_fd, source_offset, size, block_size=1024 * 1024):
+        # Called on the write-behind thread for delta copy instructions
+        while size:
+            count = min(block_size, size)
+            data = read_at(source_fd, count, source_offset)
+            if not data:
+                raise EOFError("Basis file shrank while applying delta")
+            self.write_at(offset, memoryview(data))
+            offset += len(data)
+            source_offset += len(data)
+            size -= len(data)
+
+    def copy(self, source_fd, source_offset, size):
+        # Queue a copy from an existing file at the current position
+        self.writer.submit_copy(self, self.received, source_fd, source_offset, size)
+        self.received += size
+
+    async def receive(self, reader, size, offset=None):
+        # Read a chunk payload from the socket straight into pooled buffers,
+        # at the current position or, for striped transfers, at offset
+        pool = self.writer.pool
+        while size:
+            buffer = await pool.acquire_async(asyncio.get_running_loop())
+            count = min(size, pool.size)
+            try:
+                await reader.read_exact(memoryview(buffer)[:count])
+            except Exception:
+                pool.release(buffer)
+                raise
+            if offset is None:
+                self.writer.submit(self, self.received, buffer, count)
+            else:
+                self.writer.submit(self, offset, buffer, count)
+                offset += count
+            self.received += count
+            size -= count
+
+    def write_bytes(self, data):
+        # Queue already-decoded bytes (legacy base64 payloads)
+        pool = self.writer.pool
+        view = memoryview(data)
+        while view:
+            buffer = pool.acquire()
+            count = min(len(view), pool.size)
+            buffer[:count] = view[:count]
+            self.writer.submit(self, self.received, buffer, count)
+            self.received += count
+            view = view[count:]
+
+    def finish(self, expected_sha256=None):
+        self.writer.flush(self)
+        try:
+            if self.error is not None:
+                raise self.error
+            if self.striped:
+                if expected_sha256 and hash_file(self.part_path) != expected_sha256:
+                    raise ValueError(f"Checksum mismatch for {self.name}")
+            else:
+                if self.received != self.size:
+                    os.ftruncate(self.fd, self.received)
+                if expected_sha256 and self.digest.hexdigest() != expected_sha256:
+                    raise ValueError(f"Checksum mismatch for {self.name}")
+        except Exception:
+            self.abort()
+            raise
+        os.close(self.fd)
+        self.fd = None
+        self.close_basis()
+        file_path = self.target_path or unique_path(self.folder, self.name)
+        os.replace(self.part_path, file_path)
+        if self.journal is not None:
+            self.journal.remove(self.key, keep_part=True)
+        return file_path
+
+    def suspend(self):
+        # Connection lost: keep a resumable part file for later, drop the rest.
+        # Must run after the writer has been flushed for this file.
+        if self.journal is None or self.error is not None:
+            self.abort()
+            return None
+        os.close(self.fd)
+        self.fd = None
+        self.save_journal()
+        return self.committed, self.digest
+
+    def close_basis(self):
+        if self.basis_fd is not None:
+            os.close(self.basis_fd)
+            self.basis_fd = None
+
+    def abort(self):
+        self.close_basis()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        try:
+            os.unlink(self.part_path)
+        except OSError:
+            pass
+        if self.journal is not None:
+            self.journal.remove(self.key)
+
+
+def read_at(fd, size, offset):
+    # pread where the platform has it (not on Windows)
+    if hasattr(os, 'pread'):
+        return os.pread(fd, size, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+
+def hash_prefix(fd, length, block_size=1024 * 1024):
+    # Re-hash the committed prefix of a part file after a restart
+    digest = hashlib.sha256()
+    os.lseek(fd, 0, os.SEEK_SET)
+    while length:
+        data = os.read(fd, min(block_size, length))
+        if not data:
+            break
+        digest.update(data)
+        length -= len(data)
+    return digest
+
+
+def receive_base64(folder, name, data, writer):
+    # Decode a legacy inline payload slice by slice into an IncomingFile
+    slice_size = BASE64_SLICE - BASE64_SLICE % 4
+    incoming = IncomingFile(folder, name, len(data) * 3 // 4, writer)
+    try:
+        for start in range(0, len(data), slice_size):
+            incoming.write_bytes(binascii.a2b_base64(data[start:start + slice_size]))
+    except Exception:
+        incoming.writer.flush(incoming)
+        incoming.abort()
+        raise
+    return incoming.finish()
+
+
+async def send_file_range(loop, sock, f, offset, count, buffer):
+    # Send count bytes of f starting at offset. Uses the kernel sendfile path
+    # (page cache straight to the socket) when available and otherwise falls
+    # back to readinto the reused buffer plus sock_sendall.
+    try:
+        await loop.sock_sendfile(sock, f, offset, count, fallback=False)
+        return
+    except asyncio.SendfileNotAvailableError:
+        pass
+
+    view = memoryview(buffer)
+    f.seek(offset)
+    while count:
+        with metrics.stage('read'):
+            read = f.readinto(view[:min(count, len(buffer))])
+        if not read:
+            raise EOFError("File shrank while sending")
+        await loop.sock_sendall(sock, view[:read])
+        count -= read
+
+
+def hash_file(file_path, block_size=1024 * 1024):
+    # Run in an executor while the file's bytes go out via sendfile, so the
+    # checksum for file_end does not pull data through the send path.
+    digest = hashlib.sha256()
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    with metrics.stage('hash'), open(file_path, 'rb') as f:
+        while True:
+            count = f.readinto(buffer)
+            if not count:
+                break
+            digest.update(view[:count])
+    return digest.hexdigest()
+
+
+class TokenBucket:
+    # Caps the rate of bytes leaving the process. rate is bytes per second,
+    # 0 for no limit. Each frame reserves its bytes up front and the sender
+    # waits off any debt, so concurrent senders share the rate. Loop thread
+    # only, except set_rate.
+    def __init__(self, rate=0):
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        self.rate = max(0, int(rate))
+        # A quarter second of traffic, and at least one chunk, may go at once
+        self.burst = max(self.rate // 4, protocol.CHUNK_SIZE)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def reserve(self, count):
+        # Seconds to wait before sending count bytes
+        rate = self.rate
+        if not rate:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * rate) - count
+        self.updated = now
+        return -self.tokens / rate if self.tokens < 0 else 0.0
+
+
+class CpuMeter:
+    # Wall and process CPU time for a transfer, reported per GB moved
+    def __init__(self):
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+
+    def report(self, byte_count, wire_bytes=None):
+        wall = max(time.perf_counter() - self.wall_start, 1e-9)
+        cpu = time.process_time() - self.cpu_start
+        gigabytes = max(byte_count, 1) / (1024 ** 3)
+        return {
+            'bytes': byte_count,
+            'wire_bytes': byte_count if wire_bytes is None else wire_bytes,
+            'seconds': wall,
+            'cpu_seconds': cpu,
+            'mb_per_s': byte_count / wall / (1024 ** 2),
+            'cpu_s_per_gb': cpu / gigabytes
+        }
+
+
+def format_report(report):
+    text = f"{report['mb_per_s']:.1f} MB/s, {report['cpu_s_per_gb']:.2f} CPU s/GB"
+    if report.get('wire_bytes', report['bytes']) != report['bytes']:
+        # Deltas and compressed archives put fewer bytes on the wire than they move
+        wire = report['wire_bytes']
+        if wire < 1024 * 1024:
+            text += f", {wire / 1024:.1f} KB sent"
+        else:
+            text += f", {wire / (1024 ** 2):.1f} MB sent"
+    return text
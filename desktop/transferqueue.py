@@ -0,0 +1,271 @@
+# Persistent queue of outgoing transfers. Jobs live in SQLite, so anything
+# queued or running when the app quits runs again after a restart, and
+# receivers that support resume continue from the bytes they already hold.
+# A dispatcher thread starts at most `limit` jobs at a time, each on its own
+# thread blocking on the engine future for its transfer.
+import collections
+import json
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    targets TEXT,
+    state TEXT NOT NULL,
+    size INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created REAL NOT NULL,
+    finished REAL
+)
+"""
+
+KINDS = ('file', 'folder', 'sync')
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED = (DONE, FAILED, CANCELLED)
+
+# Finished jobs kept in the list after a restart
+HISTORY = 50
+
+# Throughput is averaged over this many seconds of progress
+RATE_WINDOW = 5.0
+
+
+def format_rate(rate):
+    if rate >= 1024 * 1024:
+        return f"{rate / (1024 ** 2):.1f} MB/s"
+    return f"{rate / 1024:.0f} KB/s"
+
+
+def format_eta(seconds):
+    if seconds is None:
+        return ""
+    minutes, seconds = divmod(int(seconds + 0.5), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+
+class Job:
+    def __init__(self, job_id, kind, path, name, targets, state, size, error=None, created=None, finished=None):
+        self.id = job_id
+        self.kind = kind
+        self.path = path
+        self.name = name
+        self.targets = targets  # device keys, or None for every connected device
+        self.state = state
+        self.size = size
+        self.error = error
+        self.created = created or time.time()
+        self.finished = finished
+        self.started = None
+        self.reports = None
+        self.progress = {}  # session id -> bytes done
+        self.samples = collections.deque()  # (monotonic time, bytes done)
+
+    @property
+    def done(self):
+        # The slowest device sets the pace
+        return min(self.progress.values()) if self.progress else 0
+
+    def update(self, session_id, done, total):
+        if total:
+            self.size = total
+        self.progress[session_id] = done
+        now = time.monotonic()
+        self.samples.append((now, self.done))
+        while len(self.samples) > 2 and now - self.samples[0][0] > RATE_WINDOW:
+            self.samples.popleft()
+
+    def rate(self):
+        # Bytes per second over the recent window
+        if len(self.samples) < 2:
+            return 0.0
+        (start, first), (end, last) = self.samples[0], self.samples[-1]
+        return (last - first) / (end - start) if end > start else 0.0
+
+    def eta(self):
+        # Seconds left, or None while unknown
+        rate = self.rate()
+        if self.state != RUNNING or not self.size or rate <= 0:
+            return None
+        return max(0.0, (self.size - self.done) / rate)
+
+
+class TransferQueue:
+    # run_job(job) runs one transfer to completion on the calling thread and
+    # returns its reports; a ConnectionError puts the job back in the queue
+    # for when the device returns, anything else fails it. ready(job) says
+    # whether a target device is connected. on_change(job) and
+    # on_finished(job) are called from worker threads.
+    def __init__(self, db_path, run_job, ready, limit=2, on_change=None, on_finished=None):
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.run_job = run_job
+        self.ready = ready
+        self.limit = max(1, int(limit))
+        self.on_change = on_change or (lambda job: None)
+        self.on_finished = on_finished or (lambda job: None)
+        self.condition = threading.Condition()
+        self.jobs = collections.OrderedDict()
+        self.running = 0
+        self.stopped = False
+        self.thread = None
+        with self.condition, self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute(SCHEMA)
+            # Interrupted by the last exit; they start over from the peer's offset
+            self.db.execute('UPDATE jobs SET state = ? WHERE state = ?', (QUEUED, RUNNING))
+            rows = self.db.execute(
+                'SELECT * FROM (SELECT * FROM jobs WHERE state IN (?, ?, ?) ORDER BY id DESC LIMIT ?) '
+                'UNION SELECT * FROM jobs WHERE state = ? ORDER BY id', (*FINISHED, HISTORY, QUEUED)).fetchall()
+        for job_id, kind, path, name, targets, state, size, error, created, finished in rows:
+            self.jobs[job_id] = Job(job_id, kind, path, name, json.loads(targets) if targets else None,
+                                    state, size, error, created, finished)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.dispatch, name='transfer-queue', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # Running transfers are left to finish or fail with the connection;
+        # their jobs stay 'running' in the store and are retried next start
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def close(self):
+        self.stop()
+        with self.condition:
+            self.db.close()
+
+    def wake(self):
+        # Something a waiting job may depend on changed, e.g. a device connected
+        with self.condition:
+            self.condition.notify_all()
+
+    def set_limit(self, limit):
+        with self.condition:
+            self.limit = max(1, int(limit))
+            self.condition.notify_all()
+
+    def add(self, kind, path, name, targets=None, size=0):
+        if kind not in KINDS:
+            raise ValueError(f"Unknown transfer kind: {kind}")
+        job = Job(None, kind, path, name, sorted(targets) if targets else None, QUEUED, size)
+        with self.condition:
+            with self.db:
+                job.id = self.db.execute(
+                    'INSERT INTO jobs (kind, path, name, targets, state, size, created) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (kind, path, name, json.dumps(job.targets) if job.targets else None, job.state, size,
+                     job.created)).lastrowid
+            self.jobs[job.id] = job
+            self.condition.notify_all()
+        self.on_change(job)
+        return job
+
+    def snapshot(self):
+        with self.condition:
+            return list(self.jobs.values())
+
+    def progress(self, job, session_id, done, total):
+        # From the job's own transfer (run_job hands it a callback), so files
+        # with the same name, sent or received, never share progress. Folder
+        # syncs report per file and show no byte progress.
+        with self.condition:
+            if job.state == RUNNING and job.kind != 'sync':
+                job.update(session_id, done, total)
+
+    def cancel(self, job_id):
+        # Only jobs that have not started; a transfer in flight runs to the end
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None or job.state != QUEUED:
+                return False
+            self.set_state(job, CANCELLED)
+        self.on_change(job)
+        return True
+
+    def retry(self, job_id):
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None or job.state not in (FAILED, CANCELLED):
+                return False
+            job.error = None
+            job.progress.clear()
+            job.samples.clear()
+            self.set_state(job, QUEUED)
+            self.condition.notify_all()
+        self.on_change(job)
+        return True
+
+    def clear_finished(self):
+        with self.condition:
+            finished = [job_id for job_id, job in self.jobs.items() if job.state in FINISHED]
+            for job_id in finished:
+                del self.jobs[job_id]
+            with self.db:
+                self.db.execute('DELETE FROM jobs WHERE state IN (?, ?, ?)', FINISHED)
+        return len(finished)
+
+    def set_state(self, job, state, error=None):
+        # Caller holds the condition
+        job.state = state
+        job.error = error
+        job.finished = time.time() if state in FINISHED else None
+        with self.db:
+            self.db.execute('UPDATE jobs SET state = ?, size = ?, error = ?, finished = ? WHERE id = ?',
+                            (state, job.size, error, job.finished, job.id))
+
+    def next_job(self):
+        # Caller holds the condition
+        if self.running >= self.limit:
+            return None
+        for job in self.jobs.values():
+            if job.state == QUEUED and self.ready(job):
+                return job
+        return None
+
+    def dispatch(self):
+        while True:
+            with self.condition:
+                job = None
+                while not self.stopped:
+                    job = self.next_job()
+                    if job is not None:
+                        break
+                    # Also re-checked periodically, in case a wake() was missed
+                    self.condition.wait(5)
+                if self.stopped:
+                    return
+                self.running += 1
+                job.started = time.monotonic()
+                job.progress.clear()
+                job.samples.clear()
+                self.set_state(job, RUNNING)
+            self.on_change(job)
+            threading.Thread(target=self.run, args=(job,), name=f'transfer-{job.id}', daemon=True).start()
+
+    def run(self, job):
+        state, error = DONE, None
+        try:
+            job.reports = self.run_job(job)
+        except ConnectionError as e:
+            print(f"Transfer of {job.name} interrupted, queued again: {e}")
+            state = QUEUED
+        except Exception as e:
+            state, error = FAILED, str(e) or type(e).__name__
+        with self.condition:
+            self.running -= 1
+            if not self.stopped:
+                self.set_state(job, state, error)
+            self.condition.notify_all()
+        self.on_change(job)
+        if state != QUEUED:
+            self.on_finished(job)
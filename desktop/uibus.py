@@ -0,0 +1,135 @@
+# The one way engine and worker threads reach the Tk thread. Events are
+# gathered under a lock and handed over in frames, at most FRAME_RATE a
+# second, with one root.after per frame however many events arrive:
+#
+#   latest(key, callback, *args)        only the newest call per key runs; for
+#                                       status and redraw requests
+#   merge(key, callback, item, value)   callback({item: value}) once per frame
+#                                       with the newest value of each item;
+#                                       for the progress of many transfers
+#   collect(key, callback, item)        callback(items) once per frame with
+#                                       every item posted since; for file
+#                                       lists and errors
+#   call(callback, *args)               runs once, in order; for the rest
+#
+# Thousands of small files arriving then cost the Tk thread a few callbacks
+# per frame, at most FRAME_RATE frames a second, instead of a callback for
+# every chunk and every file. Events are delivered in the order their keys were
+# first posted within a frame.
+import threading
+import time
+import tkinter as tk
+
+import metrics
+
+FRAME_RATE = 30
+
+
+class UiBus:
+    def __init__(self, root, frame_rate=FRAME_RATE):
+        self.root = root
+        self.interval = 1.0 / frame_rate
+        self.lock = threading.Lock()
+        self.pending = {}  # key -> [callback, args, items (list or dict) or None]
+        self.scheduled = False
+        self.last_frame = 0.0
+        self.closed = False
+
+    def latest(self, key, callback, *args):
+        with self.lock:
+            if self.closed:
+                return
+            entry = self.pending.get(key)
+            if entry is None:
+                self.pending[key] = [callback, args, None]
+            else:
+                entry[0], entry[1] = callback, args
+            delay = self.arm()
+        metrics.add('ui_events_total', kind='latest')
+        if entry is not None:
+            metrics.add('ui_events_coalesced_total')
+        self.schedule(delay)
+
+    def merge(self, key, callback, item, value):
+        with self.lock:
+            if self.closed:
+                return
+            entry = self.pending.get(key)
+            if entry is None:
+                self.pending[key] = [callback, (), {item: value}]
+            else:
+                entry[2][item] = value
+            delay = self.arm()
+        metrics.add('ui_events_total', kind='merge')
+        if entry is not None:
+            metrics.add('ui_events_coalesced_total')
+        self.schedule(delay)
+
+    def collect(self, key, callback, item):
+        with self.lock:
+            if self.closed:
+                return
+            entry = self.pending.get(key)
+            if entry is None:
+                self.pending[key] = [callback, (), [item]]
+            else:
+                entry[2].append(item)
+            delay = self.arm()
+        metrics.add('ui_events_total', kind='collect')
+        if entry is not None:
+            metrics.add('ui_events_coalesced_total')
+        self.schedule(delay)
+
+    def call(self, callback, *args):
+        with self.lock:
+            if self.closed:
+                return
+            self.pending[object()] = [callback, args, None]
+            delay = self.arm()
+        metrics.add('ui_events_total', kind='call')
+        self.schedule(delay)
+
+    def close(self):
+        # Events posted from here on are dropped; the window is going away
+        with self.lock:
+            self.closed = True
+            self.pending.clear()
+
+    def arm(self):
+        # With the lock held: seconds until the next frame should run, or
+        # None when one is already scheduled
+        if self.scheduled:
+            return None
+        self.scheduled = True
+        return max(0.0, self.last_frame + self.interval - time.monotonic())
+
+    def schedule(self, delay):
+        # Outside the lock: from another thread, root.after waits for the
+        # Tk thread, which may be in flush() waiting for the lock
+        if delay is None:
+            return
+        try:
+            self.root.after(int(delay * 1000), self.flush)
+        except (RuntimeError, tk.TclError) as e:
+            # Main loop not running yet, or the window was destroyed
+            with self.lock:
+                self.scheduled = False
+            if not self.closed:
+                print(f"UI update not scheduled: {e}")
+
+    def flush(self):
+        # Tk thread. Events posted while this runs go into the next frame.
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.scheduled = False
+            self.last_frame = time.monotonic()
+        started = time.perf_counter()
+        for callback, args, items in pending.values():
+            try:
+                if items is None:
+                    callback(*args)
+                else:
+                    callback(items)
+            except Exception as e:
+                print(f"UI update failed in {getattr(callback, '__name__', callback)}: {e}")
+        metrics.observe('ui_frame_seconds', time.perf_counter() - started)
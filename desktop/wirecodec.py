@@ -0,0 +1,195 @@
+# Compression for frames on the wire. The codec is agreed in the handshake:
+# zstd or lz4 when both sides have them installed, zlib otherwise. Every
+# payload is probed first; high-entropy data (media, archives, encrypted
+# content) goes out raw, as does anything that does not shrink enough.
+# Ratio and CPU time per codec are recorded so the policy can be tuned.
+import threading
+import time
+import zlib
+
+import archive
+import metrics
+import transfer
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Payloads smaller than this are never worth compressing
+MIN_COMPRESS_SIZE = 512
+
+# Bytes probed at the start of each payload, and the bits-per-byte above
+# which it is sent raw
+PROBE_SIZE = 4096
+RAW_ENTROPY = 7.2
+
+# Compressed output must be at most this share of the input to be used
+MAX_RATIO = 0.9
+
+# Upper bound for one decompressed payload
+MAX_DECOMPRESSED = 64 * 1024 * 1024
+
+
+class ZlibCodec:
+    name = 'zlib'
+
+    def __init__(self, level=1):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        decompressor = zlib.decompressobj()
+        result = decompressor.decompress(data, MAX_DECOMPRESSED)
+        if decompressor.unconsumed_tail:
+            raise ValueError("Decompressed payload too large")
+        if not decompressor.eof:
+            raise ValueError("Truncated zlib stream")
+        return result
+
+
+class ZstdCodec:
+    name = 'zstd'
+
+    def __init__(self, level=3):
+        self.level = level
+        self.local = threading.local()  # contexts are not shared between threads
+
+    def contexts(self):
+        if not hasattr(self.local, 'compressor'):
+            self.local.compressor = zstandard.ZstdCompressor(level=self.level)
+            self.local.decompressor = zstandard.ZstdDecompressor()
+        return self.local.compressor, self.local.decompressor
+
+    def compress(self, data):
+        return self.contexts()[0].compress(data)
+
+    def decompress(self, data):
+        # max_output_size only applies to frames without a content size; a
+        # declared size is allocated as given, so it is checked first
+        if zstandard.frame_content_size(data) > MAX_DECOMPRESSED:
+            raise ValueError("Decompressed payload too large")
+        return self.contexts()[1].decompress(data, max_output_size=MAX_DECOMPRESSED)
+
+
+class Lz4Codec:
+    name = 'lz4'
+
+    def compress(self, data):
+        return lz4.frame.compress(data)
+
+    def decompress(self, data):
+        # Bounded like the others: a small frame must not inflate to gigabytes
+        # before the size is checked
+        decompressor = lz4.frame.LZ4FrameDecompressor()
+        result = decompressor.decompress(data, max_length=MAX_DECOMPRESSED + 1)
+        if len(result) > MAX_DECOMPRESSED:
+            raise ValueError("Decompressed payload too large")
+        if not decompressor.eof:
+            raise ValueError("Truncated lz4 frame")
+        return result
+
+
+def available_codecs():
+    # Installed codecs in order of preference
+    codecs = []
+    if zstandard is not None:
+        codecs.append(ZstdCodec())
+    if lz4 is not None:
+        codecs.append(Lz4Codec())
+    codecs.append(ZlibCodec())
+    return codecs
+
+
+CODECS = available_codecs()
+CODEC_NAMES = [codec.name for codec in CODECS]
+
+
+def negotiate(offered):
+    # Our most preferred codec among those the peer offered, or None
+    offered = set(offered or [])
+    for codec in CODECS:
+        if codec.name in offered:
+            return codec
+    return None
+
+
+def find_codec(name):
+    for codec in CODECS:
+        if codec.name == name:
+            return codec
+    return None
+
+
+class CodecStats:
+    # Running totals per codec; updated from the loop and executor threads
+    FIELDS = ('compressed', 'probed_raw', 'incompressible', 'bytes_in', 'bytes_out',
+              'compress_seconds', 'decompressed', 'decompress_seconds')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.codecs = {}
+
+    def add(self, name, **values):
+        with self.lock:
+            entry = self.codecs.setdefault(name, dict.fromkeys(self.FIELDS, 0))
+            for key, value in values.items():
+                entry[key] += value
+
+    def snapshot(self):
+        with self.lock:
+            result = {}
+            for name, entry in self.codecs.items():
+                entry = dict(entry)
+                entry['ratio'] = entry['bytes_out'] / entry['bytes_in'] if entry['bytes_in'] else 1.0
+                entry['mb_per_cpu_s'] = (entry['bytes_in'] / (1024 ** 2) / entry['compress_seconds']
+                                         if entry['compress_seconds'] else 0.0)
+                result[name] = entry
+            return result
+
+
+class WireCompressor:
+    # Codec of one connection plus the shared statistics
+    def __init__(self, codec, stats):
+        self.codec = codec
+        self.stats = stats
+
+    def pack(self, data):
+        # Returns (compressed, payload)
+        if len(data) < MIN_COMPRESS_SIZE:
+            return False, data
+        if archive.byte_entropy(bytes(data[:PROBE_SIZE])) > RAW_ENTROPY:
+            self.stats.add(self.codec.name, probed_raw=1)
+            return False, data
+        start = time.thread_time()
+        with metrics.stage('compress'):
+            packed = self.codec.compress(data)
+        elapsed = time.thread_time() - start
+        if len(packed) > len(data) * MAX_RATIO:
+            self.stats.add(self.codec.name, incompressible=1, compress_seconds=elapsed)
+            return False, data
+        self.stats.add(self.codec.name, compressed=1, bytes_in=len(data), bytes_out=len(packed),
+                       compress_seconds=elapsed)
+        return True, packed
+
+    def pack_range(self, fd, offset, count):
+        # Read a file range and pack it; runs in an executor
+        with metrics.stage('read'):
+            data = transfer.read_at(fd, count, offset)
+        if len(data) != count:
+            raise EOFError("File shrank while sending")
+        return self.pack(data)
+
+    def unpack(self, data):
+        start = time.thread_time()
+        with metrics.stage('decompress'):
+            result = self.codec.decompress(bytes(data))
+        self.stats.add(self.codec.name, decompressed=1, decompress_seconds=time.thread_time() - start)
+        return result
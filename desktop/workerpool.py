@@ -0,0 +1,20 @@
+# Shutting down the process pools used for CPU-bound work (folder archives,
+# thumbnails) without hanging the app on a worker stuck in a large file.
+import threading
+
+
+def shutdown(pool, timeout, name):
+    # Pending jobs are cancelled; a worker mid-job may still be writing its
+    # result, so the pool is joined before its pipes go away. Workers still
+    # busy after timeout seconds are terminated. name labels the closing
+    # thread and the message.
+    closer = threading.Thread(target=pool.shutdown, kwargs={'wait': True, 'cancel_futures': True},
+                              name=f'{name}-pool-shutdown', daemon=True)
+    closer.start()
+    closer.join(timeout)
+    if closer.is_alive():
+        print(f"{name.capitalize()} workers did not stop in time, terminating them")
+        # ProcessPoolExecutor offers no public way to reach its workers
+        for process in list((getattr(pool, '_processes', None) or {}).values()):
+            process.terminate()
+        closer.join(timeout)